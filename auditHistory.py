@@ -0,0 +1,238 @@
+# This module keeps the history of the collection audit reports. The artifactDiff, artifactDup, previewDiff and
+# typeProfiles reports are overwritten on every run, so each audit script also appends the SUMMARY line and the
+# category rows (MISSING_IN_SI, DIFF_CHECKSUMS, INCONSISTENT_FOR_BOTH, ...) of every report to a store with one
+# directory per audit. The rows of a report are written to a Parquet file partitioned by the date of the run and
+# sorted by category, and a CSV index holds the number of rows of every run, collection and category, so the trend
+# of a category is read from the index alone and the changes since the last run only open two Parquet files.
+
+from datetime import datetime
+from lazyImport import lazy_import
+import fcntl
+import sys
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+HISTORY_ROOT = "history"
+INDEX_NAME = "index.csv"
+SUMMARY_CATEGORY = "SUMMARY"
+INDEX_COLUMNS = ["run", "run_time", "date", "collection", "category", "num_rows", "path"]
+
+## The column identifying a category row, in order of preference. Rows with none of these columns, such as the
+## type profile combinations, are identified by all their values.
+KEY_COLUMNS = ["uri", "planeID", "observationID"]
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {sys.argv[0]} runs <audit> [collection]")
+    print(f"       {sys.argv[0]} trend <audit> <collection> [category1 category2 ...]")
+    print(f"       {sys.argv[0]} changes <audit> <collection> [category1 category2 ...]")
+    print(f"       {sys.argv[0]} <-h || -help> for help")
+    print(f"Example: {sys.argv[0]} changes artifactDiff CFHT MISSING_IN_SI")
+
+def history_directory(audit):
+    return f"{HISTORY_ROOT}/{audit}"
+
+def index_filename(audit):
+    return f"{history_directory(audit)}/{INDEX_NAME}"
+
+## The schema of the index, built when it is needed so that polars is not loaded on import.
+def index_schema():
+    return {column: pl.Int64 if column == "num_rows" else pl.String for column in INDEX_COLUMNS}
+
+## Read the index of an audit, one row per run, collection and category with the path of its Parquet file. The paths
+## are relative to HISTORY_ROOT so that the store can be moved.
+def read_index(audit):
+    if not os.path.exists(index_filename(audit)):
+        return pl.DataFrame(schema=index_schema())
+    return pl.read_csv(index_filename(audit), schema=index_schema())
+
+## Return the category rows of a report frame with a key column identifying each row and all values as strings, so
+## that reports written by different versions of a script can be compared.
+def with_key(frame):
+    key_columns = [column for column in KEY_COLUMNS if column in frame.columns][:1]
+    if len(key_columns) == 0:
+        key_columns = [column for column in frame.columns if column != "category"]
+    frame = frame.select(pl.all().cast(pl.String))
+    return frame.with_columns(pl.concat_str(key_columns, separator="|", ignore_nulls=True).alias("key"))
+
+## Append the SUMMARY line and the category rows of one report to the history store of the audit. The frames are the
+## category rows as written in the report, each with a category column; frames without rows are skipped. Categories
+## listed in categories are recorded in the index even when the report has no rows for them, so that a count going
+## down to zero shows in the trend. Appending the same collection and run again replaces its files and index entries.
+def append_report(audit, collection, start_time, header, summary, frames, categories=[]):
+    run = start_time.strftime("%Y-%m-%dT%H-%M-%S")
+    run_time = start_time.strftime("%Y-%m-%dT%H:%M:%S")
+    date = start_time.strftime("%Y-%m-%d")
+    partition = f"{audit}/date={date}"
+    rows_path = f"{partition}/{collection}_{run}.parquet"
+    summary_path = f"{partition}/{collection}_{run}_summary.parquet"
+
+    ## The SUMMARY line is kept as a single row with the columns of its header.
+    summary_df = pl.DataFrame([summary.rstrip("\n").split("\t")], schema=header.split("\t"), orient="row")
+
+    rows_frames = [with_key(frame) for frame in frames if len(frame) > 0 and "category" in frame.columns]
+    if len(rows_frames) > 0:
+        rows_df = pl.concat(rows_frames, how="diagonal")
+        rows_df = rows_df.select(["category", "key"] + [column for column in rows_df.columns if column not in ["category", "key"]]).sort(["category", "key"])
+    else:
+        rows_df = pl.DataFrame(schema={"category": pl.String, "key": pl.String})
+
+    os.makedirs(f"{HISTORY_ROOT}/{partition}", exist_ok=True)
+    rows_df.write_parquet(f"{HISTORY_ROOT}/{rows_path}")
+    summary_df.write_parquet(f"{HISTORY_ROOT}/{summary_path}")
+
+    counts_df = rows_df.group_by("category").agg(pl.len().cast(pl.Int64).alias("num_rows"))
+    missing_categories = [category for category in categories if category not in counts_df["category"].to_list()]
+    counts_df = pl.concat([counts_df, pl.DataFrame({"category": missing_categories, "num_rows": [0] * len(missing_categories)}, schema=counts_df.schema)])
+    report_index_df = pl.concat([
+        pl.DataFrame({"category": [SUMMARY_CATEGORY], "num_rows": [1], "path": [summary_path]}, schema={"category": pl.String, "num_rows": pl.Int64, "path": pl.String}),
+        counts_df.with_columns(pl.lit(rows_path).alias("path"))
+    ]).with_columns(
+        pl.lit(run).alias("run"),
+        pl.lit(run_time).alias("run_time"),
+        pl.lit(date).alias("date"),
+        pl.lit(collection).alias("collection")
+    ).select(INDEX_COLUMNS)
+
+    ## The parallel runs of caomAuditRunner append to the same index, so it is read and rewritten under a lock.
+    with open(f"{index_filename(audit)}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index_df = read_index(audit).filter(~((pl.col("collection") == collection) & (pl.col("run") == run)))
+        index_df = pl.concat([index_df, report_index_df]).sort(["collection", "category", "run_time"])
+        index_df.write_csv(index_filename(audit))
+
+    print(f"Appended the SUMMARY and {len(rows_df)} category rows of {collection} to {HISTORY_ROOT}/{rows_path}.")
+    return
+
+## Return the runs of an audit, optionally for one collection only, oldest first.
+def list_runs(audit, collection):
+    index_df = read_index(audit).filter(pl.col("category") == SUMMARY_CATEGORY)
+    if collection is not None:
+        index_df = index_df.filter(pl.col("collection") == collection)
+    return index_df.select(["run_time", "collection"]).sort(["run_time", "collection"])
+
+## Return the number of rows of each category of a collection across all runs, with the change since the previous run.
+## Only the index is read.
+def trend(audit, collection, categories):
+    index_df = read_index(audit).filter((pl.col("collection") == collection) & (pl.col("category") != SUMMARY_CATEGORY))
+    if index_df.is_empty():
+        print(f"No runs of {audit} found for collection {collection} in {index_filename(audit)}.")
+        exit(1)
+    if len(categories) > 0:
+        index_df = index_df.filter(pl.col("category").is_in(categories))
+    return index_df.sort(["category", "run_time"]).with_columns(
+        pl.col("num_rows").diff().over("category").alias("change")
+    ).select(["run_time", "category", "num_rows", "change"]).sort(["run_time", "category"])
+
+## Read the category and key of the rows of one run.
+def read_keys(index_df, run, categories):
+    paths = index_df.filter((pl.col("run") == run) & (pl.col("category") != SUMMARY_CATEGORY))["path"].unique().to_list()
+    if len(paths) == 0:
+        return pl.DataFrame(schema={"category": pl.String, "key": pl.String})
+    keys_df = pl.scan_parquet([f"{HISTORY_ROOT}/{path}" for path in paths]).select(["category", "key"])
+    if len(categories) > 0:
+        keys_df = keys_df.filter(pl.col("category").is_in(categories))
+    return keys_df.collect()
+
+## Read the SUMMARY line of one run as a single row.
+def read_summary(index_df, run):
+    return pl.read_parquet(HISTORY_ROOT + "/" + index_df.filter((pl.col("run") == run) & (pl.col("category") == SUMMARY_CATEGORY))["path"][0])
+
+## Compare the last two runs of a collection. Returns the SUMMARY values that changed, the number of rows of each
+## category in both runs with the number of new and resolved rows, and the new and resolved rows themselves.
+def changes(audit, collection, categories):
+    index_df = read_index(audit).filter(pl.col("collection") == collection)
+    runs = index_df.filter(pl.col("category") == SUMMARY_CATEGORY).sort("run_time")["run"].to_list()
+    if len(runs) < 2:
+        print(f"Found {len(runs)} runs of {audit} for collection {collection} in {index_filename(audit)}, at least 2 are needed.")
+        exit(1)
+    previous, latest = runs[-2], runs[-1]
+
+    previous_summary = read_summary(index_df, previous)
+    latest_summary = read_summary(index_df, latest)
+    summary_columns = [column for column in latest_summary.columns if column in previous_summary.columns]
+    summary_df = pl.DataFrame({
+        "column": summary_columns,
+        "previous": [previous_summary[column][0] for column in summary_columns],
+        "latest": [latest_summary[column][0] for column in summary_columns]
+    }).filter(pl.col("previous") != pl.col("latest"))
+
+    previous_keys = read_keys(index_df, previous, categories)
+    latest_keys = read_keys(index_df, latest, categories)
+    changed_df = pl.concat([
+        latest_keys.join(previous_keys, on=["category", "key"], how="anti").with_columns(pl.lit("NEW").alias("change")),
+        previous_keys.join(latest_keys, on=["category", "key"], how="anti").with_columns(pl.lit("RESOLVED").alias("change"))
+    ]).select(["change", "category", "key"]).sort(["category", "change", "key"])
+
+    counts_df = index_df.filter((pl.col("category") != SUMMARY_CATEGORY) & pl.col("run").is_in([previous, latest]))
+    if len(categories) > 0:
+        counts_df = counts_df.filter(pl.col("category").is_in(categories))
+    counts_df = counts_df.pivot(on="run", index="category", values="num_rows").rename({previous: "previous", latest: "latest"}, strict=False)
+    for column in ["previous", "latest"]:
+        if column not in counts_df.columns:
+            counts_df = counts_df.with_columns(pl.lit(None, dtype=pl.Int64).alias(column))
+    change_counts_df = changed_df.group_by("category").agg(
+        (pl.col("change") == "NEW").sum().cast(pl.Int64).alias("new"),
+        (pl.col("change") == "RESOLVED").sum().cast(pl.Int64).alias("resolved")
+    )
+    counts_df = counts_df.join(change_counts_df, on="category", how="left").with_columns(
+        pl.col("previous").fill_null(0),
+        pl.col("latest").fill_null(0),
+        pl.col("new").fill_null(0),
+        pl.col("resolved").fill_null(0)
+    ).with_columns(
+        (pl.col("latest") - pl.col("previous")).alias("change")
+    ).select(["category", "previous", "latest", "change", "new", "resolved"]).sort("category")
+
+    print(f"Changes in {audit} for {collection} from the run of {datetime.strptime(previous, '%Y-%m-%dT%H-%M-%S')} to the run of {datetime.strptime(latest, '%Y-%m-%dT%H-%M-%S')}.")
+    return summary_df, counts_df, changed_df
+
+## Main function to execute the script.
+## It queries the history store that the caomArtifactDiff, caomArtifactDup, caomPreviewDiff and caomTypeProfiles
+## scripts append to. The changes command writes the new and resolved rows to <audit>_<collection>_changes.tsv.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
+
+if __name__ == "__main__":
+
+    ## Determine where the collectionAuditing directory is located and change to that directory.
+    if os.path.isdir("/Users/gaudet_1/work/collectionAuditing"):
+        os.chdir("/Users/gaudet_1/work/collectionAuditing")
+    elif os.path.isdir("/arc/projects/CADC/collectionAuditing"):
+        os.chdir("/arc/projects/CADC/collectionAuditing")
+    else:
+        print("Unable to determine the location of the collectionAuditing directory.")
+        exit(1)
+
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(1)
+
+    if sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+
+    pl.Config.set_tbl_rows(-1)
+    command = sys.argv[1]
+    if command == "runs" and len(sys.argv) in [3, 4]:
+        print(list_runs(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None))
+    elif command == "trend" and len(sys.argv) >= 4:
+        print(trend(sys.argv[2], sys.argv[3], sys.argv[4:]))
+    elif command == "changes" and len(sys.argv) >= 4:
+        summary_df, counts_df, changed_df = changes(sys.argv[2], sys.argv[3], sys.argv[4:])
+        print(summary_df)
+        print(counts_df)
+        changes_filename = f"{sys.argv[2]}_{sys.argv[3]}_changes.tsv"
+        try:
+            changed_df.write_csv(changes_filename, separator='\t')
+        except Exception as e:
+            print(f"Error writing changes to {changes_filename}: {e}")
+            exit(1)
+        print(f"Wrote {len(changed_df)} new and resolved rows to {changes_filename}.")
+    else:
+        print_usage()
+        exit(1)
+
+    exit(0)
@@ -0,0 +1,273 @@
+# This module provides the phase timing shared by the audit scripts. A trace records one span for each phase
+# of a run (queries, processing, writing) holding its wall time, CPU time, the peak resident memory of the
+# process, and the bytes downloaded and rows parsed while it was open. The trace of a run is written as JSON
+# next to its TSV report so that runs can be compared without parsing the report text. The CountingReader wraps
+# the response stream of a sync TAP query to separate the time waiting for the server, the time downloading
+# and the time parsing the CSV.
+
+from datetime import datetime, timedelta, timezone
+import threading
+import resource
+import io
+import json
+import time
+import sys
+import os
+
+## Set up variables
+TRACE_SUFFIX = ".trace.json"
+READ_CHUNK_SIZE = 1024 * 1024
+THROUGHPUT_COLUMNS = ["time to first byte in seconds", "bytes downloaded", "bytes decoded", "download MB/s", "parse rows/s"]
+
+## ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+RSS_UNITS = 1 if sys.platform == "darwin" else 1024
+
+## The spans open on each thread, so that counts recorded deep inside a query are added to every enclosing span.
+OPEN_SPANS = threading.local()
+
+## Return the peak resident memory of the process in bytes.
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNITS
+
+## Return the stack of spans open on the current thread.
+def open_spans():
+    if not hasattr(OPEN_SPANS, "stack"):
+        OPEN_SPANS.stack = []
+    return OPEN_SPANS.stack
+
+## Add downloaded bytes and parsed rows, and the time spent waiting for, downloading and parsing them, to every
+## span open on the current thread.
+def count(num_bytes=0, num_rows=0, ttfb_seconds=0.0, download_seconds=0.0, parse_seconds=0.0, decoded_bytes=0):
+    for span in open_spans():
+        span.count(num_bytes, num_rows, ttfb_seconds, download_seconds, parse_seconds, decoded_bytes)
+
+## Return the throughput of a phase from its totals: the time to first byte, the bytes downloaded, the bytes after
+## decompression, the download rate in MB/s of the bytes downloaded and the parse rate in rows/s.
+def throughput(phase_totals):
+    download_seconds = phase_totals.get("download_seconds", 0.0)
+    parse_seconds = phase_totals.get("parse_seconds", 0.0)
+    return {
+        "ttfb_seconds": phase_totals.get("ttfb_seconds", 0.0),
+        "bytes": phase_totals.get("bytes", 0),
+        "decoded_bytes": phase_totals.get("decoded_bytes", 0),
+        "mb_per_second": phase_totals.get("bytes", 0) / 1e6 / download_seconds if download_seconds > 0 else 0.0,
+        "rows_per_second": phase_totals.get("rows", 0) / parse_seconds if parse_seconds > 0 else 0.0,
+    }
+
+## Return the tab separated header of the throughput columns, prefixed with a label such as CAOM or SI.
+def throughput_header(label):
+    return "\t".join([f"{label} {column}" for column in THROUGHPUT_COLUMNS])
+
+## Return the tab separated throughput columns.
+def format_throughput(stats):
+    return f"{stats['ttfb_seconds']:.2f}\t{stats['bytes']}\t{stats['decoded_bytes']}\t{stats['mb_per_second']:.2f}\t{stats['rows_per_second']:.0f}"
+
+## Wrap the raw response stream of a query so that pl.read_csv counts the bytes it reads. The time to first byte is
+## measured from request_start, taken with time.perf_counter before the request was sent, and the parse time is the
+## time from the last byte read until parsed is called, unless the parser measured it while reading the stream. When the response is compressed and the raw stream decodes
+## it, the bytes read are the decoded bytes and the bytes downloaded are taken from the position of the raw stream.
+class CountingReader(io.RawIOBase):
+    def __init__(self, raw, request_start):
+        self.raw = raw
+        self.request_start = request_start
+        self.first_byte_time = None
+        self.last_byte_time = None
+        self.num_bytes = 0
+        self.leftover = b""
+
+    def readable(self):
+        return True
+
+    ## The first read asks for a single byte so that the time to first byte is not hidden inside a large read. A
+    ## decoding stream can return more than was asked for, and the excess is kept for the next read.
+    def readinto(self, buffer):
+        if len(self.leftover) > 0:
+            data = self.leftover
+        else:
+            data = self.raw.read(1 if self.first_byte_time is None else len(buffer))
+            if data:
+                now = time.perf_counter()
+                if self.first_byte_time is None:
+                    self.first_byte_time = now
+                self.last_byte_time = now
+                self.num_bytes += len(data)
+        self.leftover = data[len(buffer):]
+        data = data[:len(buffer)]
+        buffer[:len(data)] = data
+        return len(data)
+
+    ## Return the number of bytes downloaded, which is the position of the raw stream for a urllib3 response.
+    def downloaded_bytes(self):
+        try:
+            return self.raw.tell()
+        except Exception:
+            return self.num_bytes
+
+    ## Read the whole stream in large chunks rather than the small default buffer of RawIOBase.
+    def readall(self):
+        chunks = []
+        while True:
+            chunk = self.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    ## Record the rows parsed from the stream and add the counts and times to the open spans. A parser that parses
+    ## while the stream downloads gives the time it spent parsing as parse_seconds. Returns the throughput of this query.
+    def parsed(self, num_rows, parse_seconds=None):
+        now = time.perf_counter()
+        first_byte_time = self.first_byte_time if self.first_byte_time is not None else now
+        last_byte_time = self.last_byte_time if self.last_byte_time is not None else now
+        totals = {
+            "ttfb_seconds": first_byte_time - self.request_start,
+            "download_seconds": last_byte_time - first_byte_time,
+            "parse_seconds": now - last_byte_time if parse_seconds is None else parse_seconds,
+            "bytes": self.downloaded_bytes(),
+            "decoded_bytes": self.num_bytes,
+            "rows": num_rows,
+        }
+        count(totals["bytes"], num_rows, totals["ttfb_seconds"], totals["download_seconds"], totals["parse_seconds"], self.num_bytes)
+        return throughput(totals)
+
+## A timed phase of a run, used as a context manager. The CPU time is that of the whole process, so it includes
+## the worker threads used by polars, and the peak RSS is the high water mark of the process when the span ended.
+class Span:
+    def __init__(self, trace, phase, attributes):
+        self.trace = trace
+        self.phase = phase
+        self.attributes = attributes
+        self.num_bytes = 0
+        self.decoded_bytes = 0
+        self.num_rows = 0
+        self.ttfb_seconds = 0.0
+        self.download_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.wall_seconds = None
+        self.cpu_seconds = None
+
+    ## Start the span. Spans are normally used with a with statement, but a long phase can call start and stop.
+    def start(self):
+        self.start_time = datetime.now(timezone.utc)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        open_spans().append(self)
+        return self
+
+    ## Stop the span and add it to the trace, recording the type of the exception if the phase failed.
+    def stop(self, error=None):
+        self.wall_seconds = time.perf_counter() - self.start_wall
+        self.cpu_seconds = time.process_time() - self.start_cpu
+        open_spans().remove(self)
+        record = {
+            "phase": self.phase,
+            "start_time": self.start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "peak_rss_bytes": peak_rss(),
+            "bytes": self.num_bytes,
+            "decoded_bytes": self.decoded_bytes,
+            "rows": self.num_rows,
+            "ttfb_seconds": round(self.ttfb_seconds, 6),
+            "download_seconds": round(self.download_seconds, 6),
+            "parse_seconds": round(self.parse_seconds, 6),
+            "error": error,
+        }
+        record.update(self.attributes)
+        self.trace.add(record)
+        return self.duration
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(exc_type.__name__ if exc_type is not None else None)
+        return False
+
+    ## Add downloaded bytes and parsed rows, and the time spent on them, to this span only.
+    def count(self, num_bytes=0, num_rows=0, ttfb_seconds=0.0, download_seconds=0.0, parse_seconds=0.0, decoded_bytes=0):
+        self.num_bytes += num_bytes
+        self.decoded_bytes += decoded_bytes
+        self.num_rows += num_rows
+        self.ttfb_seconds += ttfb_seconds
+        self.download_seconds += download_seconds
+        self.parse_seconds += parse_seconds
+
+    ## The wall time of the span as a timedelta, for use with format_duration. While the span is open this is
+    ## the time elapsed so far.
+    @property
+    def duration(self):
+        if self.wall_seconds is None:
+            return timedelta(seconds=time.perf_counter() - self.start_wall)
+        return timedelta(seconds=self.wall_seconds)
+
+## The spans of one run, e.g. one collection of an audit. Spans may be recorded from several threads.
+class Trace:
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start_time = datetime.now(timezone.utc)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    ## Open a span for a phase, with optional attributes such as the site or namespace queried.
+    def span(self, phase, **attributes):
+        return Span(self, phase, attributes)
+
+    ## Add a finished span, or the spans recorded by another process.
+    def add(self, record):
+        with self.lock:
+            self.spans.append(record)
+
+    def extend(self, records):
+        with self.lock:
+            self.spans.extend(records)
+
+    ## Return the total wall time of the spans of a phase as a timedelta.
+    def duration(self, phase):
+        with self.lock:
+            return timedelta(seconds=sum(span["wall_seconds"] for span in self.spans if span["phase"] == phase))
+
+    ## Return the totals of each phase, in the order the phases first ended.
+    def totals(self):
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                phase_totals = totals.setdefault(span["phase"], {"spans": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0, "decoded_bytes": 0, "rows": 0,
+                                                                 "ttfb_seconds": 0.0, "download_seconds": 0.0, "parse_seconds": 0.0})
+                phase_totals["spans"] += 1
+                for key in ["wall_seconds", "cpu_seconds", "ttfb_seconds", "download_seconds", "parse_seconds"]:
+                    phase_totals[key] = round(phase_totals[key] + span.get(key, 0.0), 6)
+                phase_totals["bytes"] += span["bytes"]
+                phase_totals["decoded_bytes"] += span.get("decoded_bytes", 0)
+                phase_totals["rows"] += span["rows"]
+        return totals
+
+    ## Return the throughput of the spans of a phase, see throughput.
+    def throughput(self, phase):
+        return throughput(self.totals().get(phase, {}))
+
+    ## Write the trace next to the report, replacing the extension of the report with .trace.json.
+    def write(self, report_filename):
+        filename = f"{os.path.splitext(report_filename)[0]}{TRACE_SUFFIX}"
+        end_time = datetime.now(timezone.utc)
+        trace = {
+            "name": self.name,
+            "script": os.path.basename(sys.argv[0]),
+            "report": report_filename,
+            "start_time": self.start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            "end_time": end_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            "wall_seconds": round((end_time - self.start_time).total_seconds(), 6),
+            "peak_rss_bytes": peak_rss(),
+        }
+        trace.update(self.attributes)
+        trace["totals"] = {phase: {**phase_totals, **throughput(phase_totals)} for phase, phase_totals in self.totals().items()}
+        with self.lock:
+            trace["spans"] = list(self.spans)
+        try:
+            with open(filename, 'w') as f:
+                json.dump(trace, f, indent=2)
+                f.write("\n")
+        except Exception as e:
+            print(f"Error writing trace to {filename}: {e}")
+        return filename
@@ -0,0 +1,76 @@
+# This script benchmarks usageGenCollInstr.calculate_percentages against the previous row-by-row
+# implementation over a synthetic set of collection/instrument combinations, and checks that both
+# produce the same CSV file.
+
+from pathlib import Path
+import argparse
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import usageGenCollInstr
+
+## The previous implementation, which scanned the totals once per result row.
+
+def find_num_instances(collection, instrument_name, array_coll_instr):
+    row = array_coll_instr[(array_coll_instr['collection'] == collection) & (array_coll_instr['instrument_name'] == instrument_name)]
+    return row['num_instances'].values[0]
+
+def calculate_percentages_by_row(filename, array_coll_instr):
+    cp_results = pd.read_csv(filename)
+
+    if len(cp_results) > 0:
+        cp_results['num_instances'] = cp_results.apply(lambda row: find_num_instances(row['collection'], row['instrument_name'], array_coll_instr), axis=1)
+        cp_results['percentage_null'] = cp_results.apply(lambda row: row['num_null'] * 100 / row['num_instances'], axis=1)
+        cp_results['num_instances'] = cp_results['num_instances'].round(2)
+        cp_results['percentage_null'] = cp_results['percentage_null'].round(2)
+
+        cp_results.to_csv(filename, index=False)
+
+## Generate the totals for num_pairs collection/instrument combinations and a field result
+## with null values for a fraction of them, written as execute_query writes it.
+
+def generate_inputs(num_pairs, directory):
+    rng = np.random.default_rng(42)
+    array_coll_instr = pd.DataFrame({
+        'collection': [f"COLL{index // 10}" for index in range(num_pairs)],
+        'instrument_name': [f"INSTR{index % 10}" for index in range(num_pairs)],
+        'num_instances': rng.integers(1, 1000000, num_pairs)
+    })
+    results = array_coll_instr.sample(frac=0.8, random_state=42).sort_values(['collection', 'instrument_name']).reset_index(drop=True)
+    results = results[['collection', 'instrument_name']].copy()
+    results['num_null'] = rng.integers(0, 1000, len(results))
+
+    filename = os.path.join(directory, "field.csv")
+    results.to_csv(filename, index=True)
+    return array_coll_instr, filename
+
+def time_calculation(function, filename, array_coll_instr, copy_filename):
+    shutil.copy(filename, copy_filename)
+    start = time.perf_counter()
+    function(copy_filename, array_coll_instr)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-pairs", type=int, nargs='+', default=[1000, 2000, 5000], help="Numbers of collection/instrument combinations")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_pairs in args.num_pairs:
+            array_coll_instr, filename = generate_inputs(num_pairs, directory)
+            by_row_filename = os.path.join(directory, "by_row.csv")
+            joined_filename = os.path.join(directory, "joined.csv")
+
+            by_row_duration = time_calculation(calculate_percentages_by_row, filename, array_coll_instr, by_row_filename)
+            joined_duration = time_calculation(usageGenCollInstr.calculate_percentages, filename, array_coll_instr, joined_filename)
+
+            identical = Path(by_row_filename).read_bytes() == Path(joined_filename).read_bytes()
+            print(f"{num_pairs} pairs: by row {by_row_duration:.3f} s, joined {joined_duration:.3f} s, speedup {by_row_duration / joined_duration:.0f}x, identical output {identical}")
@@ -0,0 +1,59 @@
+# This script measures the startup cost of each entry point script, i.e. the time to import it before any of its
+# work starts, using python -X importtime in a fresh interpreter. It also lists the heavy packages that were loaded
+# at import, which should be none now that they are loaded on first use.
+
+from pathlib import Path
+import subprocess
+import argparse
+import time
+import sys
+
+SCRIPT_DIRECTORY = Path(__file__).resolve().parent.parent
+HEAVY_PACKAGES = ["polars", "pandas", "numpy", "requests", "astroquery", "astropy"]
+ENTRY_POINTS = ["caomArtifactDiff", "caomArtifactDup", "caomPreviewDiff", "caomTypeProfiles", "caomAuditRunner", "collectionAuditingSummary",
+                "auditHistory", "siDiffSites", "siGenCopies", "siHistory", "siMergeCopies", "usagePipeline", "usagePrep",
+                "usageGenCollection", "usageGenCollInstr", "usageGenFieldByCollection", "usageGenFieldByCollInstr",
+                "usageSumCollection", "usageSumCollInstr", "usageSumFieldByCollection", "usageSumFieldByCollInstr"]
+
+## Import a module in a fresh interpreter and return the wall time of the process, the cumulative import time of the
+## module in seconds as reported by -X importtime, and the heavy packages it imported.
+def time_import(module):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=SCRIPT_DIRECTORY,
+                            capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    import_seconds = 0.0
+    loaded = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.removeprefix("import time:").split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        if name == module:
+            import_seconds = int(fields[1]) / 1e6
+        if name in HEAVY_PACKAGES:
+            loaded.append(name)
+    return wall_seconds, import_seconds, loaded
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs='*', default=ENTRY_POINTS, help="Entry point modules to import")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of imports of each module, the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{'Module':<28}{'Import s':>10}{'Process s':>11}  Heavy packages loaded")
+    for module in args.modules:
+        try:
+            timings = [time_import(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{module:<28}  failed: {e}")
+            continue
+        wall_seconds = min(timing[0] for timing in timings)
+        import_seconds = min(timing[1] for timing in timings)
+        print(f"{module:<28}{import_seconds:>10.3f}{wall_seconds:>11.3f}  {' '.join(timings[0][2]) or '-'}")
@@ -0,0 +1,56 @@
+# This script benchmarks tapStream.read_csv_pipelined against pl.read_csv on a synthetic artifact listing
+# served through a stream throttled to a given link rate, and checks that both produce the same DataFrame.
+
+from pathlib import Path
+import argparse
+import time
+import sys
+import io
+
+import polars as pl
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import tapStream
+
+## A stream that delivers its data no faster than the given rate, as a slow inter-site link would.
+
+class ThrottledStream(io.RawIOBase):
+    def __init__(self, data, bytes_per_second):
+        self.data = io.BytesIO(data)
+        self.bytes_per_second = bytes_per_second
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self.data.read(min(len(buffer), 1024 * 1024))
+        time.sleep(len(chunk) / self.bytes_per_second)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+## Generate an artifact listing with the columns returned by the caomArtifactDiff queries.
+
+def generate_listing(num_rows):
+    lines = ["uri,contentCheckSum,contentLength,contentType,lastModified"]
+    for index in range(num_rows):
+        lines.append(f"cadc:COLL/file{index:09}.fits,md5:{index:032x},{index * 7919 % 1000000007},application/fits,2024-01-01T00:00:00.000")
+    return ("\n".join(lines) + "\n").encode()
+
+def time_read(function, data, bytes_per_second):
+    start = time.perf_counter()
+    result = function(ThrottledStream(data, bytes_per_second))
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-rows", type=int, default=2000000, help="Number of rows in the listing")
+    parser.add_argument("-r", "--rate", type=float, nargs='+', default=[50, 200], help="Link rates in MB/s")
+    args = parser.parse_args()
+
+    data = generate_listing(args.num_rows)
+    print(f"Listing of {args.num_rows} rows, {len(data) / 1e6:.1f} MB")
+    for rate in args.rate:
+        buffered, buffered_duration = time_read(pl.read_csv, data, rate * 1e6)
+        pipelined, pipelined_duration = time_read(tapStream.read_csv_pipelined, data, rate * 1e6)
+        print(f"{rate:.0f} MB/s: download alone {len(data) / (rate * 1e6):.2f} s, read_csv {buffered_duration:.2f} s, pipelined {pipelined_duration:.2f} s, identical output {buffered.equals(pipelined)}")
@@ -1,22 +1,32 @@
 from datetime import datetime, timezone
 from pathlib import Path
-import polars as pl
-import requests
+from lazyImport import lazy_import
+import auditHistory
+import auditTrace
+import caomConfig
+import querySchedule
 import os
 import sys
 
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+requests = lazy_import("requests")
+
 ## Set up variables
 CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
 OUTPUT_DIRECTORY = f"artifactDiff_reports"
 OUTPUT_FILENAME_ROOT = "artifactDiff"
 SI_URL = "https://ws.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/luskan"
-MAPPINGS_CONFIG = pl.DataFrame()
-COLLECTIONS_CONFIG = pl.DataFrame()
-SITES_CONFIG = pl.DataFrame()
-CAOM_QUERY_DURATION = 0
-SI_QUERY_DURATION = 0
+TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
 MULTI_VALUED_SEPARATOR = '_'
 PROCESSING_START_TIME = datetime.now(timezone.utc)
+CATEGORIES = ["MISSING_IN_SI", "MISSING_IN_CAOM", "DIFF_CHECKSUMS", "DIFF_LENGTHS", "DIFF_TYPES"]
+
+## In delta mode the report lists only the URIs that entered or left a category since the previous run. The category
+## sets of each run are kept in DELTA_STATE_DIRECTORY as the sorted URIs of each category, which are few compared to
+## the artifacts of the collections.
+DELTA_MODE = False
+DELTA_STATE_DIRECTORY = "delta_state"
 
 ## Format a duration as HH:MM:SS
 def format_duration(duration):
@@ -26,28 +36,16 @@ def format_duration(duration):
     seconds = total_seconds % 60
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-## Formate a duration in seconds as HH:MM:SS
-def format_duration_in_seconds(seconds):
-    total_seconds = int(seconds)
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    seconds = total_seconds % 60
-    return f"{hours:02}:{minutes:02}:{seconds:02}"
-
 ## Execute the query as a sync call to the site URL, requesting CSV output as this is the most efficient
-## way to get the query output which is then converted to a POLARS dataframe.
+## way to get the query output which is then converted to a POLARS dataframe. The label and collection identify
+## the previous runs of the query, see querySchedule.
 
-def execute_query(site_url, site_name, site_query):
-    
-    site_url_sync = site_url + "/sync"
-    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": site_query}
+def execute_query(site_url, site_name, site_query, label, collection):
 
     try:
-        # Make the POST request with a streaming response and a 2 hour timeout
-        with requests.post(site_url_sync, data=data_list, allow_redirects=True, cert=CERT_FILENAME, stream=True, timeout=7200) as response:
-            response.raise_for_status()  # Raise an error for bad status codes
-            # Read the raw CSV response into a Polars DataFrame
-            query_result = pl.read_csv(response.raw)
+        # Run the query with the timeout learned from its previous runs, retrying transient failures
+        query_result, stats, content_encoding = querySchedule.sync_query(site_url, site_query, CERT_FILENAME, label, collection)
+        print(f"Query to {site_name}: time to first byte {stats['ttfb_seconds']:.2f} seconds, {stats['bytes']} bytes ({content_encoding}, {stats['decoded_bytes']} decoded) at {stats['mb_per_second']:.2f} MB/s, {len(query_result)} rows parsed at {stats['rows_per_second']:.0f} rows/s.")
         return query_result
     except requests.exceptions.HTTPError as e:
         print(f"{datetime.now(timezone.utc)} HTTP Error: {e}")
@@ -58,37 +56,27 @@ def execute_query(site_url, site_name, site_query):
 
 ## Query the Storage Inventory service for the specified collection.
 def query_si_service(si_namespace):
-    global SI_QUERY_DURATION
 
     ## Format the query to the inventory.Artifact table and execute it.
-    start_time = datetime.now(timezone.utc)
+    si_query_span = TRACE.span("si_query", si_namespace=si_namespace).start()
     service_query = f"""SELECT uri as uri, contentChecksum as contentCheckSum, contentLength as contentLength, contentType as contentType, contentLastModified as lastModified
         FROM inventory.Artifact AS A
         WHERE uri LIKE '{si_namespace}/%'"""    
-    service_query_result = execute_query(SI_URL, si_namespace, service_query)
+    service_query_result = execute_query(SI_URL, si_namespace, service_query, f"{OUTPUT_FILENAME_ROOT}_si_query", si_namespace)
 
     ## Now sort the result by uri and remove any duplicates by retaining the first instance. Although SI has a unique index on uri, this would protect against any change there.
     service_query_result = service_query_result.sort('uri').unique(subset=['uri'], keep='first')
 
-    end_time = datetime.now(timezone.utc)
-    duration = end_time - start_time
-    SI_QUERY_DURATION += duration.total_seconds()
+    si_query_span.stop()
 
     return service_query_result
 
 ## Query the caom repository service for the specified collection in the specified si_namespace.
 def query_caom_service(collection, si_namespace):
-    global CAOM_QUERY_DURATION
 
     ## First determine which ams_site and ams_url to use for the given collection
-    start_time = datetime.now(timezone.utc)
-    row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-    ams_site = row['ams_site'][0]
-    site_row = SITES_CONFIG.filter(pl.col('site_name') == ams_site)
-    if site_row.is_empty():
-        print(f"Site {ams_site} for collection {collection} not found in sites configuration file.")
-        exit(1)
-    ams_url = site_row['site_url'][0]
+    caom_query_span = TRACE.span("caom_query", collection=collection, si_namespace=si_namespace).start()
+    ams_site, ams_url = caomConfig.ams_site_url(collection)
 
     ## Format the query to the caom2.Artifact table for uris in the given si_namespace and execute it.
     service_query = f"""SELECT A.uri as uri, A.contentChecksum as contentCheckSum, A.contentLength as contentLength, A.contentType as contentType, A.lastModified as lastModified
@@ -97,7 +85,7 @@ def query_caom_service(collection, si_namespace):
         JOIN caom2.Artifact AS A ON A.planeID = P.planeID
         WHERE O.collection = '{collection}'
         and A.uri LIKE '{si_namespace}/%'"""
-    service_query_result = execute_query(ams_url, ams_site, service_query)
+    service_query_result = execute_query(ams_url, ams_site, service_query, f"{OUTPUT_FILENAME_ROOT}_caom_query", collection)
 
     ## Now sort the result by uri and remove any duplicates by retaining the first instance. Some collections such as JWST have multiple entries in CAOM for the same uri.
     service_query_result = service_query_result.sort('uri').unique(subset=['uri'], keep='first')
@@ -105,10 +93,7 @@ def query_caom_service(collection, si_namespace):
     ## Now cast the data type of the contentLength column to Int64 as this is how it is represented in SI. If a collection has only null values for contentLength,
     ## the data type will not be set to Int64 and this will cause problems when comparing the dataframes.
     service_query_result = service_query_result.with_columns(pl.col('contentLength').cast(pl.Int64))
-        
-    end_time = datetime.now(timezone.utc)
-    duration = end_time - start_time
-    CAOM_QUERY_DURATION += duration.total_seconds()
+    caom_query_span.stop()
 
     return service_query_result
 
@@ -126,11 +111,51 @@ def write_files(f, filename, text, files_df):
         
     return
 
+## Return the category and uri of every file in one of the categories.
+
+def category_uris(category_frames):
+    frames = [df.select(['category', 'uri']) for df in category_frames if len(df) > 0]
+    if len(frames) == 0:
+        return pl.DataFrame(schema={"category": pl.String, "uri": pl.String})
+    return pl.concat(frames)
+
+## Save the category uris of this run, sorted so that the file compresses well, replacing those of the previous run.
+
+def write_delta_state(collections, current_df):
+    os.makedirs(DELTA_STATE_DIRECTORY, exist_ok=True)
+    current_df.with_columns(
+        pl.lit(PROCESSING_START_TIME.strftime('%Y-%m-%dT%H:%M:%S')).alias("run_time")
+    ).sort(['category', 'uri']).write_parquet(f"{DELTA_STATE_DIRECTORY}/{collections}.parquet")
+
+## Compare the category uris of this run with those saved by the previous run. Returns the time of the previous run,
+## the new files and the resolved files with their category, uri and whether the file is still in CAOM or SI, or None
+## if there is no previous run. A state saved as hashes by an older version of the script is treated as no previous run.
+
+def compute_delta(collections, current_df, caom_query_result, si_query_result):
+    state_filename = f"{DELTA_STATE_DIRECTORY}/{collections}.parquet"
+    if not os.path.exists(state_filename):
+        return None
+    previous_df = pl.read_parquet(state_filename)
+    if 'uri' not in previous_df.columns:
+        print(f"The delta state in {state_filename} has no uri column, it is replaced by the categories of this run.")
+        return None
+    previous_run_time = previous_df['run_time'][0] if len(previous_df) > 0 else "unknown"
+
+    new_files = current_df.join(previous_df, on=['category', 'uri'], how='anti').select(['category', 'uri'])
+    resolved_files = previous_df.join(current_df, on=['category', 'uri'], how='anti').select(['category', 'uri'])
+    listings = [query_result.select('uri') for query_result in [caom_query_result, si_query_result] if 'uri' in query_result.columns]
+    if len(resolved_files) > 0 and len(listings) > 0:
+        present = pl.concat(listings).join(resolved_files.select('uri'), on='uri', how='semi').unique()
+        resolved_files = resolved_files.with_columns(pl.col('uri').is_in(present['uri']).alias('present'))
+    else:
+        resolved_files = resolved_files.with_columns(pl.lit(False).alias('present'))
+    return previous_run_time, new_files, resolved_files
+
 ## Given the results from CAOM and SI, compare them and write the differences to a CSV file.
 
 def compare_results(collections, si_namespaces, caom_query_result, si_query_result, filename):
 
-    cmp_start_time = datetime.now(timezone.utc)
+    cmp_span = TRACE.span("compare").start()
 
     ## Count the number of uri's that are in both CAOM and SI and have the same contentCheckSum, contentLength and contentType values.
     consistent_files = pl.DataFrame()
@@ -209,8 +234,14 @@ def compare_results(collections, si_namespaces, caom_query_result, si_query_resu
         diff_types = diff_types.with_columns(pl.lit(collections).alias("collection")).select(['collection'] + diff_types.columns)
         diff_types = diff_types.with_columns(pl.lit("DIFF_TYPES").alias("category")).select(['category'] + diff_types.columns)
 
-    cmp_end_time = datetime.now(timezone.utc)
-    cmp_duration = cmp_end_time - cmp_start_time
+    ## Find the files that entered or left each category since the previous run.
+    category_frames = [missing_in_si, missing_in_caom, diff_checksums, diff_lengths, diff_types]
+    current_df = category_uris(category_frames)
+    delta = compute_delta(collections, current_df, caom_query_result, si_query_result) if DELTA_MODE else None
+    if DELTA_MODE and delta is None:
+        print(f"No previous run of {collections} found, writing the full report.")
+
+    cmp_duration = cmp_span.stop()
 
     ## print a summary of the comparison results.
     print(f"Files in CAOM: {len(caom_query_result)}; in SI: {len(si_query_result)}; in CAOM and not in SI: {len(missing_in_si)}; in SI and not in CAOM: {len(missing_in_caom)}; different checksums: {len(diff_checksums)}; different lengths: {len(diff_lengths)}; different types: {len(diff_types)}. Comparison took {cmp_duration.total_seconds():.2f} seconds.")
@@ -219,15 +250,21 @@ def compare_results(collections, si_namespaces, caom_query_result, si_query_resu
     print(f"Writing comparison results to {filename}.")
     try:
         with open(filename, 'w') as f:
-            write_start_time = datetime.now(timezone.utc)
+            write_span = TRACE.span("write").start()
+            caom_throughput = TRACE.throughput('caom_query')
+            si_throughput = TRACE.throughput('si_query')
             f.write(f"Result for collection(s) {collections.replace(MULTI_VALUED_SEPARATOR, " ")}\n")
             f.write(f"\n")
             f.write(f"Start time UTC\t{PROCESSING_START_TIME.strftime('%Y-%m-%dT%H:%M:%S')}\n")
             f.write(f"\n")
-            f.write(f"CAOM collections queried and duration\t{collections.replace(MULTI_VALUED_SEPARATOR, " ")}\t{format_duration_in_seconds(CAOM_QUERY_DURATION)}\n")
-            f.write(f"SI namespaces queried and duration\t{si_namespaces.replace(MULTI_VALUED_SEPARATOR, " ")}\t{format_duration_in_seconds(SI_QUERY_DURATION)}\n")
+            f.write(f"CAOM collections queried and duration\t{collections.replace(MULTI_VALUED_SEPARATOR, " ")}\t{format_duration(TRACE.duration('caom_query'))}\n")
+            f.write(f"SI namespaces queried and duration\t{si_namespaces.replace(MULTI_VALUED_SEPARATOR, " ")}\t{format_duration(TRACE.duration('si_query'))}\n")
             f.write(f"Comparison duration\t{format_duration(cmp_duration)}\n")
             f.write(f"\n")
+            f.write(f"\tTime to first byte in seconds\tBytes downloaded\tBytes decoded\tDownload MB/s\tParse rows/s\n")
+            f.write(f"CAOM queries\t{auditTrace.format_throughput(caom_throughput)}\n")
+            f.write(f"SI queries\t{auditTrace.format_throughput(si_throughput)}\n")
+            f.write(f"\n")
             f.write(f"\tNum files\tSize of data in bytes\n")
             f.write(f"In CAOM\t{len(caom_query_result)}\t{caom_query_result.estimated_size()}\n")
             f.write(f"In SI\t{len(si_query_result)}\t{si_query_result.estimated_size()}\n")
@@ -238,30 +275,62 @@ def compare_results(collections, si_namespaces, caom_query_result, si_query_resu
             f.write(f"Same checksum but different lengths\t{len(diff_lengths)}\t{diff_lengths.estimated_size()}\n")
             f.write(f"Same checksums and lengths but different types\t{len(diff_types)}\t{diff_types.estimated_size()}\n")
             f.flush()
-    
-            ## Write the missing files to the output file.
-            write_files(f, filename, "MISSING_IN_SI", missing_in_si)
-            write_files(f, filename, "MISSING_IN_CAOM", missing_in_caom)
-
-            ## Write the inconsistent files to the output file.
-            write_files(f, filename, "DIFF_CHECKSUMS", diff_checksums)
-            write_files(f, filename, "DIFF_LENGTHS", diff_lengths)
-            write_files(f, filename, "DIFF_TYPES", diff_types)
+
+            if delta is None:
+                ## Write the missing files to the output file.
+                write_files(f, filename, "MISSING_IN_SI", missing_in_si)
+                write_files(f, filename, "MISSING_IN_CAOM", missing_in_caom)
+
+                ## Write the inconsistent files to the output file.
+                write_files(f, filename, "DIFF_CHECKSUMS", diff_checksums)
+                write_files(f, filename, "DIFF_LENGTHS", diff_lengths)
+                write_files(f, filename, "DIFF_TYPES", diff_types)
+            else:
+                ## Write only the files that entered or left each category since the previous run.
+                previous_run_time, new_files, resolved_files = delta
+                f.write(f"\n")
+                f.write(f"Changes since the run of\t{previous_run_time}\n")
+                f.write(f"\tNew files\tResolved files\n")
+                for category in CATEGORIES:
+                    f.write(f"{category}\t{len(new_files.filter(pl.col('category') == category))}\t{len(resolved_files.filter(pl.col('category') == category))}\n")
+                f.write(f"Resolved files no longer in CAOM or SI\t{len(resolved_files.filter(~pl.col('present')))}\n")
+                f.flush()
+                for category, files_df in zip(CATEGORIES, category_frames):
+                    if len(files_df) > 0:
+                        files_df = files_df.join(new_files.filter(pl.col('category') == category).select('uri'), on='uri', how='semi')
+                    write_files(f, filename, f"new {category}", files_df)
+                resolved_files = resolved_files.filter(pl.col('present')).with_columns(
+                    pl.lit(collections).alias("collection"),
+                    ("RESOLVED_" + pl.col('category')).alias("category")
+                ).select(['category', 'collection', 'uri']).sort(['category', 'uri'])
+                write_files(f, filename, "resolved", resolved_files)
+                del new_files, resolved_files
             
             ## Finally, write the summary message
-            write_end_time = datetime.now(timezone.utc)
-            write_duration = write_end_time - write_start_time
+            write_duration = write_span.stop()
             end_time = datetime.now(timezone.utc)
             total_duration = end_time - PROCESSING_START_TIME
             
-            message = f"Category\tCollections\tStart time UTC\tArtifacts in CAOM\tFiles in SI\tConsistent files\tFile in CAOM and not in SI\tFiles in Si and not in CAOM\tFiles with different checksums\tFiles with good checksums but different lengths\tFiles with good checksums and lengths but different types\tDuration of CAOM queries\tduration of SI queries\tDuration processing query results\tDuration writing\tTotal duration\tEnd time UTC"
-            f.write(f"\n{message}\n")
-            message = f"SUMMARY\t{collections}\t{PROCESSING_START_TIME.strftime('%Y-%m-%dT%H:%M:%S')}\t{len(caom_query_result)}\t{len(si_query_result)}\t{num_consistent_files}\t{len(missing_in_si)}\t{len(missing_in_caom)}\t{len(diff_checksums)}\t{len(diff_lengths)}\t{len(diff_types)}\t{format_duration_in_seconds(CAOM_QUERY_DURATION)}\t{format_duration_in_seconds(SI_QUERY_DURATION)}\t{format_duration(cmp_duration)}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+            header = f"Category\tCollections\tStart time UTC\tArtifacts in CAOM\tFiles in SI\tConsistent files\tFile in CAOM and not in SI\tFiles in Si and not in CAOM\tFiles with different checksums\tFiles with good checksums but different lengths\tFiles with good checksums and lengths but different types\tDuration of CAOM queries\tduration of SI queries\tDuration processing query results\tDuration writing\tTotal duration\tEnd time UTC\t{auditTrace.throughput_header('CAOM')}\t{auditTrace.throughput_header('SI')}"
+            f.write(f"\n{header}\n")
+            message = f"SUMMARY\t{collections}\t{PROCESSING_START_TIME.strftime('%Y-%m-%dT%H:%M:%S')}\t{len(caom_query_result)}\t{len(si_query_result)}\t{num_consistent_files}\t{len(missing_in_si)}\t{len(missing_in_caom)}\t{len(diff_checksums)}\t{len(diff_lengths)}\t{len(diff_types)}\t{format_duration(TRACE.duration('caom_query'))}\t{format_duration(TRACE.duration('si_query'))}\t{format_duration(cmp_duration)}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{auditTrace.format_throughput(caom_throughput)}\t{auditTrace.format_throughput(si_throughput)}\n"
             f.write(f"{message}\n")
             f.flush()
             print(message)
 
+            ## Add the SUMMARY line and the category rows to the history store.
+            try:
+                auditHistory.append_report(OUTPUT_FILENAME_ROOT, collections, PROCESSING_START_TIME, header, message,
+                                           category_frames, CATEGORIES)
+            except Exception as e:
+                print(f"Error appending {filename} to the history store: {e}")
+
+            ## Save the categories of this run for the next run in delta mode.
+            write_delta_state(collections, current_df)
+
             ## Explicitly delete the dataframes to free up memory.
+            del current_df
+            del category_frames
             del missing_in_si
             del missing_in_caom
             del diff_checksums
@@ -274,15 +343,17 @@ def compare_results(collections, si_namespaces, caom_query_result, si_query_resu
         print(f"Error writing comparison results to {filename}: {e}")
         exit(1)
 
+    ## Write the trace of the phases next to the report.
+    TRACE.write(filename)
+
     return
         
 ## For each collection/namespace combination, compare the entire list of files in one go.
 
 def process_collections_namespaces(collections, si_namespaces):
-    global CAOM_QUERY_DURATION, SI_QUERY_DURATION, PROCESSING_START_TIME
+    global TRACE, PROCESSING_START_TIME
 
-    CAOM_QUERY_DURATION = 0
-    SI_QUERY_DURATION = 0
+    TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT, collections=collections, si_namespaces=si_namespaces)
     PROCESSING_START_TIME = datetime.now(timezone.utc)
 
     cmp_filename = f"{OUTPUT_FILENAME_ROOT}"
@@ -329,79 +400,30 @@ def process_collections_namespaces(collections, si_namespaces):
     
     return
 
-## Read the configuration files into global dataframes.
- 
-def read_configurations():
-    global MAPPINGS_CONFIG, COLLECTIONS_CONFIG, SITES_CONFIG
-
-    ## Read static configuration files for mapping collections to SI namespaces.
-    ## This file must contain the columns collection, si_namespace.
-    try:
-        MAPPINGS_CONFIG = pl.read_csv("config/caomSiMappings.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading configuration file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping collections to AMS sites.
-    ## This file must contain the columns collection, in_si and ams_site.
-    try:
-        COLLECTIONS_CONFIG = pl.read_csv("config/caomCollections.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading collections file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping AMS sites to URLs.
-    ## This file must contain the columns site_name and site_url.
-    try:
-        SITES_CONFIG = pl.read_csv("config/caomSites.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading sites file: {e}")
-        exit(1)
-    
-    return
-
 ## Prepare a list of collection/si_namespace mappings to be processed. Create a data frame with columns collections and si_namespaces.
-## For a collection that used multiple si namespaces, concatenate the namespace names with a semi-colon.
-## For a si_namespace that is used by multiple collections, concatenate the collection names with a semi-colon.
+## Collections sharing SI namespaces are compared together with all their namespaces: each row is a connected component of the
+## collection/namespace mappings, with the collection names and the namespace names concatenated with underscores.
 def prepare_collection_si_mappings(collection_list):
-    processing_df = pl.DataFrame()
-    for collection in collection_list:
-       
-       ## Find all namespaces for the given collection.
-        mapping_by_collection_rows = MAPPINGS_CONFIG.filter(pl.col('collection') == collection)
-        si_namespace_list = []
-        for mapping_by_collection_row in mapping_by_collection_rows.iter_rows(named=True):
-            si_namespace = mapping_by_collection_row['si_namespace']
-            if si_namespace not in si_namespace_list:
-                si_namespace_list.append(si_namespace)
-        
-            ## Create a list of all collections for the given namespace. Remove collections from the list as they are found to avoid duplicates.
-            mapping_by_namespace_rows = MAPPINGS_CONFIG.filter(pl.col('si_namespace') == si_namespace)
-            collections_to_query_list = []
-            for mapping_by_namespace_row in mapping_by_namespace_rows.iter_rows(named=True):
-                collection_to_query = mapping_by_namespace_row['collection']
-                if collection_to_query not in collections_to_query_list:
-                    collections_to_query_list.append(collection_to_query)
-                if collection_to_query != collection and collection_to_query in collection_list:
-                    collection_list.remove(collection_to_query)
-        
-        collections_to_query = "_".join(collections_to_query_list)
-        si_namespaces = "_".join(si_namespace_list)
-        new_row = pl.DataFrame({"collections": [collections_to_query], "si_namespaces": [si_namespaces]})
-        processing_df = pl.concat([processing_df, new_row])
+    collections_rows = []
+    si_namespaces_rows = []
+    for collections_to_query_list, si_namespace_list in caomConfig.namespace_groups(collection_list):
+        if len(si_namespace_list) == 0:
+            print(f"Collection {collections_to_query_list[0]} has no SI namespace mapping and will be skipped.")
+            continue
+        collections_rows.append(MULTI_VALUED_SEPARATOR.join(collections_to_query_list))
+        si_namespaces_rows.append(MULTI_VALUED_SEPARATOR.join(si_namespace_list))
     
-    return processing_df
+    return pl.DataFrame({"collections": collections_rows, "si_namespaces": si_namespaces_rows}, schema={"collections": pl.String, "si_namespaces": pl.String})
 
 ## If the collection list is empty, read all collections from the collections configuration file that have in_si = "True".
 ## Otherwise, use the collection list provided as arguments to the script and check that they are valid collections.
 def validate_collection_list(collection_list):
     if len(collection_list) == 0:
-        collection_list = COLLECTIONS_CONFIG.filter(pl.col('in_si') == True)['collection'].to_list()
+        collection_list = caomConfig.collection_names(in_si=True)
     else:
         ## Verify the collections provided as arguments to the script are valid.
         for collection in collection_list:
-            row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-            if row.is_empty() or not row['in_si'][0]:
+            if not caomConfig.is_collection(collection, in_si=True):
                 print(f"Collection {collection} not found in collections configuration file.")
                 exit(1)    
     
@@ -434,19 +456,29 @@ if __name__ == "__main__":
 
     ## Check the first argument to determine if help is requested.
     if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
-        print(f"Usage: {os.path.basename(sys.argv[0])} [collection1 collection2 ...]")
+        print(f"Usage: {os.path.basename(sys.argv[0])} [--delta] [collection1 collection2 ...]")
         print(f"       {os.path.basename(sys.argv[0])} <-h || --help>")
+        print(f"With --delta, only the files that entered or left a category since the previous run are listed.")
         exit(0)
 
-    ## Reaed all configuration files into global dataframes.
-    read_configurations()
+    ## Check for the delta option, which may be given before or after the collections.
+    arguments = sys.argv[1:]
+    if "--delta" in arguments:
+        DELTA_MODE = True
+        arguments = [argument for argument in arguments if argument != "--delta"]
+
+    ## Read all configuration files into indexed dictionaries.
+    caomConfig.read_configurations()
 
     ## Create the list of collections to verify, either from the list provided on the command line or from the configuration file.
-    collection_list = validate_collection_list(sys.argv[1:])
+    collection_list = validate_collection_list(arguments)
 
     ## Prepare the list of collection/si_namespace mappings to be processed.
     processing_df = prepare_collection_si_mappings(collection_list)
 
+    ## The history store is kept in the collectionAuditing directory, while the reports are written in the output directory.
+    auditHistory.HISTORY_ROOT = os.path.abspath(auditHistory.HISTORY_ROOT)
+
     ## Creat a subdirectory for the output files if it does not exist.
     try:
         if not os.path.exists(OUTPUT_DIRECTORY):
@@ -1,19 +1,23 @@
 from datetime import datetime, timezone
 from pathlib import Path
-import polars as pl
-import requests
+from lazyImport import lazy_import
+import auditHistory
+import auditTrace
+import caomConfig
+import querySchedule
 import os
 import sys
 
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+requests = lazy_import("requests")
+
 ## Set up variables
 CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
 OUTPUT_DIRECTORY = f"artifactDup_reports"
 OUTPUT_FILENAME_ROOT = "artifactDup"
 SI_URL = "https://ws.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/luskan"
-MAPPINGS_CONFIG = pl.DataFrame()
-COLLECTIONS_CONFIG = pl.DataFrame()
-SITES_CONFIG = pl.DataFrame()
-CAOM_QUERY_DURATION = 0
+TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
 MULTI_VALUED_SEPARATOR = '_'
 PROCESSING_START_TIME = datetime.now(timezone.utc)
 
@@ -26,19 +30,15 @@ def format_duration(duration):
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
 ## Execute the query as a sync call to the site URL, requesting CSV output as this is the most efficient
-## way to get the query output which is then converted to a POLARS dataframe.
+## way to get the query output which is then converted to a POLARS dataframe. The label and collection identify
+## the previous runs of the query, see querySchedule.
 
-def execute_query(site_url, site_name, site_query):
-    
-    site_url_sync = site_url + "/sync"
-    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": site_query}
+def execute_query(site_url, site_name, site_query, label, collection):
 
     try:
-        # Make the POST request with a streaming response and a 2 hour timeout
-        with requests.post(site_url_sync, data=data_list, allow_redirects=True, cert=CERT_FILENAME, stream=True, timeout=7200) as response:
-            response.raise_for_status()  # Raise an error for bad status codes
-            # Read the raw CSV response into a Polars DataFrame
-            query_result = pl.read_csv(response.raw)
+        # Run the query with the timeout learned from its previous runs, retrying transient failures
+        query_result, stats, content_encoding = querySchedule.sync_query(site_url, site_query, CERT_FILENAME, label, collection)
+        print(f"Query to {site_name}: time to first byte {stats['ttfb_seconds']:.2f} seconds, {stats['bytes']} bytes ({content_encoding}, {stats['decoded_bytes']} decoded) at {stats['mb_per_second']:.2f} MB/s, {len(query_result)} rows parsed at {stats['rows_per_second']:.0f} rows/s.")
         return query_result
     except requests.exceptions.HTTPError as e:
         print(f"{datetime.now(timezone.utc)} HTTP Error: {e}")
@@ -49,17 +49,10 @@ def execute_query(site_url, site_name, site_query):
 
 ## Query the caom repository service for the specified collection in the specified si_namespace.
 def query_caom_service(collection, si_namespace):
-    global CAOM_QUERY_DURATION
 
     ## First determine which ams_site and ams_url to use for the given collection
-    start_time = datetime.now(timezone.utc)
-    row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-    ams_site = row['ams_site'][0]
-    site_row = SITES_CONFIG.filter(pl.col('site_name') == ams_site)
-    if site_row.is_empty():
-        print(f"Site {ams_site} for collection {collection} not found in sites configuration file.")
-        exit(1)
-    ams_url = site_row['site_url'][0]
+    caom_query_span = TRACE.span("caom_query", collection=collection, si_namespace=si_namespace).start()
+    ams_site, ams_url = caomConfig.ams_site_url(collection)
 
     ## Format the query to the caom2.Artifact table for uris in the given si_namespace and execute it.
     service_query = f"""SELECT A.uri, 
@@ -85,11 +78,8 @@ def query_caom_service(collection, si_namespace):
         JOIN caom2.Artifact AS A ON A.planeID = P.planeID
         WHERE O.collection = '{collection}'
         and A.uri LIKE '{si_namespace}/%'"""
-    service_query_result = execute_query(ams_url, ams_site, service_query)
-
-    end_time = datetime.now(timezone.utc)
-    duration = end_time - start_time
-    CAOM_QUERY_DURATION += duration.total_seconds()
+    service_query_result = execute_query(ams_url, ams_site, service_query, f"{OUTPUT_FILENAME_ROOT}_caom_query", collection)
+    caom_query_span.stop()
 
     return service_query_result
 
@@ -112,7 +102,7 @@ def write_files(f, filename, text, files_df):
 
 def process_query_results(query_result_df):
 
-    process_start = datetime.now(timezone.utc)
+    process_span = TRACE.span("process").start()
     unique_uri_df = pl.DataFrame()
 
     ## Cast all product type columns to Int64 to ensure proper aggregation.
@@ -147,12 +137,12 @@ def process_query_results(query_result_df):
          pl.col("preview_plot") + pl.col("weight")).alias("count")
     )
 
-    process_end = datetime.now(timezone.utc)
-    process_duration = process_end - process_start
+    process_duration = process_span.stop()
     return unique_uri_df, process_duration
 
 def write_results(collection, si_namespaces, unique_uri_df, start_time, query_duration, processing_duration):
-    write_start = datetime.now(timezone.utc)
+    write_span = TRACE.span("write").start()
+    caom_throughput = TRACE.throughput('caom_query')
     
         ## Count the number of unique uri's with count = 1 and count > 1
     num_uris = sum(unique_uri_df['count'])
@@ -172,6 +162,9 @@ def write_results(collection, si_namespaces, unique_uri_df, start_time, query_du
         f.write(f"AMS query duration\t{format_duration(query_duration)}\n")
         f.write(f"Processing duration\t{format_duration(processing_duration)}\n")
         f.write(f"\n")
+        f.write(f"\tTime to first byte in seconds\tBytes downloaded\tBytes decoded\tDownload MB/s\tParse rows/s\n")
+        f.write(f"AMS queries\t{auditTrace.format_throughput(caom_throughput)}\n")
+        f.write(f"\n")
 
         f.write(f"Total number of artifact URIs\t{num_uris}\n")
         f.write(f"Number of single instance artifact URIs\t{num_unique_uris}\n")
@@ -185,26 +178,34 @@ def write_results(collection, si_namespaces, unique_uri_df, start_time, query_du
             unique_uri_df.filter(pl.col('count') > 1).write_csv(f, include_header=True, separator='\t')
         
         ## Write a summary of the processing.
-        write_end = datetime.now(timezone.utc)
-        write_duration = write_end - write_start
+        write_duration = write_span.stop()
         end_time = datetime.now(timezone.utc)
         total_duration = end_time - start_time 
         f.write(f"\n")
-        message = f"Category\tCollection\tStart time\tNum URIs\tNum unique URIs\tNum duplicate URIs\tNum instances of duplicate URIs\tQuery duration\tProcessing duration\tWrite duration\tDuration\tEnd time"
-        f.write(f"\n{message}\n")
-        message = f"SUMMARY\t{collection}\t{start_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{num_uris}\t{num_unique_uris}\t{num_duplicate_uris}\t{total_instances_duplicates}\t{format_duration(query_duration)}\t{format_duration(processing_duration)}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+        header = f"Category\tCollection\tStart time\tNum URIs\tNum unique URIs\tNum duplicate URIs\tNum instances of duplicate URIs\tQuery duration\tProcessing duration\tWrite duration\tDuration\tEnd time\t{auditTrace.throughput_header('AMS')}"
+        f.write(f"\n{header}\n")
+        message = f"SUMMARY\t{collection}\t{start_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{num_uris}\t{num_unique_uris}\t{num_duplicate_uris}\t{total_instances_duplicates}\t{format_duration(query_duration)}\t{format_duration(processing_duration)}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{auditTrace.format_throughput(caom_throughput)}\n"
         f.write(f"{message}\n")
         f.flush()
         print(message)
+
+        ## Add the SUMMARY line and the duplicate URIs to the history store.
+        try:
+            duplicate_uri_df = unique_uri_df.filter(pl.col('count') > 1).with_columns(pl.lit("DUPLICATE_URI").alias("category"))
+            auditHistory.append_report(OUTPUT_FILENAME_ROOT, collection, start_time, header, message, [duplicate_uri_df], ["DUPLICATE_URI"])
+        except Exception as e:
+            print(f"Error appending {filename} to the history store: {e}")
     except Exception as e:
         print(f"Error opening or writing intro to {filename}: {e}")
+
+    ## Write the trace of the phases next to the report.
+    TRACE.write(filename)
     
     return
         
 ## For each collection/namespace combination, compare the entire list of files in one go.
 
 def query_collection(collection, si_namespaces):
-    query_start = datetime.now(timezone.utc)
     query_results_df = pl.DataFrame()
 
     ## If there are underscores (separators), split namespaces into lists.
@@ -223,72 +224,23 @@ def query_collection(collection, si_namespaces):
             print(f"Error querying CAOM for collection {collection} in namespace {si_namespace}: {e}")
             return   
 
-    query_end = datetime.now(timezone.utc)
-    query_duration = query_end - query_start
-    return query_results_df, query_duration    
-
-## Read the configuration files into global dataframes.
- 
-def read_configurations():
-    global MAPPINGS_CONFIG, COLLECTIONS_CONFIG, SITES_CONFIG
-
-    ## Read static configuration files for mapping collections to SI namespaces.
-    ## This file must contain the columns collection, si_namespace.
-    try:
-        MAPPINGS_CONFIG = pl.read_csv("config/caomSiMappings.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading configuration file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping collections to AMS sites.
-    ## This file must contain the columns collection, in_si and ams_site.
-    try:
-        COLLECTIONS_CONFIG = pl.read_csv("config/caomCollections.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading collections file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping AMS sites to URLs.
-    ## This file must contain the columns site_name and site_url.
-    try:
-        SITES_CONFIG = pl.read_csv("config/caomSites.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading sites file: {e}")
-        exit(1)
-    
-    return
+    return query_results_df, TRACE.duration('caom_query')    
 
 ## Prepare a list of collection/si_namespace mappings to be processed. Create a data frame with columns collection and si_namespaces.
-## For a collection that used multiple si namespaces, concatenate the namespace names with a semi-colon.
+## For a collection that used multiple si namespaces, concatenate the namespace names with an underscore.
 def prepare_collection_si_mappings(collection_list):
-    processing_df = pl.DataFrame()
-    for collection in collection_list:
-       
-       ## Find all namespaces for the given collection.
-        mapping_by_collection_rows = MAPPINGS_CONFIG.filter(pl.col('collection') == collection)
-        si_namespace_list = []
-        for mapping_by_collection_row in mapping_by_collection_rows.iter_rows(named=True):
-            si_namespace = mapping_by_collection_row['si_namespace']
-            if si_namespace not in si_namespace_list:
-                si_namespace_list.append(si_namespace)
-       
-        ## Now create a new row in the processing dataframe for the collection and the list of namespaces.
-        si_namespaces = "_".join(si_namespace_list)
-        new_row = pl.DataFrame({"collection": collection, "si_namespaces": [si_namespaces]})
-        processing_df = pl.concat([processing_df, new_row])
-    
-    return processing_df
+    si_namespaces_rows = ["_".join(caomConfig.si_namespaces(collection)) for collection in collection_list]
+    return pl.DataFrame({"collection": collection_list, "si_namespaces": si_namespaces_rows}, schema={"collection": pl.String, "si_namespaces": pl.String})
 
 ## If the collection list is empty, read all collections from the collections configuration file that have in_si = "True".
 ## Otherwise, use the collection list provided as arguments to the script and check that they are valid collections.
 def validate_collection_list(collection_list):
     if len(collection_list) == 0:
-        collection_list = COLLECTIONS_CONFIG.filter(pl.col('in_si') == True)['collection'].to_list()
+        collection_list = caomConfig.collection_names(in_si=True)
     else:
         ## Verify the collections provided as arguments to the script are valid.
         for collection in collection_list:
-            row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-            if row.is_empty() or not row['in_si'][0]:
+            if not caomConfig.is_collection(collection, in_si=True):
                 print(f"Collection {collection} not found in collections configuration file.")
                 exit(1)    
     
@@ -325,8 +277,8 @@ if __name__ == "__main__":
         print(f"       {os.path.basename(sys.argv[0])} <-h || --help>")
         exit(0)
 
-    ## Reaed all configuration files into global dataframes.
-    read_configurations()
+    ## Read all configuration files into indexed dictionaries.
+    caomConfig.read_configurations()
 
     ## Create the list of collections to verify, either from the list provided on the command line or from the configuration file.
     collection_list = validate_collection_list(sys.argv[1:])
@@ -334,6 +286,9 @@ if __name__ == "__main__":
     ## Prepare the list of collection/si_namespace mappings to be processed.
     processing_df = prepare_collection_si_mappings(collection_list)
 
+    ## The history store is kept in the collectionAuditing directory, while the reports are written in the output directory.
+    auditHistory.HISTORY_ROOT = os.path.abspath(auditHistory.HISTORY_ROOT)
+
     ## Creat a subdirectory for the output files if it does not exist.
     try:
         if not os.path.exists(OUTPUT_DIRECTORY):
@@ -350,6 +305,7 @@ if __name__ == "__main__":
         print(f"Processing collection {collection} with SI namespace(s) {si_namespaces}.")
 
         start_time = datetime.now(timezone.utc)
+        TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT, collection=collection, si_namespaces=si_namespaces)
         query_results_df, query_duration = query_collection(collection, si_namespaces)
         unique_uri_df, processing_duration = process_query_results(query_results_df)
         write_results(collection, si_namespaces, unique_uri_df, start_time, query_duration, processing_duration)
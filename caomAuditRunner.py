@@ -0,0 +1,405 @@
+# This script runs the four collection audits, caomArtifactDiff, caomArtifactDup, caomPreviewDiff and
+# caomTypeProfiles, from a single CAOM download per collection. Each audit queries the same caom2.Observation,
+# caom2.Plane and caom2.Artifact join with different columns, so the union of their columns is queried once with
+# outer joins, keeping the observations without planes and the planes without artifacts, and the frame each audit
+# would have queried is selected from it in memory. The productType of each artifact is downloaded once rather
+# than as the one column per type computed by the queries of the audits. The reports, traces and history store
+# rows are those of the audit scripts, written in their usual output directories. caomArtifactDiff still queries SI,
+# and compares the collections sharing SI namespaces together once all of them have been downloaded.
+# With --jobs, the collections of each AMS site are shared between that number of parallel runs of the script, the
+# largest collections first according to the query durations of previous runs kept by querySchedule.
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from lazyImport import lazy_import
+import caomArtifactDiff
+import caomArtifactDup
+import caomPreviewDiff
+import caomTypeProfiles
+import auditHistory
+import auditTrace
+import caomConfig
+import querySchedule
+import subprocess
+import sys
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
+AUDITS = ["artifactDiff", "artifactDup", "previewDiff", "typeProfiles"]
+MAQ_SITE = "ams_maq"
+QUERY_LABEL = "auditRunner_shared_query"
+TIME_STAMP = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+LOG_DIRECTORY = f"logs/caomAuditRunner-{TIME_STAMP}"
+
+## The collectionAuditing directory, set once the script has changed to it.
+AUDIT_ROOT = None
+
+## The productType of each of the product type columns of the audits.
+PRODUCT_TYPES = {"this": "this", "science": "science", "calibration": "calibration", "preview": "preview", "thumbnail": "thumbnail",
+                 "auxiliary": "auxiliary", "bias": "bias", "coderived": "coderived", "dark": "dark", "documentation": "documentation",
+                 "error": "error", "flat": "flat", "info": "info", "noise": "noise", "preview_image": "preview-image",
+                 "preview_plot": "preview-plot", "weight": "weight"}
+
+## Return the schema of the shared query. The columns are read as text, as the audits report them, except
+## contentLength which caomArtifactDiff compares as an Int64.
+def shared_query_schema():
+    return {
+        "collection": pl.String,
+        "observationID": pl.String,
+        "instrument_name": pl.String,
+        "intent": pl.String,
+        "observationMaxLastModified": pl.String,
+        "planeID": pl.String,
+        "dataProductType": pl.String,
+        "maxLastModified": pl.String,
+        "quality_flag": pl.String,
+        "uri": pl.String,
+        "productType": pl.String,
+        "contentCheckSum": pl.String,
+        "contentLength": pl.Int64,
+        "contentType": pl.String,
+        "lastModified": pl.String
+    }
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {os.path.basename(sys.argv[0])} [--delta] [--audits audit1,audit2,...] [--jobs N] [collection1 collection2 ...]")
+    print(f"       {os.path.basename(sys.argv[0])} <-h || --help>")
+    print(f"The audits are {','.join(AUDITS)}, all of them by default. With --delta, caomArtifactDiff only lists the")
+    print(f"files that entered or left a category since the previous run. With --jobs, N runs of the script share the")
+    print(f"collections of each AMS site, with their output in {LOG_DIRECTORY}.")
+
+## Query the union of the columns used by the audits for one collection. There is one row per artifact, one row
+## with no artifact columns for a plane without artifacts, and one row with no plane or artifact columns for an
+## observation without planes. The query span is recorded in a trace of its own and added to the trace of each audit.
+def query_collection(collection):
+    query_trace = auditTrace.Trace("auditRunner", collection=collection)
+    query_span = query_trace.span("shared_query", collection=collection).start()
+    ams_site, ams_url = caomConfig.ams_site_url(collection)
+
+    shared_query = f"""
+            select O.collection, O.observationID, O.instrument_name, O.intent, O.maxLastModified as observationMaxLastModified,
+                P.planeID, P.dataProductType, P.maxLastModified, P.quality_flag,
+                A.uri, A.productType, A.contentChecksum as contentCheckSum, A.contentLength, A.contentType, A.lastModified
+            from caom2.Observation as O left outer join caom2.Plane as P on O.obsID = P.obsID left outer join caom2.Artifact as A on P.planeID = A.planeID
+            where O.collection = '{collection}'
+        """.replace('\n', ' ')
+    shared_df = caomPreviewDiff.query_ams_service(ams_url, shared_query, shared_query_schema(), QUERY_LABEL, collection)
+    query_span.stop()
+    print(f"Rows for collection {collection}: {len(shared_df)}")
+
+    return shared_df, query_trace.spans[-1]
+
+## Add the shared query span to the trace of an audit under the phase name of the query it replaces.
+def add_query_span(trace, query_record, phase):
+    trace.add({**query_record, "phase": phase})
+
+## Return the product type columns, 1 for the productType of the artifact and null otherwise, as in the queries of the audits.
+def product_type_columns(names):
+    return [pl.when(pl.col("productType") == PRODUCT_TYPES[name]).then(pl.lit(1, dtype=pl.Int64)).alias(name) for name in names]
+
+## Return the artifacts of the planes that are not flagged as junk, which are the rows queried by caomPreviewDiff and
+## caomTypeProfiles.
+def checked_artifacts(shared_df):
+    return shared_df.filter(
+        pl.col("uri").is_not_null() & (pl.col("quality_flag").is_null() | (pl.col("quality_flag") != "junk"))
+    )
+
+## Return the artifacts of a collection in its SI namespaces, as queried by caomArtifactDiff.query_caom_service.
+def artifact_diff_frame(shared_df, si_namespace_list):
+    caom_query_results = pl.DataFrame()
+    for si_namespace in si_namespace_list:
+        query_result = shared_df.filter(pl.col("uri").str.starts_with(f"{si_namespace}/")).select(
+            ["uri", "contentCheckSum", "contentLength", "contentType", "lastModified"]
+        ).sort('uri').unique(subset=['uri'], keep='first')
+        caom_query_results = pl.concat([caom_query_results, query_result])
+    return caom_query_results
+
+## Return the artifacts of a collection in its SI namespaces with their product type columns, as queried by
+## caomArtifactDup.query_caom_service.
+def artifact_dup_frame(shared_df, si_namespace_list):
+    query_results_df = pl.DataFrame()
+    for si_namespace in si_namespace_list:
+        query_result = shared_df.filter(pl.col("uri").str.starts_with(f"{si_namespace}/")).select(
+            [pl.col("uri")] + product_type_columns(PRODUCT_TYPES.keys())
+        )
+        query_results_df = pl.concat([query_results_df, query_result])
+    return query_results_df
+
+## Return the artifacts with the columns queried by caomPreviewDiff.query_collection.
+def preview_diff_frame(shared_df):
+    return checked_artifacts(shared_df).select(
+        ["collection", "observationID", "instrument_name", "intent", "planeID", "dataProductType", "maxLastModified"] +
+        product_type_columns(["preview", "thumbnail", "this", "science", "calibration"])
+    )
+
+## Set the four frames queried by caomTypeProfiles.query_collection.
+def set_type_profiles_frames(shared_df):
+    caomTypeProfiles.NO_PLANES_DF = shared_df.filter(pl.col("planeID").is_null()).select(
+        pl.lit(caomTypeProfiles.NO_PLANE_TEXT).alias("category"), "collection", "observationID",
+        pl.col("observationMaxLastModified").alias("maxLastModified")
+    )
+    print( f"Observations with no planes: {len(caomTypeProfiles.NO_PLANES_DF)}" )
+
+    caomTypeProfiles.NO_ARTIFACTS_DF = shared_df.filter(pl.col("planeID").is_not_null() & pl.col("uri").is_null()).select(
+        pl.lit(caomTypeProfiles.NO_ARTIFACT_TEXT).alias("category"), "collection", "observationID", "planeID", "dataProductType", "maxLastModified"
+    )
+    print( f"Planes with no artifacts: {len(caomTypeProfiles.NO_ARTIFACTS_DF)}" )
+
+    caomTypeProfiles.JUNK_PLANES_DF = shared_df.filter(pl.col("quality_flag") == "junk").unique(subset=["planeID"], keep='first', maintain_order=True).select(
+        pl.lit("JUNK_PLANE").alias("category"), "collection", "observationID", "planeID", "dataProductType", "maxLastModified"
+    )
+    print( f"Junk planes: {len(caomTypeProfiles.JUNK_PLANES_DF)}" )
+
+    caomTypeProfiles.PLANE_ARTIFACT_TYPES_DF = checked_artifacts(shared_df).select(
+        [pl.lit(caomTypeProfiles.TYPE_TEXT).alias("category"), "collection", "instrument_name", "intent", "planeID", "dataProductType"] +
+        product_type_columns(PRODUCT_TYPES.keys())
+    )
+    print( f"Number of artifacts: {len(caomTypeProfiles.PLANE_ARTIFACT_TYPES_DF)}" )
+
+    return
+
+## Run one audit in its output directory. An audit that fails, including one that exits, is reported and the
+## other audits carry on. Returns whether the audit succeeded.
+def run_audit(audit, output_directory, function, *args):
+    try:
+        os.makedirs(output_directory, exist_ok=True)
+        os.chdir(output_directory)
+        function(*args)
+        return True
+    except (Exception, SystemExit) as e:
+        print(f"Error running {audit}: {e!r}")
+        return False
+    finally:
+        os.chdir(AUDIT_ROOT)
+
+## Run caomArtifactDup for one collection from the shared download.
+def audit_artifact_dup(collection, shared_df, query_record, start_time):
+    si_namespace_list = caomConfig.si_namespaces(collection)
+    si_namespaces = caomArtifactDup.MULTI_VALUED_SEPARATOR.join(si_namespace_list)
+    caomArtifactDup.TRACE = auditTrace.Trace(caomArtifactDup.OUTPUT_FILENAME_ROOT, collection=collection, si_namespaces=si_namespaces)
+    add_query_span(caomArtifactDup.TRACE, query_record, "caom_query")
+    query_results_df = artifact_dup_frame(shared_df, si_namespace_list)
+    unique_uri_df, processing_duration = caomArtifactDup.process_query_results(query_results_df)
+    del query_results_df
+    caomArtifactDup.write_results(collection, si_namespaces, unique_uri_df, start_time, caomArtifactDup.TRACE.duration('caom_query'), processing_duration)
+
+## Run caomPreviewDiff for one collection from the shared download.
+def audit_preview_diff(collection, shared_df, query_record, start_time):
+    caomPreviewDiff.TRACE = auditTrace.Trace(caomPreviewDiff.OUTPUT_FILENAME_ROOT, collection=collection)
+    add_query_span(caomPreviewDiff.TRACE, query_record, "ams_query")
+    plane_artifact_type_df = preview_diff_frame(shared_df)
+    caomPreviewDiff.process_query_results(collection, start_time, caomPreviewDiff.TRACE.duration('ams_query'), plane_artifact_type_df)
+
+## Run caomTypeProfiles for one collection from the shared download.
+def audit_type_profiles(collection, shared_df, query_record, start_time):
+    caomTypeProfiles.START_TIME = start_time
+    caomTypeProfiles.TRACE = auditTrace.Trace(caomTypeProfiles.OUTPUT_FILENAME_ROOT, collection=collection)
+    add_query_span(caomTypeProfiles.TRACE, query_record, "ams_query")
+    set_type_profiles_frames(shared_df)
+    caomTypeProfiles.process_query_results()
+    caomTypeProfiles.write_processing_results(collection)
+
+## Run caomArtifactDiff for a group of collections sharing SI namespaces, from their CAOM artifacts and the SI query.
+def audit_artifact_diff(collections, si_namespace_list, caom_query_results):
+    si_namespaces = caomArtifactDiff.MULTI_VALUED_SEPARATOR.join(si_namespace_list)
+    si_query_results = pl.DataFrame()
+    for si_namespace in si_namespace_list:
+        print(f"Querying SI namespace {si_namespace}.")
+        query_result = caomArtifactDiff.query_si_service(si_namespace)
+        si_query_results = pl.concat([si_query_results, query_result])
+
+    cmp_filename = f"{caomArtifactDiff.OUTPUT_FILENAME_ROOT}_{collections}.tsv"
+    print(f"Comparing  collection(s) {collections} and SI namespace(s) {si_namespaces} and writing results to {cmp_filename}.")
+    caomArtifactDiff.compare_results(collections, si_namespaces, caom_query_results, si_query_results, cmp_filename)
+
+## Run the selected audits for the collections, one group of collections sharing SI namespaces at a time so that
+## caomArtifactDiff can compare a group once all its collections have been downloaded. The collections of a group
+## that are not audited are queried for caomArtifactDiff alone. Returns the number of audits that failed.
+def run_audits(collection_list, audits):
+    num_failed = 0
+    for collections_to_query_list, si_namespace_list in caomConfig.namespace_groups(collection_list):
+        diff_group = "artifactDiff" in audits and len(si_namespace_list) > 0 and any(caomConfig.is_collection(collection, in_si=True) for collection in collections_to_query_list)
+        if diff_group:
+            collections = caomArtifactDiff.MULTI_VALUED_SEPARATOR.join(collections_to_query_list)
+            si_namespaces = caomArtifactDiff.MULTI_VALUED_SEPARATOR.join(si_namespace_list)
+            print(f"Collection(s) {collections} uses SI namespace(s): {si_namespaces}.")
+            caomArtifactDiff.TRACE = auditTrace.Trace(caomArtifactDiff.OUTPUT_FILENAME_ROOT, collections=collections, si_namespaces=si_namespaces)
+            caomArtifactDiff.PROCESSING_START_TIME = datetime.now(timezone.utc)
+            caom_query_results = pl.DataFrame()
+
+        for collection in collections_to_query_list:
+            if collection not in collection_list:
+                if diff_group:
+                    for si_namespace in si_namespace_list:
+                        print(f"Querying CAOM for collection {collection} with artifacts like {si_namespace}/%.")
+                        caom_query_results = pl.concat([caom_query_results, caomArtifactDiff.query_caom_service(collection, si_namespace)])
+                continue
+
+            print(f"Processing collection {collection}.")
+            start_time = datetime.now(timezone.utc)
+            shared_df, query_record = query_collection(collection)
+            in_si = caomConfig.is_collection(collection, in_si=True)
+            is_maq = caomConfig.COLLECTIONS[collection]['ams_site'] == MAQ_SITE
+
+            if diff_group:
+                add_query_span(caomArtifactDiff.TRACE, query_record, "caom_query")
+                caom_query_results = pl.concat([caom_query_results, artifact_diff_frame(shared_df, si_namespace_list)])
+            if "artifactDup" in audits and in_si and len(caomConfig.si_namespaces(collection)) > 0:
+                num_failed += not run_audit("caomArtifactDup", caomArtifactDup.OUTPUT_DIRECTORY, audit_artifact_dup, collection, shared_df, query_record, start_time)
+            if "previewDiff" in audits and not is_maq:
+                num_failed += not run_audit("caomPreviewDiff", caomPreviewDiff.OUTPUT_DIRECTORY, audit_preview_diff, collection, shared_df, query_record, start_time)
+            if "typeProfiles" in audits and not is_maq:
+                num_failed += not run_audit("caomTypeProfiles", caomTypeProfiles.OUTPUT_DIRECTORY, audit_type_profiles, collection, shared_df, query_record, start_time)
+
+            ## Explicitly delete the dataframe to free up memory before the next collection.
+            del shared_df
+
+        if diff_group:
+            num_failed += not run_audit("caomArtifactDiff", caomArtifactDiff.OUTPUT_DIRECTORY, audit_artifact_diff, collections, si_namespace_list, caom_query_results)
+            del caom_query_results
+
+    return num_failed
+
+## Share the collections of each AMS site between jobs slots, the largest first. The collections sharing SI namespaces
+## are kept together, on the site of the first of them, as caomArtifactDiff compares them together. Their expected
+## duration is that of their previous shared queries, see querySchedule.expected_duration. Returns the name, the
+## expected duration in seconds and the collections of each slot that has collections.
+def schedule_slots(collection_list, jobs):
+    units_by_site = {}
+    for collections_to_query_list, si_namespace_list in caomConfig.namespace_groups(collection_list):
+        unit = [collection for collection in collections_to_query_list if collection in collection_list]
+        durations = [querySchedule.expected_duration(collection, QUERY_LABEL) for collection in unit]
+        duration = None if None in durations else sum(durations)
+        units_by_site.setdefault(caomConfig.COLLECTIONS[unit[0]]['ams_site'], []).append((unit, duration))
+
+    slots = []
+    for site, units in units_by_site.items():
+        site_slots, loads = querySchedule.lpt_schedule(units, jobs)
+        for slot_number, (site_slot, load) in enumerate(zip(site_slots, loads), start=1):
+            if len(site_slot) > 0:
+                slots.append((f"{site}_{slot_number}", load, [collection for unit in site_slot for collection in unit]))
+    return slots
+
+## Run the script for the collections of one slot as a subprocess, writing its output to the log file of the slot.
+def run_slot(name, collections, options):
+    log_filename = f"{LOG_DIRECTORY}/{name}.log"
+    command = [sys.executable, os.path.abspath(__file__)] + options + collections
+    start_time = datetime.now(timezone.utc)
+    print(f"{start_time.strftime('%Y-%m-%dT%H:%M:%S')} Starting {name} with collections {' '.join(collections)}, log in {log_filename}")
+    with open(log_filename, 'w') as log_file:
+        completed = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT)
+    end_time = datetime.now(timezone.utc)
+    print(f"{end_time.strftime('%Y-%m-%dT%H:%M:%S')} Finished {name} with exit code {completed.returncode} in {caomArtifactDiff.format_duration(end_time - start_time)}")
+    return completed.returncode
+
+## Run the slots in parallel and return the number of slots that failed.
+def run_slots(slots, options):
+    os.makedirs(LOG_DIRECTORY, exist_ok=True)
+    for name, load, collections in slots:
+        print(f"{name}\texpected {caomArtifactDiff.format_duration(timedelta(seconds=load))}\t{' '.join(collections)}")
+    with ThreadPoolExecutor(max_workers=max(1, len(slots))) as executor:
+        exit_codes = list(executor.map(run_slot, [slot[0] for slot in slots], [slot[2] for slot in slots], [options] * len(slots)))
+    return sum(1 for exit_code in exit_codes if exit_code != 0)
+
+## If the collection list is empty, use all the collections in the collections configuration file. Otherwise, check
+## that the collections provided as arguments to the script are valid collections.
+def validate_collection_list(collection_list):
+    if len(collection_list) == 0:
+        collection_list = caomConfig.collection_names()
+    else:
+        ## Verify the collections provided as arguments to the script are valid.
+        for collection in collection_list:
+            if not caomConfig.is_collection(collection):
+                print(f"Collection {collection} not found in collections configuration file.")
+                exit(1)
+
+    print("Collections to be processed: ", end="")
+    print(*collection_list)
+    return collection_list
+
+## Main function to execute the script.
+## It reads the configuration files and runs the selected audits for each collection, from one CAOM query per
+## collection. MAQ collections are only audited by caomArtifactDiff and caomArtifactDup, as in the audit scripts.
+## If the script is give one or more collections, these are the collections to be audited.
+## The script will exit with a status code of 0 if successful, or 1 if an audit failed.
+
+if __name__ == "__main__":
+
+    ## Check if the certificate file exists.
+    if not os.path.exists(CERT_FILENAME):
+        print(f"Certificate file {CERT_FILENAME} does not exist. Please check the path.")
+        exit(1)
+
+    ## Determine where the collectionAuditing directory is located and change to that directory.
+    if os.path.isdir("/Users/gaudet_1/work/collectionAuditing"):
+        os.chdir("/Users/gaudet_1/work/collectionAuditing")
+    elif os.path.isdir("/arc/projects/CADC/collectionAuditing"):
+        os.chdir("/arc/projects/CADC/collectionAuditing")
+    else:
+        print("Unable to determine the location of the collectionAuditing directory.")
+        exit(1)
+    AUDIT_ROOT = os.getcwd()
+
+    ## Check the first argument to determine if help is requested.
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+
+    ## Check for the delta and audits options, which may be given before or after the collections.
+    arguments = sys.argv[1:]
+    if "--delta" in arguments:
+        caomArtifactDiff.DELTA_MODE = True
+        arguments = [argument for argument in arguments if argument != "--delta"]
+    options = ["--delta"] if caomArtifactDiff.DELTA_MODE else []
+    audits = AUDITS
+    if "--audits" in arguments:
+        index = arguments.index("--audits")
+        if index + 1 >= len(arguments):
+            print_usage()
+            exit(1)
+        audits = arguments[index + 1].split(',')
+        arguments = arguments[:index] + arguments[index + 2:]
+        for audit in audits:
+            if audit not in AUDITS:
+                print(f"Unknown audit {audit}, the audits are {','.join(AUDITS)}.")
+                exit(1)
+        options += ["--audits", ",".join(audits)]
+    jobs = 0
+    if "--jobs" in arguments:
+        index = arguments.index("--jobs")
+        if index + 1 >= len(arguments) or not arguments[index + 1].isdigit() or int(arguments[index + 1]) < 1:
+            print_usage()
+            exit(1)
+        jobs = int(arguments[index + 1])
+        arguments = arguments[:index] + arguments[index + 2:]
+
+    ## Read all configuration files into indexed dictionaries.
+    caomConfig.read_configurations()
+
+    ## Create the list of collections to audit, either from the list provided on the command line or from the configuration file.
+    collection_list = validate_collection_list(arguments)
+
+    ## The history store is kept in the collectionAuditing directory, while the reports are written in the output directories.
+    auditHistory.HISTORY_ROOT = os.path.abspath(auditHistory.HISTORY_ROOT)
+
+    ## With --jobs, run the slots of each site in parallel, each running this script for its collections.
+    if jobs > 0:
+        num_failed = run_slots(schedule_slots(collection_list, jobs), options)
+        if num_failed > 0:
+            print(f"All collections processed, {num_failed} runs failed, see {LOG_DIRECTORY}.")
+            exit(1)
+        print("All collections processed.")
+        exit(0)
+
+    num_failed = run_audits(collection_list, audits)
+    if num_failed > 0:
+        print(f"All collections processed, {num_failed} audits failed.")
+        exit(1)
+    print("All collections processed.")
+    exit(0)
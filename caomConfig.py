@@ -0,0 +1,131 @@
+# This module loads the configuration files shared by the caom audit scripts: caomCollections.tsv, caomSites.tsv and
+# caomSiMappings.tsv in the config subdirectory of the collectionAuditing directory. Each file is read once into
+# dictionaries so that looking up the site of a collection or the namespaces of a collection does not scan a
+# DataFrame. The collection to SI namespace mappings form a graph, and the collections and namespaces that share
+# namespaces with each other (its connected components) are queried and compared together by caomArtifactDiff.
+
+from lazyImport import lazy_import
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+COLLECTIONS_FILENAME = "config/caomCollections.tsv"
+SITES_FILENAME = "config/caomSites.tsv"
+MAPPINGS_FILENAME = "config/caomSiMappings.tsv"
+
+## The rows of caomCollections.tsv by collection, in the order of the file.
+COLLECTIONS = {}
+
+## The site_url of each site_name in caomSites.tsv.
+SITES = {}
+
+## The SI namespaces of each collection and the collections of each SI namespace, in the order of caomSiMappings.tsv.
+NAMESPACES_BY_COLLECTION = {}
+COLLECTIONS_BY_NAMESPACE = {}
+
+## The connected components of the mappings as (collections, namespaces) lists, and the component of each collection.
+COMPONENTS = []
+COMPONENT_BY_COLLECTION = {}
+
+## Read a configuration file, exiting if it does not exist.
+def read_tsv(filename, description):
+    try:
+        return pl.read_csv(filename, separator='\t')
+    except FileNotFoundError as e:
+        print(f"Error reading {description} file: {e}")
+        exit(1)
+
+## Read the configuration files into the dictionaries. The mappings are only needed by the scripts comparing CAOM
+## with SI.
+def read_configurations(mappings=True):
+    global COLLECTIONS, SITES
+
+    ## This file must contain the columns collection and ams_site, and the column in_si for the scripts using SI.
+    COLLECTIONS = {row['collection']: row for row in read_tsv(COLLECTIONS_FILENAME, "collections").iter_rows(named=True)}
+
+    ## This file must contain the columns site_name and site_url.
+    SITES = {row['site_name']: row['site_url'] for row in read_tsv(SITES_FILENAME, "sites").iter_rows(named=True)}
+
+    ## This file must contain the columns collection and si_namespace.
+    if mappings:
+        index_mappings(read_tsv(MAPPINGS_FILENAME, "configuration"))
+
+    return
+
+## Build the adjacency lists of the collection to namespace graph and its connected components. The collections and
+## namespaces of a component are kept in the order they first appear in the mappings file.
+def index_mappings(mappings_df):
+    NAMESPACES_BY_COLLECTION.clear()
+    COLLECTIONS_BY_NAMESPACE.clear()
+    COMPONENTS.clear()
+    COMPONENT_BY_COLLECTION.clear()
+
+    for row in mappings_df.iter_rows(named=True):
+        namespaces = NAMESPACES_BY_COLLECTION.setdefault(row['collection'], [])
+        if row['si_namespace'] not in namespaces:
+            namespaces.append(row['si_namespace'])
+        collections = COLLECTIONS_BY_NAMESPACE.setdefault(row['si_namespace'], [])
+        if row['collection'] not in collections:
+            collections.append(row['collection'])
+
+    collection_order = {collection: index for index, collection in enumerate(NAMESPACES_BY_COLLECTION)}
+    namespace_order = {namespace: index for index, namespace in enumerate(COLLECTIONS_BY_NAMESPACE)}
+    for start in NAMESPACES_BY_COLLECTION:
+        if start in COMPONENT_BY_COLLECTION:
+            continue
+        component_collections = {start}
+        component_namespaces = set()
+        pending = [start]
+        while len(pending) > 0:
+            collection = pending.pop()
+            for namespace in NAMESPACES_BY_COLLECTION[collection]:
+                if namespace in component_namespaces:
+                    continue
+                component_namespaces.add(namespace)
+                for other in COLLECTIONS_BY_NAMESPACE[namespace]:
+                    if other not in component_collections:
+                        component_collections.add(other)
+                        pending.append(other)
+        component = (sorted(component_collections, key=collection_order.get), sorted(component_namespaces, key=namespace_order.get))
+        for collection in component_collections:
+            COMPONENT_BY_COLLECTION[collection] = component
+        COMPONENTS.append(component)
+
+    return
+
+## Remove the collections of a site, e.g. the MAQ collections that some scripts do not support.
+def exclude_site(site_name):
+    global COLLECTIONS
+    COLLECTIONS = {collection: row for collection, row in COLLECTIONS.items() if row['ams_site'] != site_name}
+
+## Return the configured collections, optionally only those in SI.
+def collection_names(in_si=False):
+    return [collection for collection, row in COLLECTIONS.items() if not in_si or row['in_si']]
+
+## Return whether a collection is configured, and in SI if in_si is set.
+def is_collection(collection, in_si=False):
+    row = COLLECTIONS.get(collection)
+    return row is not None and (not in_si or bool(row['in_si']))
+
+## Return the ams_site and the URL of the site of a collection, exiting if the site is not configured.
+def ams_site_url(collection):
+    ams_site = COLLECTIONS[collection]['ams_site']
+    if ams_site not in SITES:
+        print(f"Site {ams_site} for collection {collection} not found in sites configuration file.")
+        exit(1)
+    return ams_site, SITES[ams_site]
+
+## Return the SI namespaces of a collection.
+def si_namespaces(collection):
+    return NAMESPACES_BY_COLLECTION.get(collection, [])
+
+## Return the components containing the given collections, once each in the order of the collections, as
+## (collections, namespaces) lists. A collection without mappings is returned alone with no namespaces.
+def namespace_groups(collection_list):
+    groups = []
+    for collection in collection_list:
+        group = COMPONENT_BY_COLLECTION.get(collection, ([collection], []))
+        if group not in groups:
+            groups.append(group)
+    return groups
@@ -1,19 +1,36 @@
 from datetime import datetime, timezone
 from pathlib import Path
-import polars as pl
-import requests
+from lazyImport import lazy_import
+import auditHistory
+import auditTrace
+import caomConfig
+import querySchedule
 import os
 import sys
 
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+requests = lazy_import("requests")
+
 CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
 OUTPUT_DIRECTORY = "previewDiff_reports"
 OUTPUT_FILENAME_ROOT = "previewDiff"
 
-COLLECTIONS_CONFIG = pl.DataFrame()
-SITES_CONFIG = pl.DataFrame()
+TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
+
+## The category rows written to the report of the current collection, added to the history store with its SUMMARY.
+CATEGORY_FRAMES = []
+CATEGORIES = ["CONSISTENT_FOR_BOTH", "INCONSISTENT_FOR_BOTH", "CONSISTENT_FOR_PREVIEW_ONLY", "INCONSISTENT_FOR_PREVIEW_ONLY",
+              "CONSISTENT_FOR_THUMBNAIL_ONLY", "INCONSISTENT_FOR_THUMBNAIL_ONLY", "NEVER_HAD_PREVIEW"]
 
 PROFILE_TEXT = "PROFILE"
 
+## With --memory-limit, a collection whose artifacts are estimated to need more than MEMORY_LIMIT bytes is queried and
+## processed in partitions of instruments. The estimate covers the artifact frame, about 300 bytes per artifact for
+## typical identifiers, and the plane frames and joins of the processing, which at most about triple it.
+MEMORY_LIMIT = None
+ESTIMATED_BYTES_PER_ARTIFACT = 1024
+
 ## Format a duration as HH:MM:SS
 def format_duration(duration):
     total_seconds = int(duration.total_seconds())
@@ -22,17 +39,13 @@ def format_duration(duration):
     seconds = total_seconds % 60
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-## Query the ams repository service for the specified collection.
-def query_ams_service(ams_url, query, schema):
-    ams_url_sync = ams_url + "/sync"
-    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": query}
-
+## Query the ams repository service for the specified collection. The label and collection identify the previous
+## runs of the query, see querySchedule.
+def query_ams_service(ams_url, query, schema, label, collection):
     try:
-        # Make the POST request with a streaming response and a 2 hour timeout
-        with requests.post(ams_url_sync, data=data_list, allow_redirects=True, cert=CERT_FILENAME, stream=True, timeout=7200) as response:
-            response.raise_for_status()  # Raise an error for bad status codes
-            # Read the raw CSV response into a Polars DataFrame
-            query_result = pl.read_csv(response.raw, schema_overrides=schema)
+        # Run the query with the timeout learned from its previous runs, retrying transient failures
+        query_result, stats, content_encoding = querySchedule.sync_query(ams_url, query, CERT_FILENAME, label, collection, schema_overrides=schema)
+        print(f"Query to {ams_url}: time to first byte {stats['ttfb_seconds']:.2f} seconds, {stats['bytes']} bytes ({content_encoding}, {stats['decoded_bytes']} decoded) at {stats['mb_per_second']:.2f} MB/s, {len(query_result)} rows parsed at {stats['rows_per_second']:.0f} rows/s.")
     except requests.exceptions.HTTPError as e:
         print(f"{datetime.now(timezone.utc)} HTTP Error: {e}")
         exit(1)
@@ -42,18 +55,25 @@ def query_ams_service(ams_url, query, schema):
 
     return query_result
 
-def query_collection(collection):
+## Return the ADQL condition selecting the observations of a partition of instruments, where None stands for the
+## observations without an instrument_name.
+def instrument_condition(instrument_names):
+    conditions = []
+    names = [name.replace("'", "''") for name in instrument_names if name is not None]
+    if len(names) > 0:
+        conditions.append("O.instrument_name in (" + ", ".join([f"'{name}'" for name in names]) + ")")
+    if None in instrument_names:
+        conditions.append("O.instrument_name is null")
+    return "(" + " or ".join(conditions) + ")"
 
-    start_time = datetime.now(timezone.utc)
+## Query the artifacts of the collection, or only those of the given instrument names when the collection is processed
+## in partitions.
+def query_collection(collection, instrument_names=None):
+
+    query_span = TRACE.span("ams_query", collection=collection).start()
 
     ## First determine which ams_site and ams_url to use for the given collection
-    row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-    ams_site = row['ams_site'][0]
-    site_row = SITES_CONFIG.filter(pl.col('site_name') == ams_site)
-    if site_row.is_empty():
-        print(f"Site {ams_site} for collection {collection} not found in sites configuration file.")
-        exit(1)
-    ams_url = site_row['site_url'][0]
+    ams_site, ams_url = caomConfig.ams_site_url(collection)
 
     ## Create query string
     plane_artifact_type_query = f"""
@@ -66,6 +86,10 @@ def query_collection(collection):
             from caom2.Observation as O join caom2.Plane as P on O.obsID = P.obsID join caom2.Artifact as A on P.planeID = A.planeID
             where O.collection = '{collection}' and (P.quality_flag is null or P.quality_flag != 'junk')
         """.replace('\n', ' ')
+    label = f"{OUTPUT_FILENAME_ROOT}_ams_query"
+    if instrument_names is not None:
+        plane_artifact_type_query += f" and {instrument_condition(instrument_names)}"
+        label = f"{OUTPUT_FILENAME_ROOT}_partition_query"
     
     ## Define the schema for the dataframe to be returned.
     plane_artifact_type_schema = {
@@ -84,13 +108,66 @@ def query_collection(collection):
     }
 
     ## Query the ams service for the collection.
-    plane_artifact_type_df = query_ams_service(ams_url, plane_artifact_type_query, plane_artifact_type_schema) 
+    plane_artifact_type_df = query_ams_service(ams_url, plane_artifact_type_query, plane_artifact_type_schema, label, collection)
 
-    end_time = datetime.now(timezone.utc)
-    duration = end_time - start_time
+    duration = query_span.stop()
 
     return plane_artifact_type_df, duration
 
+## Count the artifacts of each instrument of the collection that query_collection would return.
+def count_instrument_artifacts(collection):
+
+    with TRACE.span("ams_query", collection=collection, count=True):
+        ams_site, ams_url = caomConfig.ams_site_url(collection)
+        count_query = f"""
+                select O.instrument_name, count(*) as num_artifacts
+                from caom2.Observation as O join caom2.Plane as P on O.obsID = P.obsID join caom2.Artifact as A on P.planeID = A.planeID
+                where O.collection = '{collection}' and (P.quality_flag is null or P.quality_flag != 'junk')
+                group by O.instrument_name
+            """.replace('\n', ' ')
+        counts_df = query_ams_service(ams_url, count_query, {"instrument_name": str, "num_artifacts": pl.Int64}, f"{OUTPUT_FILENAME_ROOT}_count_query", collection)
+
+    return counts_df
+
+## Return the partitions of instrument names in which to process the collection so that the estimated memory of each
+## partition is within MEMORY_LIMIT, or None if the whole collection fits. The instruments are packed into partitions
+## largest first. Profiles never span instruments, so an instrument that does not fit on its own is a partition by
+## itself, with a warning.
+def plan_partitions(collection):
+    counts_df = count_instrument_artifacts(collection).sort("num_artifacts", descending=True)
+    estimated_size = counts_df["num_artifacts"].sum() * ESTIMATED_BYTES_PER_ARTIFACT
+    print(f"Estimated memory for the {counts_df['num_artifacts'].sum()} artifacts of collection {collection}: {estimated_size} bytes, limit {MEMORY_LIMIT} bytes.")
+    if estimated_size <= MEMORY_LIMIT:
+        return None
+
+    partitions = []
+    partition_sizes = []
+    for instrument_name, num_artifacts in counts_df.iter_rows():
+        size = num_artifacts * ESTIMATED_BYTES_PER_ARTIFACT
+        if size > MEMORY_LIMIT:
+            print(f"Warning: instrument {instrument_name} of collection {collection} is estimated to need {size} bytes, more than the limit of {MEMORY_LIMIT} bytes.")
+        for index in range(len(partitions)):
+            if partition_sizes[index] + size <= MEMORY_LIMIT:
+                partitions[index].append(instrument_name)
+                partition_sizes[index] += size
+                break
+        else:
+            partitions.append([instrument_name])
+            partition_sizes.append(size)
+    print(f"Processing collection {collection} in {len(partitions)} partitions of instruments.")
+    return partitions
+
+## Return a memory size given in bytes or with a K, M, G or T suffix, e.g. 16G, or None if it is not valid.
+def parse_size(text):
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().removesuffix("B")
+    multiplier = multipliers.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in multipliers else text
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        return None
+
 def write_intro(f, collection, collection_start_time, query_duration):
     try:
         f.write(f"Query results for collection {collection}\n")
@@ -98,6 +175,9 @@ def write_intro(f, collection, collection_start_time, query_duration):
         f.write(f"Start time\t{collection_start_time.strftime('%Y-%m-%dT%H:%M:%S')} UTC\n")
         f.write(f"AMS query duration\t{format_duration(query_duration)}\n")
         f.write(f"\n")
+        f.write(f"\tTime to first byte in seconds\tBytes downloaded\tBytes decoded\tDownload MB/s\tParse rows/s\n")
+        f.write(f"AMS queries\t{auditTrace.format_throughput(TRACE.throughput('ams_query'))}\n")
+        f.write(f"\n")
     except Exception as e:
         print(f"Error writing intro to output file: {e}")
 
@@ -116,6 +196,7 @@ def write_inconsistent_planes(f, consistent_instrument_intent_dataProductType_df
             if len(inconsistent_planes_df) > 0:
                 inconsistent_planes_df.write_csv(f, include_header=True, separator='\t')
         f.flush()
+        CATEGORY_FRAMES.extend([consistent_instrument_intent_dataProductType_df, inconsistent_planes_df])
     except Exception as e:
         print(f"Error writing results to output file: {e}")
         exit(1)
@@ -127,12 +208,18 @@ def write_summary(f, collection, collection_start_time, num_planes, num_never_ha
                   num_inconsistent_thumbnail_only, query_duration, processing_duration, processing_end_time):
 
     try:
-        message = f"Category\tCollection\tStart time\tNum planes\tNum planes with combination that has never had previews\tNum planes consistent for both preview and thumbnail\tNum planes inconsistent for both preview and thumbnail\t Num planes consistent for preview only\t Num planes inconsistent for preview only\t Num planes consistent for thumbnail only\t Num planes inconsistent for thumbnail only\tQuery duration\tProcessing duration\tEnd time"
-        f.write(f"\n{message}\n")
-        message = f"SUMMARY\t{collection}\t{collection_start_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{num_planes}\t{num_never_had_previews}\t{num_consistent_both}\t{num_inconsistent_both}\t{num_consistent_preview_only}\t{num_inconsistent_preview_only}\t{num_consistent_thumbnail_only}\t{num_inconsistent_thumbnail_only}\t{format_duration(query_duration)}\t{format_duration(processing_duration)}\t{processing_end_time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+        header = f"Category\tCollection\tStart time\tNum planes\tNum planes with combination that has never had previews\tNum planes consistent for both preview and thumbnail\tNum planes inconsistent for both preview and thumbnail\t Num planes consistent for preview only\t Num planes inconsistent for preview only\t Num planes consistent for thumbnail only\t Num planes inconsistent for thumbnail only\tQuery duration\tProcessing duration\tEnd time\t{auditTrace.throughput_header('AMS')}"
+        f.write(f"\n{header}\n")
+        message = f"SUMMARY\t{collection}\t{collection_start_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{num_planes}\t{num_never_had_previews}\t{num_consistent_both}\t{num_inconsistent_both}\t{num_consistent_preview_only}\t{num_inconsistent_preview_only}\t{num_consistent_thumbnail_only}\t{num_inconsistent_thumbnail_only}\t{format_duration(query_duration)}\t{format_duration(processing_duration)}\t{processing_end_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{auditTrace.format_throughput(TRACE.throughput('ams_query'))}\n"
         f.write(f"{message}\n")
         f.flush()
         print(message)
+
+        ## Add the SUMMARY line and the category rows to the history store.
+        try:
+            auditHistory.append_report(OUTPUT_FILENAME_ROOT, collection, collection_start_time, header, message, CATEGORY_FRAMES, CATEGORIES)
+        except Exception as e:
+            print(f"Error appending the report of {collection} to the history store: {e}")
     except Exception as e:
         print(f"Error writing summary to output file: {e}")
 
@@ -209,21 +296,28 @@ def find_inconsistent_planes(planes_df, instrument_intent_dataProductType_df, co
 #    print( f"instrument_intent_dataProductType_df:\n{instrument_intent_dataProductType_df}" )
     return planes_df, consistent_instrument_intent_dataProductType_df, inconsistent_planes_df, instrument_intent_dataProductType_df
 """
-Process a specific preview combination with the provided constraints in querying the planes dataframe.
+Process a specific preview combination with the provided constraints in querying the planes dataframe. Returns the
+consistent profiles and the inconsistent planes of the combination, or None for both if no profiles were left to
+process, along with the remaining planes and profiles.
 """
-def process_preview_combination(f, planes_df, instrument_intent_dataProductType_df, constraint1, constraint2, category_consistent, category_inconsistent):
+def process_preview_combination(planes_df, instrument_intent_dataProductType_df, constraint1, constraint2, category_consistent, category_inconsistent):
 
     if (len(instrument_intent_dataProductType_df ) > 0):
         planes_df, consistent_instrument_intent_dataProductType_df, inconsistent_planes_df, instrument_intent_dataProductType_df = \
                 find_inconsistent_planes(planes_df, instrument_intent_dataProductType_df, constraint1, constraint2, category_consistent, category_inconsistent)
-        write_inconsistent_planes(f, consistent_instrument_intent_dataProductType_df,inconsistent_planes_df, category_consistent, category_inconsistent)
-        num_consistent_planes = consistent_instrument_intent_dataProductType_df['num_planes'].sum()
-        num_inconsistent_planes = len(inconsistent_planes_df)
     else:
-        num_consistent_planes = 0
-        num_inconsistent_planes = 0
+        consistent_instrument_intent_dataProductType_df = None
+        inconsistent_planes_df = None
 
-    return planes_df, num_consistent_planes, num_inconsistent_planes, instrument_intent_dataProductType_df
+    return planes_df, consistent_instrument_intent_dataProductType_df, inconsistent_planes_df, instrument_intent_dataProductType_df
+
+## Return the preview combinations in the order they are processed, as the two constraints and the consistent and
+## inconsistent categories passed to process_preview_combination.
+def preview_combinations():
+    return [((pl.col("preview") == 1) & (pl.col("thumbnail") == 1), (pl.col("preview") == 0) | (pl.col("thumbnail") == 0), "CONSISTENT_FOR_BOTH", "INCONSISTENT_FOR_BOTH"),
+            ((pl.col("preview") == 1), (pl.col("preview") == 0), "CONSISTENT_FOR_PREVIEW_ONLY", "INCONSISTENT_FOR_PREVIEW_ONLY"),
+            ((pl.col("thumbnail") == 1), (pl.col("thumbnail") == 0), "CONSISTENT_FOR_THUMBNAIL_ONLY", "INCONSISTENT_FOR_THUMBNAIL_ONLY"),
+            ((pl.col("preview") == 0) & (pl.col("thumbnail") == 0), (pl.col("preview") == 0) & (pl.col("thumbnail") == 0), "NEVER_HAD_PREVIEW", "")]
 
 """
 Process the query results into lists of inconsistent files. The constraints are:
@@ -233,18 +327,11 @@ Process the query results into lists of inconsistent files. The constraints are:
    instrument, dataProductType that does not have a preview artifact is inconsistent.
 3. For an instrument, dataProductType combination that has only thumbnail artifacts and never both, any plane with a matching
    instrument, dataProductType that does not have a thumbnail artifact is inconsistent.
+Every join is on the instrument_name, so the artifacts of a collection can be processed one group of instruments at a
+time. Returns the number of planes and the results of each preview combination, see process_preview_combination.
 """
-def process_query_results(collection, collection_start_time, query_duration, plane_artifact_type_df):
+def process_partition(plane_artifact_type_df):
 
-    num_consistent_planes_with_both = 0
-    num_inconsistent_planes_with_both = 0
-    num_consistent_planes_with_preview_only = 0
-    num_inconsistent_planes_with_preview_only = 0
-    num_consistent_planes_with_thumbnail_only = 0
-    num_inconsistent_planes_with_thumbnail_only = 0
-    
-    processing_start_time = datetime.now(timezone.utc)
-    
     ## Merge rows by with the same collection, observationID, instrument_name, intent, planeID, dataProductType, maxLastModified and set the auxiliary, calibration, info, noise, preview, science, thumbnail, weight columns to 1 if any one row in the plane is > 0.
     planes_df = plane_artifact_type_df.group_by( ["collection", "observationID", "instrument_name", "intent", "planeID", "dataProductType", "maxLastModified"] ).agg(
         [pl.col("preview").min().alias("preview"),
@@ -275,25 +362,51 @@ def process_query_results(collection, collection_start_time, query_duration, pla
         ).sort( ["collection", "instrument_name", "intent", "dataProductType", "this", "science", "calibration"] 
         ).select( ["collection", "instrument_name", "intent", "dataProductType", "num_planes", "this", "science", "calibration"] )
     
-    #print( f"Number of instrument_name, intent, dataProductType, this, science, calibration combinations: {len(instrument_intent_dataProductType_df)}" )
-    #print( f"instrument_intent_dataProductType_df:\n{instrument_intent_dataProductType_df}" )
-    #print( f"Number of planes with at least a preview or a thumbnail: {instrument_intent_dataProductType_df['num_planes'].sum()}" )
-
-    ## Create a dataframe of unique instrument_name, intent, dataProductType combinations having either a preview or a thumbnail artifact.
-#    instrument_intent_dataProductType_df = planes_df.filter(
-#        (pl.col("preview") == 1) | (pl.col("thumbnail") == 1)
-#        ).group_by( ["collection", "instrument_name", "intent", "dataProductType", "this", "science", "calibration"]
-#        ).agg( pl.len().alias("num_planes")
-#        ).sort( ["collection", "instrument_name", "intent", "dataProductType", "this", "science", "calibration"] 
-#        ).select( ["collection", "instrument_name", "intent", "dataProductType", "num_planes", "this", "science", "calibration"] )
-
-    #print( f"Number of instrument_name, intent, dataProductType, this, science, calibration combinations with at least a preview or a thumbnail: {len(instrument_intent_dataProductType_df)}" )
-    #print( f"instrument_intent_dataProductType_df:\n{instrument_intent_dataProductType_df}" )
-    #print( f"Number of planes with at least a preview or a thumbnail: {instrument_intent_dataProductType_df['num_planes'].sum()}" )
-    
     ## Add a category column at as the first column of the dataframe and set the values of the category column to PROFILE
     category_column = pl.Series("category", ["PROFILE"] * len(instrument_intent_dataProductType_df))
     instrument_intent_dataProductType_df.insert_column(0, category_column)
+
+    ## Process each of the three cases in turn, and then the combinations of instrument_name, intent, dataProductType for which
+    ## no previews or thumbnails have ever existed, updating the instrument_intent_dataProductType_df each time.
+    results = []
+    for constraint1, constraint2, category_consistent, category_inconsistent in preview_combinations():
+        planes_df, consistent_instrument_intent_dataProductType_df, inconsistent_planes_df, instrument_intent_dataProductType_df = \
+            process_preview_combination(planes_df, instrument_intent_dataProductType_df, constraint1, constraint2, category_consistent, category_inconsistent)
+        results.append((consistent_instrument_intent_dataProductType_df, inconsistent_planes_df))
+
+## At this point, all combinations should have been processed and the instrument_intent_dataProductType_df should be empty.
+    if (len(instrument_intent_dataProductType_df ) > 0):
+        print( "Error - instrument_dataProductType should be empty" )
+        print( instrument_intent_dataProductType_df )
+        exit(1)
+
+    return num_planes, results
+
+## Combine the results of the partitions of a collection into the results of the whole collection, sorted as
+## find_inconsistent_planes sorts them. A combination is written to the report if any partition had profiles left
+## to process, as it would have been for the whole collection. Empty frames are left out as their category column
+## has no type.
+def combine_partition_results(partition_results):
+    combined_results = []
+    for index in range(len(preview_combinations())):
+        results = [partition_result[index] for partition_result in partition_results if partition_result[index][0] is not None]
+        if len(results) == 0:
+            combined_results.append((None, None))
+            continue
+        consistent_frames = [result[0] for result in results if len(result[0]) > 0]
+        consistent_instrument_intent_dataProductType_df = pl.concat(consistent_frames).sort(
+            ["collection", "instrument_name", "intent", "dataProductType", "this", "science", "calibration"] ) if len(consistent_frames) > 0 else results[0][0]
+        inconsistent_frames = [result[1] for result in results if len(result[1]) > 0]
+        inconsistent_planes_df = pl.concat(inconsistent_frames).sort(
+            ["collection", "observationID", "instrument_name", "intent", "planeID", "dataProductType"] ) if len(inconsistent_frames) > 0 else pl.DataFrame()
+        combined_results.append((consistent_instrument_intent_dataProductType_df, inconsistent_planes_df))
+    return combined_results
+
+## Write the report of a collection from the results of its partitions.
+def write_results(collection, collection_start_time, query_duration, num_planes, partition_results):
+
+    processing_span = TRACE.span("process").start()
+    CATEGORY_FRAMES.clear()
     
      ## Open output file for writing and write the intro.
     filename = f"{OUTPUT_FILENAME_ROOT}_{collection}.tsv"
@@ -304,53 +417,65 @@ def process_query_results(collection, collection_start_time, query_duration, pla
     except Exception as e:
         print(f"Error opening or writing intro to {filename}: {e}")
 
-    ## Process and output each of the three cases in turn, updating the instrument_intent_dataProductType_df each time.
-    planes_df, num_consistent_planes_with_both, num_inconsistent_planes_with_both, instrument_intent_dataProductType_df = \
-        process_preview_combination(f, planes_df, instrument_intent_dataProductType_df,
-                                    (pl.col("preview") == 1) & (pl.col("thumbnail") == 1),
-                                    (pl.col("preview") == 0) | (pl.col("thumbnail") == 0),
-                                    "CONSISTENT_FOR_BOTH", "INCONSISTENT_FOR_BOTH")
-    planes_df, num_consistent_planes_with_preview_only, num_inconsistent_planes_with_preview_only, instrument_intent_dataProductType_df = \
-        process_preview_combination(f, planes_df, instrument_intent_dataProductType_df,
-                                    (pl.col("preview") == 1),
-                                    (pl.col("preview") == 0),
-                                    "CONSISTENT_FOR_PREVIEW_ONLY", "INCONSISTENT_FOR_PREVIEW_ONLY")
-    planes_df, num_consistent_planes_with_thumbnail_only, num_inconsistent_planes_with_thumbnail_only, instrument_intent_dataProductType_df = \
-        process_preview_combination(f, planes_df, instrument_intent_dataProductType_df,
-                                    (pl.col("thumbnail") == 1),
-                                    (pl.col("thumbnail") == 0),
-                                    "CONSISTENT_FOR_THUMBNAIL_ONLY", "INCONSISTENT_FOR_THUMBNAIL_ONLY")
-    
-    ## Process and output the combinations of instrument_name, intent, dataProductType for which no previews or thumbnails have ever existed.
-    planes_df, num_never_had_preview, num_never_had_preview2, instrument_intent_dataProductType_df = \
-        process_preview_combination(f, planes_df, instrument_intent_dataProductType_df,
-                                    (pl.col("preview") == 0) & (pl.col("thumbnail") == 0),
-                                    (pl.col("preview") == 0) & (pl.col("thumbnail") == 0),
-                                    "NEVER_HAD_PREVIEW", "")
-
-## At this point, all combinations should have been processed and the instrument_intent_dataProductType_df should be empty.
-    if (len(instrument_intent_dataProductType_df ) > 0):
-        print( "Error - instrument_dataProductType should be empty" )
-        print( instrument_intent_dataProductType_df )
-        exit(1)
-
+    ## Output each of the preview combinations in turn, counting the consistent and inconsistent planes.
+    num_consistent_planes = []
+    num_inconsistent_planes = []
+    for (constraint1, constraint2, category_consistent, category_inconsistent), (consistent_instrument_intent_dataProductType_df, inconsistent_planes_df) in \
+            zip(preview_combinations(), combine_partition_results(partition_results)):
+        if consistent_instrument_intent_dataProductType_df is None:
+            num_consistent_planes.append(0)
+            num_inconsistent_planes.append(0)
+            continue
+        write_inconsistent_planes(f, consistent_instrument_intent_dataProductType_df, inconsistent_planes_df, category_consistent, category_inconsistent)
+        num_consistent_planes.append(consistent_instrument_intent_dataProductType_df['num_planes'].sum())
+        num_inconsistent_planes.append(len(inconsistent_planes_df))
+
+    processing_span.stop()
+    processing_duration = TRACE.duration("process")
     processing_end_time = datetime.now(timezone.utc)
-    processing_duration = processing_end_time - processing_start_time 
-    write_summary(f, collection, collection_start_time, num_planes, num_never_had_preview, num_consistent_planes_with_both, num_inconsistent_planes_with_both,
-                  num_consistent_planes_with_preview_only, num_inconsistent_planes_with_preview_only, num_consistent_planes_with_thumbnail_only,
-                  num_inconsistent_planes_with_thumbnail_only, query_duration, processing_duration, processing_end_time)
+    write_summary(f, collection, collection_start_time, num_planes, num_consistent_planes[3], num_consistent_planes[0], num_inconsistent_planes[0],
+                  num_consistent_planes[1], num_inconsistent_planes[1], num_consistent_planes[2],
+                  num_inconsistent_planes[2], query_duration, processing_duration, processing_end_time)
+
+    ## Write the trace of the phases next to the report.
+    TRACE.write(filename)
     return 
 
+## Process the query results of a whole collection and write its report.
+def process_query_results(collection, collection_start_time, query_duration, plane_artifact_type_df):
+    processing_span = TRACE.span("process").start()
+    num_planes, results = process_partition(plane_artifact_type_df)
+    processing_span.stop()
+    write_results(collection, collection_start_time, query_duration, num_planes, [results])
+    return
+
+## Query and process a collection one partition of instruments at a time, keeping only the results of each partition,
+## and write its report.
+def process_partitioned_collection(collection, collection_start_time, partitions):
+    num_planes = 0
+    partition_results = []
+    for index, instrument_names in enumerate(partitions):
+        print(f"Processing partition {index + 1} of {len(partitions)} with {len(instrument_names)} instrument(s).")
+        plane_artifact_type_df, query_duration = query_collection(collection, instrument_names)
+        print(f"Partition {index + 1} takes {plane_artifact_type_df.estimated_size()} bytes for {len(plane_artifact_type_df)} artifacts.")
+        with TRACE.span("process", partition=index + 1):
+            num_partition_planes, results = process_partition(plane_artifact_type_df)
+        del plane_artifact_type_df
+        num_planes += num_partition_planes
+        partition_results.append(results)
+
+    write_results(collection, collection_start_time, TRACE.duration("ams_query"), num_planes, partition_results)
+    return
+
 ## If the collection list is empty, read all collections from the collections configuration file.
 ## Otherwise, use the collection list provided as arguments to the script and check that they are valid collections.
 def validate_collection_list(collection_list):
     if len(collection_list) == 0:
-        collection_list = COLLECTIONS_CONFIG['collection'].to_list()
+        collection_list = caomConfig.collection_names()
     else:
         ## Verify the collections provided as arguments to the script are valid.
         for collection in collection_list:
-            row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-            if row.is_empty() or not row['in_si'][0]:
+            if not caomConfig.is_collection(collection, in_si=True):
                 print(f"Collection {collection} not found in collections configuration file.")
                 exit(1)    
     
@@ -358,28 +483,6 @@ def validate_collection_list(collection_list):
     print(*collection_list)
     return collection_list
 
-## Read the configuration files into global dataframes.
-def read_configurations():
-    global COLLECTIONS_CONFIG, SITES_CONFIG
-
-    ## Read static configuration file for mapping collections to AMS sites.
-    ## This file must contain the columns collection, in_si and ams_site.
-    try:
-        COLLECTIONS_CONFIG = pl.read_csv("config/caomCollections.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading collections file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping AMS sites to URLs.
-    ## This file must contain the columns site_name and site_url.
-    try:
-        SITES_CONFIG = pl.read_csv("config/caomSites.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading sites file: {e}")
-        exit(1)
-    
-    return
-
 ## Main function to execute the script.
 ## It initializes the data structures by reading from the pre-generated list of collections.
 ## It then loops through the list of collections and queries the ams service for each collection.
@@ -404,19 +507,33 @@ if __name__ == "__main__":
 
     ## Check the first argument to determine if help is requested.
     if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
-        print(f"Usage: {os.path.basename(sys.argv[0])} [collection1 collection2 ...]")
+        print(f"Usage: {os.path.basename(sys.argv[0])} [--memory-limit <size>] [collection1 collection2 ...]")
         print(f"       {os.path.basename(sys.argv[0])} <-h || --help>")
+        print(f"With --memory-limit, e.g. 16G, a collection estimated to need more memory is processed in partitions of instruments.")
         exit(0)
 
-    ## Reaed all configuration files into global dataframes.
-    read_configurations()
-
-    ## Remove ams_maq collections from the collections configuration dataframe.
-    COLLECTIONS_CONFIG = COLLECTIONS_CONFIG.filter(pl.col('ams_site') != 'ams_maq')
+    ## Check for the memory limit option, which may be given before or after the collections.
+    arguments = sys.argv[1:]
+    if "--memory-limit" in arguments:
+        index = arguments.index("--memory-limit")
+        MEMORY_LIMIT = parse_size(arguments[index + 1]) if index + 1 < len(arguments) else None
+        if MEMORY_LIMIT is None or MEMORY_LIMIT <= 0:
+            print(f"Usage: {os.path.basename(sys.argv[0])} [--memory-limit <size>] [collection1 collection2 ...]")
+            exit(1)
+        arguments = arguments[:index] + arguments[index + 2:]
+
+    ## Read all configuration files into indexed dictionaries.
+    caomConfig.read_configurations(mappings=False)
+
+    ## Remove ams_maq collections from the collections configuration.
+    caomConfig.exclude_site('ams_maq')
     print(f"Warning: MAQ collections are not supported and will be skipped.")
 
     ## Create the list of collections to verify, either from the list provided on the command line or from the configuration file.
-    collection_list = validate_collection_list(sys.argv[1:])
+    collection_list = validate_collection_list(arguments)
+
+    ## The history store is kept in the collectionAuditing directory, while the reports are written in the output directory.
+    auditHistory.HISTORY_ROOT = os.path.abspath(auditHistory.HISTORY_ROOT)
 
     ## Creat a subdirectory for the output files if it does not exist.
     try:
@@ -431,8 +548,13 @@ if __name__ == "__main__":
     for collection in collection_list:
         print(f"Processing collection {collection}.")
         collection_start_time = datetime.now(timezone.utc)
+        TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT, collection=collection)
+        partitions = plan_partitions(collection) if MEMORY_LIMIT is not None else None
+        if partitions is not None:
+            process_partitioned_collection(collection, collection_start_time, partitions)
+            continue
         plane_artifact_type_df, query_duration = query_collection(collection)
-        process_query_results(collection, collection_start_time, query_duration, plane_artifact_type_df)
+        process_query_results(collection, collection_start_time, TRACE.duration("ams_query"), plane_artifact_type_df)
         
         ## Explicitly delete the dataframe to free up memory if running through a list of collections.
         del plane_artifact_type_df
@@ -1,26 +1,31 @@
 from datetime import datetime, timezone
 from pathlib import Path
-import polars as pl
-import requests
+from lazyImport import lazy_import
+import auditHistory
+import auditTrace
+import caomConfig
+import querySchedule
 import os
 import sys
 
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+requests = lazy_import("requests")
+
 CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
 OUTPUT_DIRECTORY = "typeProfiles_reports"
 OUTPUT_FILENAME_ROOT = "typeProfiles"
-QUERY_DURATION = 0
-PROCESS_RESULTS_DURATION = 0
+TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
 START_TIME = datetime.now(timezone.utc)
 
-COLLECTIONS_CONFIG = pl.DataFrame()
-SITES_CONFIG = pl.DataFrame()
 
-PLANE_ARTIFACT_TYPES_DF = pl.DataFrame()
-DISTINCT_PLANE_ARTIFACT_TYPES_DF = pl.DataFrame()
-ALL_TYPES_DF = pl.DataFrame()
-NO_PLANES_DF = pl.DataFrame()
-NO_ARTIFACTS_DF = pl.DataFrame()
-JUNK_PLANES_DF = pl.DataFrame()
+## The query and processing results of the current collection, set by query_collection and process_query_results.
+PLANE_ARTIFACT_TYPES_DF = None
+DISTINCT_PLANE_ARTIFACT_TYPES_DF = None
+ALL_TYPES_DF = None
+NO_PLANES_DF = None
+NO_ARTIFACTS_DF = None
+JUNK_PLANES_DF = None
 
 NO_PLANE_TEXT = "NO_PLANES"
 NO_ARTIFACT_TEXT = "NO_ARTIFACTS"
@@ -34,17 +39,13 @@ def format_duration(duration):
     seconds = total_seconds % 60
     return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-## Query the ams repository service for the specified collection.
-def query_ams_service(ams_url, query):
-    ams_url_sync = ams_url + "/sync"
-    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": query}
-
+## Query the ams repository service for the specified collection. The label and collection identify the previous
+## runs of the query, see querySchedule.
+def query_ams_service(ams_url, query, label, collection):
     try:
-        # Make the POST request with a streaming response and a 2 hour timeout
-        with requests.post(ams_url_sync, data=data_list, allow_redirects=True, cert=CERT_FILENAME, stream=True, timeout=7200) as response:
-            response.raise_for_status()  # Raise an error for bad status codes
-            # Read the raw CSV response into a Polars DataFrame
-            query_result = pl.read_csv(response.raw)
+        # Run the query with the timeout learned from its previous runs, retrying transient failures
+        query_result, stats, content_encoding = querySchedule.sync_query(ams_url, query, CERT_FILENAME, label, collection)
+        print(f"Query to {ams_url}: time to first byte {stats['ttfb_seconds']:.2f} seconds, {stats['bytes']} bytes ({content_encoding}, {stats['decoded_bytes']} decoded) at {stats['mb_per_second']:.2f} MB/s, {len(query_result)} rows parsed at {stats['rows_per_second']:.0f} rows/s.")
     except requests.exceptions.HTTPError as e:
         print(f"{datetime.now(timezone.utc)} HTTP Error: {e}")
         exit(1)
@@ -55,28 +56,21 @@ def query_ams_service(ams_url, query):
     return query_result
 
 def query_collection(collection):
-    global QUERY_DURATION
     global PLANE_ARTIFACT_TYPES_DF
     global NO_ARTIFACTS_DF
     global NO_PLANES_DF
     global JUNK_PLANES_DF
 
     ## First determine which ams_site and ams_url to use for the given collection
-    start_time = datetime.now(timezone.utc)
-    row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-    ams_site = row['ams_site'][0]
-    site_row = SITES_CONFIG.filter(pl.col('site_name') == ams_site)
-    if site_row.is_empty():
-        print(f"Site {ams_site} for collection {collection} not found in sites configuration file.")
-        exit(1)
-    ams_url = site_row['site_url'][0]
+    query_span = TRACE.span("ams_query", collection=collection).start()
+    ams_site, ams_url = caomConfig.ams_site_url(collection)
 
     query_no_planes = f"""
             select '{NO_PLANE_TEXT}' as category, collection, O.observationID, O.maxLastModified 
             from caom2.Observation as O left outer join caom2.Plane as P on O.obsID = P.obsID
             where O.collection = '{collection}' and P.planeID is null
         """.replace('\n', ' ')
-    NO_PLANES_DF = query_ams_service(ams_url, query_no_planes)
+    NO_PLANES_DF = query_ams_service(ams_url, query_no_planes, f"{OUTPUT_FILENAME_ROOT}_{NO_PLANE_TEXT}", collection)
     print( f"Observations with no planes: {len(NO_PLANES_DF)}" )
 
     query_no_artifacts = f"""
@@ -84,7 +78,7 @@ def query_collection(collection):
             from caom2.Observation as O join caom2.Plane as P on O.obsID = P.obsID left outer join caom2.Artifact as A on P.planeID = A.planeID
             where O.collection = '{collection}' and A.artifactID is null
         """.replace('\n', ' ')
-    NO_ARTIFACTS_DF = query_ams_service(ams_url, query_no_artifacts)
+    NO_ARTIFACTS_DF = query_ams_service(ams_url, query_no_artifacts, f"{OUTPUT_FILENAME_ROOT}_{NO_ARTIFACT_TEXT}", collection)
     print( f"Planes with no artifacts: {len(NO_ARTIFACTS_DF)}" )
 
     query_junk_planes = f"""
@@ -92,7 +86,7 @@ def query_collection(collection):
             from caom2.Observation as O join caom2.Plane as P on O.obsID = P.obsID
             where O.collection = '{collection}' and P.quality_flag = 'junk'
         """.replace('\n', ' ')
-    JUNK_PLANES_DF = query_ams_service(ams_url, query_junk_planes)
+    JUNK_PLANES_DF = query_ams_service(ams_url, query_junk_planes, f"{OUTPUT_FILENAME_ROOT}_JUNK_PLANE", collection)
     print( f"Junk planes: {len(JUNK_PLANES_DF)}" )
 
     query_plane_artifact_types = f"""
@@ -117,12 +111,11 @@ def query_collection(collection):
             from caom2.Observation as O join caom2.Plane as P on O.obsID = P.obsID join caom2.Artifact as A on P.planeID = A.planeID
             where O.collection = '{collection}' and (P.quality_flag is null or P.quality_flag != 'junk')
         """.replace('\n', ' ')
-    PLANE_ARTIFACT_TYPES_DF = query_ams_service(ams_url, query_plane_artifact_types)
+    PLANE_ARTIFACT_TYPES_DF = query_ams_service(ams_url, query_plane_artifact_types, f"{OUTPUT_FILENAME_ROOT}_{TYPE_TEXT}", collection)
     
     print( f"Number of artifacts: {len(PLANE_ARTIFACT_TYPES_DF)}" )
 
-    end_time = datetime.now(timezone.utc)
-    QUERY_DURATION = end_time - start_time
+    query_span.stop()
 
     return
 
@@ -187,12 +180,16 @@ def write_processing_results(collection):
     print(f"Writing query results to {filename}.")
     try:
         with open(filename, 'w') as f:
-            write_start_time = datetime.now(timezone.utc)
+            write_span = TRACE.span("write").start()
+            ams_throughput = TRACE.throughput('ams_query')
             f.write(f"Query results for collection {collection}\n")
             f.write(f"\n")
             f.write(f"Start time\t{START_TIME.strftime('%Y-%m-%dT%H:%M:%S')} UTC\n")
-            f.write(f"AMS query duration\t{format_duration(QUERY_DURATION)}\n")
-            f.write(f"Process results duration\t{format_duration(PROCESS_RESULTS_DURATION)}\n")
+            f.write(f"AMS query duration\t{format_duration(TRACE.duration('ams_query'))}\n")
+            f.write(f"Process results duration\t{format_duration(TRACE.duration('process'))}\n")
+            f.write(f"\n")
+            f.write(f"\tTime to first byte in seconds\tBytes downloaded\tBytes decoded\tDownload MB/s\tParse rows/s\n")
+            f.write(f"AMS queries\t{auditTrace.format_throughput(ams_throughput)}\n")
             f.write(f"\n")
 
             f.write(f"Observations with no associated planes\t{len(NO_PLANES_DF)}\n")
@@ -207,18 +204,24 @@ def write_processing_results(collection):
             write_tsv( f, filename, TYPE_TEXT, ALL_TYPES_DF )
 
             ## Finally, write the summary message
-            write_end_time = datetime.now(timezone.utc)
-            write_duration = write_end_time - write_start_time
+            write_duration = write_span.stop()
             end_time = datetime.now(timezone.utc)
             total_duration = end_time - START_TIME
             
-            message = f"Category\tCollection\tStart time\tObservations with no planes\tPlanes with no artifacts\tJunk planes\tPlanes to by checked\tArtifacts to be checked\tNum profile combinations\tQuery duration\tProcessing results duration\tWrite duration\tTotal duration\tEnd time"
-            f.write(f"\n{message}\n")
-            message = f"SUMMARY\t{collection}\t{START_TIME.strftime('%Y-%m-%dT%H:%M:%S')}\t{len(NO_PLANES_DF)}\t{len(NO_ARTIFACTS_DF)}\t{len(JUNK_PLANES_DF)}\t{len(DISTINCT_PLANE_ARTIFACT_TYPES_DF)}\t{len(PLANE_ARTIFACT_TYPES_DF)}\t{len(ALL_TYPES_DF)}\t{format_duration(QUERY_DURATION)}\t{format_duration(PROCESS_RESULTS_DURATION)}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+            header = f"Category\tCollection\tStart time\tObservations with no planes\tPlanes with no artifacts\tJunk planes\tPlanes to by checked\tArtifacts to be checked\tNum profile combinations\tQuery duration\tProcessing results duration\tWrite duration\tTotal duration\tEnd time\t{auditTrace.throughput_header('AMS')}"
+            f.write(f"\n{header}\n")
+            message = f"SUMMARY\t{collection}\t{START_TIME.strftime('%Y-%m-%dT%H:%M:%S')}\t{len(NO_PLANES_DF)}\t{len(NO_ARTIFACTS_DF)}\t{len(JUNK_PLANES_DF)}\t{len(DISTINCT_PLANE_ARTIFACT_TYPES_DF)}\t{len(PLANE_ARTIFACT_TYPES_DF)}\t{len(ALL_TYPES_DF)}\t{format_duration(TRACE.duration('ams_query'))}\t{format_duration(TRACE.duration('process'))}\t{format_duration(write_duration)}\t{format_duration(total_duration)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{auditTrace.format_throughput(ams_throughput)}\n"
             f.write(f"{message}\n")
             f.flush()
             print(message)
 
+            ## Add the SUMMARY line and the category rows to the history store.
+            try:
+                auditHistory.append_report(OUTPUT_FILENAME_ROOT, collection, START_TIME, header, message,
+                                           [NO_PLANES_DF, NO_ARTIFACTS_DF, ALL_TYPES_DF], [NO_PLANE_TEXT, NO_ARTIFACT_TEXT, TYPE_TEXT])
+            except Exception as e:
+                print(f"Error appending {filename} to the history store: {e}")
+
             ## Explicitly delete the dataframes to free up memory.
             del PLANE_ARTIFACT_TYPES_DF
             del DISTINCT_PLANE_ARTIFACT_TYPES_DF
@@ -229,14 +232,17 @@ def write_processing_results(collection):
     except Exception as e:
         print(f"Error writing query results to {filename}: {e}")
         exit(1)
+
+    ## Write the trace of the phases next to the report.
+    TRACE.write(filename)
     
     return
 
 ## Process the query results to create the type profile of the collection.
 def process_query_results():
-    global PLANE_ARTIFACT_TYPES_DF, ALL_TYPES_DF, DISTINCT_PLANE_ARTIFACT_TYPES_DF, PROCESS_RESULTS_DURATION
+    global PLANE_ARTIFACT_TYPES_DF, ALL_TYPES_DF, DISTINCT_PLANE_ARTIFACT_TYPES_DF
 
-    start_time = datetime.now(timezone.utc)
+    process_span = TRACE.span("process").start()
 
     ## Cast the productType columns to Int64 to allow aggregation
     PLANE_ARTIFACT_TYPES_DF = PLANE_ARTIFACT_TYPES_DF.with_columns(
@@ -297,8 +303,7 @@ def process_query_results():
     ])
     print( f"Number of distinct combinations of plane and artifact types: {len(ALL_TYPES_DF)}" )
 
-    end_time = datetime.now(timezone.utc)
-    PROCESS_RESULTS_DURATION = end_time - start_time
+    process_span.stop()
 
     return
 
@@ -307,12 +312,11 @@ def process_query_results():
 ## Otherwise, use the collection list provided as arguments to the script and check that they are valid collections.
 def validate_collection_list(collection_list):
     if len(collection_list) == 0:
-        collection_list = COLLECTIONS_CONFIG['collection'].to_list()
+        collection_list = caomConfig.collection_names()
     else:
         ## Verify the collections provided as arguments to the script are valid.
         for collection in collection_list:
-            row = COLLECTIONS_CONFIG.filter(pl.col('collection') == collection)
-            if row.is_empty():
+            if not caomConfig.is_collection(collection):
                 print(f"Collection {collection} not found in collections configuration file.")
                 exit(1)    
     
@@ -321,28 +325,6 @@ def validate_collection_list(collection_list):
 
     return collection_list
 
-## Read the configuration files into global dataframes.
-def read_configurations():
-    global COLLECTIONS_CONFIG, SITES_CONFIG
-
-    ## Read static configuration file for mapping collections to AMS sites.
-    ## This file must contain the columns collection and ams_site.
-    try:
-        COLLECTIONS_CONFIG = pl.read_csv("config/caomCollections.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading collections file: {e}")
-        exit(1)
-
-    ## Read static configuration file for mapping AMS sites to URLs.
-    ## This file must contain the columns site_name and site_url.
-    try:
-        SITES_CONFIG = pl.read_csv("config/caomSites.tsv", separator='\t')
-    except FileNotFoundError as e:
-        print(f"Error reading sites file: {e}")
-        exit(1)
-    
-    return
-
 ## Main function to execute the script.
 ## It initializes the data structures by reading from the pre-generated list of collections.
 ## It then loops through the list of collections and queries the ams service for each collection.
@@ -371,17 +353,20 @@ if __name__ == "__main__":
         print(f"       {os.path.basename(sys.argv[0])} <-h || --help>")
         exit(0)
 
-    ## Read all configuration files into global dataframes.
-    read_configurations()
+    ## Read all configuration files into indexed dictionaries.
+    caomConfig.read_configurations(mappings=False)
 
-    ## Remove ams_maq collections from the collections configuration dataframe.
-    COLLECTIONS_CONFIG = COLLECTIONS_CONFIG.filter(pl.col('ams_site') != 'ams_maq')
+    ## Remove ams_maq collections from the collections configuration.
+    caomConfig.exclude_site('ams_maq')
     print(f"Warning: MAQ collections are not supported and will be skipped.")
 
     ## Create the list of collections to verify, either from the list provided on the command line or from the configuration file.
     ## MAQ collections are not supported.
     collection_list = validate_collection_list(sys.argv[1:])
 
+    ## The history store is kept in the collectionAuditing directory, while the reports are written in the output directory.
+    auditHistory.HISTORY_ROOT = os.path.abspath(auditHistory.HISTORY_ROOT)
+
     ## Creat a subdirectory for the output files if it does not exist.
     try:
         if not os.path.exists(OUTPUT_DIRECTORY):
@@ -395,6 +380,7 @@ if __name__ == "__main__":
     for collection in collection_list:
         print(f"Processing collection {collection}.")
         START_TIME = datetime.now(timezone.utc)
+        TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT, collection=collection)
         query_collection(collection)
         process_query_results()
         write_processing_results(collection)
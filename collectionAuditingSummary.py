@@ -0,0 +1,150 @@
+# This script generates a summary of one of the reports subdirectories in the top-level collectionAuditing directory.
+# Each report ends with a Category header line followed by its SUMMARY line. Only the end of each report is read,
+# searching backwards for these two lines, and the reports are read in parallel. The summary is written both as a
+# TSV file and as a Parquet table.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from lazyImport import lazy_import
+import sys
+import os
+import io
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+MAX_WORKERS = 16
+TAIL_BLOCK_SIZE = 8192
+MAX_TAIL_SIZE = 1024 * 1024
+SUMMARY_CATEGORY = "SUMMARY"
+HEADER_CATEGORY = "Category"
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {os.path.basename(sys.argv[0])} <reports_subdirectory>")
+    print(f"Example: {os.path.basename(sys.argv[0])} typeProfiles_reports")
+
+## Read the end of a report, doubling the amount read until it holds the header and SUMMARY lines or MAX_TAIL_SIZE
+## has been read. Returns the header and SUMMARY lines, or None and the reason the report is not valid.
+def read_summary(filename):
+    try:
+        with open(filename, 'rb') as f:
+            file_size = f.seek(0, os.SEEK_END)
+            tail_size = TAIL_BLOCK_SIZE
+            while True:
+                offset = max(0, file_size - tail_size)
+                f.seek(offset)
+                lines = f.read(file_size - offset).decode('utf-8', errors='replace').split('\n')
+
+                ## The first line is only complete if the start of the file was reached.
+                if offset > 0:
+                    lines = lines[1:]
+                for index in range(len(lines) - 1, 0, -1):
+                    if lines[index].startswith(f"{SUMMARY_CATEGORY}\t"):
+                        header = lines[index - 1]
+                        if not header.startswith(f"{HEADER_CATEGORY}\t"):
+                            return None, f"SUMMARY line is not preceded by a {HEADER_CATEGORY} header line"
+                        summary = lines[index]
+                        num_header_columns = len(header.split('\t'))
+                        num_summary_columns = len(summary.split('\t'))
+                        if num_header_columns != num_summary_columns:
+                            return None, f"header has {num_header_columns} columns but the SUMMARY line has {num_summary_columns}"
+                        return (header, summary), None
+
+                if offset == 0:
+                    return None, "no SUMMARY line found"
+                if tail_size >= MAX_TAIL_SIZE:
+                    return None, f"no SUMMARY line found in the last {MAX_TAIL_SIZE} bytes"
+                tail_size *= 2
+    except Exception as e:
+        return None, f"error reading report: {e}"
+
+## Read the summaries of all the reports in parallel and return the distinct SUMMARY lines grouped by header.
+## Reports written by different versions of a script can have different headers.
+def read_summaries(filenames):
+    summaries = {}
+    num_invalid = 0
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for filename, (result, error) in zip(filenames, executor.map(read_summary, filenames)):
+            if result is None:
+                print(f"Skipping {filename}: {error}")
+                num_invalid += 1
+                continue
+            header, summary = result
+            summaries.setdefault(header, set()).add(summary)
+    return summaries, num_invalid
+
+## Combine the summaries into one DataFrame of text values, so that the TSV file holds the values exactly as they
+## are written in the reports. The columns of all headers are kept, with empty values for reports whose header does
+## not have a column.
+def combine_summaries(summaries):
+    frames = []
+    for header, lines in summaries.items():
+        text = header + '\n' + '\n'.join(sorted(lines)) + '\n'
+        frames.append(pl.read_csv(io.StringIO(text), separator='\t', infer_schema=False, quote_char=None))
+    combined = pl.concat(frames, how="diagonal")
+    return combined.sort(combined.columns[:3])
+
+## Return the combined summaries with the column types inferred from all the values, for the Parquet table.
+def infer_types(combined):
+    buffer = io.StringIO()
+    combined.write_csv(buffer, separator='\t', quote_style='never')
+    buffer.seek(0)
+    return pl.read_csv(buffer, separator='\t', infer_schema_length=None, quote_char=None)
+
+## Main function to execute the script.
+## It reads the SUMMARY line of each .tsv report in the given reports subdirectory and writes them to the
+## <name>_summary.tsv and <name>_summary.parquet files, where <name> is the subdirectory without its _reports suffix.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
+
+if __name__ == "__main__":
+
+    ## Determine where the collectionAuditing directory is located and change to that directory.
+    if os.path.isdir(f"{Path.home()}/work/collectionAuditing"):
+        os.chdir(f"{Path.home()}/work/collectionAuditing")
+    elif os.path.isdir("/arc/projects/CADC/collectionAuditing"):
+        os.chdir("/arc/projects/CADC/collectionAuditing")
+    else:
+        print("Unable to determine the location of the collectionAuditing directory.")
+        exit(1)
+
+    ## Check that one and only one subdirectory is provided on the command line.
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+    if len(sys.argv) != 2:
+        print_usage()
+        exit(1)
+
+    ## Check that the provided subdirectory exists and is not empty, and strip off any trailing slash.
+    reports_subdir = sys.argv[1].rstrip('/')
+    if not os.path.isdir(reports_subdir):
+        print(f"The specified subdirectory '{reports_subdir}' does not exist.")
+        exit(1)
+    filenames = sorted([str(path) for path in Path(reports_subdir).glob("*.tsv")])
+    if len(filenames) == 0:
+        print(f"The specified subdirectory '{reports_subdir}' is not readable or has no reports.")
+        exit(1)
+
+    ## Create the summary filenames based on the reports subdirectory name, stripping off the "_reports" suffix.
+    summary_root = f"{reports_subdir.replace('_reports', '')}_summary"
+    print(f"Generating summary files: {summary_root}.tsv and {summary_root}.parquet")
+
+    summaries, num_invalid = read_summaries(filenames)
+    if len(summaries) == 0:
+        print(f"No valid reports found in {reports_subdir}.")
+        exit(1)
+    if len(summaries) > 1:
+        print(f"Warning: the reports have {len(summaries)} different headers, the summary has the columns of all of them.")
+
+    summary_df = combine_summaries(summaries)
+    try:
+        summary_df.write_csv(f"{summary_root}.tsv", separator='\t', quote_style='never')
+        infer_types(summary_df).write_parquet(f"{summary_root}.parquet")
+    except Exception as e:
+        print(f"Error writing summary files {summary_root}: {e}")
+        exit(1)
+
+    print(f"Wrote {len(summary_df)} distinct SUMMARY lines from {len(filenames) - num_invalid} reports, {num_invalid} reports skipped.")
+    exit(0)
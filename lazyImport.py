@@ -0,0 +1,29 @@
+# This module defers loading the heavy packages used by the scripts (polars, pandas, numpy, requests) until one of
+# their attributes is first used, so that --help, usage errors and configuration checks do not pay for importing
+# them. astroquery, the slowest of all because it loads astropy, is instead imported inside the functions that
+# create a Cadc service. The scripts require Python 3.12 or later.
+
+import importlib.util
+import sys
+
+## Return the named module without executing it. The module is loaded the first time one of its attributes is
+## accessed. A module that has already been imported is returned as is. Before Python 3.12.3 the first access is not
+## thread-safe, and threads making it at the same time can fail with an AttributeError, so a script that first uses a
+## module in several threads loads it with load_modules on the main thread before starting them.
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+## Load lazily imported modules now, on the calling thread.
+def load_modules(*modules):
+    for module in modules:
+        getattr(module, "__name__")
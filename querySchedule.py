@@ -0,0 +1,204 @@
+# This module runs the sync TAP queries of the audit scripts with timeouts and retries learned from previous runs.
+# The time to first byte and the duration of every query are appended to a TSV file in the history store, per site,
+# query and collection. A sync query sends nothing until the server has run it, so the read timeout of a request is
+# in practice a limit on the time to first byte. It is set from the 99th percentile of the previous times to first
+# byte of the same query instead of a fixed 2 hours, and doubled for the next run when a query times out. Transient
+# failures, i.e. connection errors, interrupted downloads and 429 or 5xx responses, are retried with exponential
+# backoff. A query that timed out is not retried, as the server keeps running it after the client gives up and a
+# retry would only add the same query to the load of the service.
+# The durations are also used by caomAuditRunner to start the largest collections first on each site.
+
+from datetime import datetime, timezone
+from lazyImport import lazy_import
+import auditHistory
+import auditTrace
+import tapStream
+import random
+import time
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+requests = lazy_import("requests")
+urllib3 = lazy_import("urllib3")
+
+## Set up variables
+DURATIONS_NAME = "query_durations.tsv"
+DURATIONS_COLUMNS = ["site_url", "label", "collection", "start_time", "status", "attempt", "timeout_seconds", "ttfb_seconds", "seconds", "rows", "bytes"]
+DEFAULT_TIMEOUT = 7200
+MIN_TIMEOUT = 3600
+MAX_TIMEOUT = 4 * 7200
+TIMEOUT_FACTOR = 2.0
+TIMEOUT_PERCENTILE = 0.99
+MIN_SAMPLES = 3
+MAX_SAMPLES = 50
+MAX_ATTEMPTS = 4
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 600
+TRANSIENT_STATUS_CODES = [429, 500, 502, 503, 504]
+
+## The successful queries of previous runs by (site_url, label, collection), as lists of (ttfb_seconds, seconds), read
+## from the durations file the first time they are needed.
+DURATIONS = None
+
+## The timeout of the last attempt of each query by (site_url, label, collection) when that attempt timed out.
+TIMED_OUT = {}
+
+## Return the path of the durations file, in the history store of the audits.
+def durations_filename():
+    return f"{auditHistory.HISTORY_ROOT}/{DURATIONS_NAME}"
+
+## Read the durations file once into DURATIONS, keeping the last MAX_SAMPLES successful queries of each site, query
+## and collection.
+def read_durations():
+    global DURATIONS
+    if DURATIONS is not None:
+        return DURATIONS
+    DURATIONS = {}
+    if not os.path.exists(durations_filename()):
+        return DURATIONS
+    try:
+        durations_df = pl.read_csv(durations_filename(), separator='\t', infer_schema=False)
+    except Exception as e:
+        print(f"Error reading query durations from {durations_filename()}: {e}")
+        return DURATIONS
+    for row in durations_df.iter_rows(named=True):
+        key = (row["site_url"], row["label"], row["collection"])
+        if row["status"] == "timeout":
+            TIMED_OUT[key] = float(row["timeout_seconds"])
+            continue
+        if row["status"] != "ok":
+            continue
+        TIMED_OUT.pop(key, None)
+        samples = DURATIONS.setdefault((row["site_url"], row["label"], row["collection"]), [])
+        samples.append((float(row["ttfb_seconds"]), float(row["seconds"])))
+        if len(samples) > MAX_SAMPLES:
+            del samples[0]
+    return DURATIONS
+
+## Append one query to the durations file. A single short line is written in append mode so that the lines of audits
+## running in parallel are not interleaved.
+def record_query(site_url, label, collection, status, attempt, timeout, ttfb_seconds, seconds, rows, num_bytes):
+    values = [site_url, label, collection, datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S'), status, attempt,
+              f"{timeout:.0f}", f"{ttfb_seconds:.3f}", f"{seconds:.3f}", rows, num_bytes]
+    try:
+        os.makedirs(auditHistory.HISTORY_ROOT, exist_ok=True)
+        is_new = not os.path.exists(durations_filename())
+        with open(durations_filename(), 'a') as f:
+            f.write(("\t".join(DURATIONS_COLUMNS) + "\n" if is_new else "") + "\t".join([str(value) for value in values]) + "\n")
+    except Exception as e:
+        print(f"Error recording query duration in {durations_filename()}: {e}")
+    if status == "timeout":
+        TIMED_OUT[(site_url, label, collection)] = timeout
+    elif status == "ok":
+        TIMED_OUT.pop((site_url, label, collection), None)
+        samples = read_durations().setdefault((site_url, label, collection), [])
+        samples.append((ttfb_seconds, seconds))
+        if len(samples) > MAX_SAMPLES:
+            del samples[0]
+
+## Return the value at the given fraction of the sorted values, using the nearest rank.
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(fraction * len(values) + 0.999999) - 1))]
+
+## Return the timeout in seconds of a query: TIMEOUT_FACTOR times the 99th percentile of its previous times to first
+## byte, between MIN_TIMEOUT and MAX_TIMEOUT, or DEFAULT_TIMEOUT until MIN_SAMPLES queries have succeeded. After a
+## query has timed out, the timeout is at least twice the one it timed out with until it succeeds again.
+def query_timeout(site_url, label, collection):
+    samples = read_durations().get((site_url, label, collection), [])
+    if len(samples) < MIN_SAMPLES:
+        timeout = DEFAULT_TIMEOUT
+    else:
+        ttfb_p99 = percentile([sample[0] for sample in samples], TIMEOUT_PERCENTILE)
+        timeout = min(MAX_TIMEOUT, max(MIN_TIMEOUT, TIMEOUT_FACTOR * ttfb_p99))
+    if (site_url, label, collection) in TIMED_OUT:
+        timeout = max(timeout, min(MAX_TIMEOUT, 2 * TIMED_OUT[(site_url, label, collection)]))
+    return timeout
+
+## Return the expected duration in seconds of the queries of a collection: the median duration of its previous
+## queries with the given label, or of the longest of its other queries. Returns None for a collection never queried.
+def expected_duration(collection, label):
+    medians = {}
+    for (site_url, sample_label, sample_collection), samples in read_durations().items():
+        if sample_collection == collection and len(samples) > 0:
+            medians[sample_label] = max(medians.get(sample_label, 0.0), percentile([sample[1] for sample in samples], 0.5))
+    if label in medians:
+        return medians[label]
+    return max(medians.values()) if len(medians) > 0 else None
+
+## Return whether a failed query is worth retrying: connection errors, including timeouts while connecting, downloads
+## interrupted by the server and responses asking to try again later or reporting a server error. A read timeout is
+## not retried, as the server is still running the query.
+def is_transient(error):
+    if is_read_timeout(error):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, urllib3.exceptions.ProtocolError))
+
+## Return whether a failed query timed out waiting for the server, rather than while connecting to it.
+def is_read_timeout(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    return isinstance(error, (requests.exceptions.Timeout, urllib3.exceptions.ReadTimeoutError))
+
+## Return the wait before the next attempt: the Retry-After of the response if it gives one in seconds, otherwise an
+## exponential backoff with jitter so that the queries of parallel audits do not retry together.
+def retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(RETRY_MAX_SECONDS, int(response.headers["Retry-After"]))
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+## Execute a query as a sync call to the site URL, requesting CSV output, and return the query result as a polars
+## DataFrame with the throughput of the query and the content encoding of the response. The label names the query,
+## e.g. the audit and query phase, and with the collection identifies its previous durations. Transient failures are
+## retried up to MAX_ATTEMPTS times and the error of the last attempt is raised.
+def sync_query(site_url, query, cert_filename, label, collection, schema_overrides=None):
+    site_url_sync = site_url + "/sync"
+    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": query}
+    timeout = query_timeout(site_url, label, collection)
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        request_start = time.perf_counter()
+        try:
+            # Make the POST request with a streaming response and the timeout of the query
+            with requests.post(site_url_sync, data=data_list, headers=tapStream.REQUEST_HEADERS, allow_redirects=True, cert=cert_filename, stream=True, timeout=timeout) as response:
+                response.raise_for_status()  # Raise an error for bad status codes
+                # Read the raw CSV response into a Polars DataFrame, parsing it in batches while it downloads, counting the bytes
+                # and timing the download and the time spent parsing the batches
+                raw_stream, content_encoding = tapStream.decode_stream(response)
+                reader = auditTrace.CountingReader(raw_stream, request_start)
+                timings = {}
+                query_result = tapStream.read_csv_pipelined(reader, schema_overrides=schema_overrides, timings=timings)
+                stats = reader.parsed(len(query_result), timings["parse_seconds"])
+            record_query(site_url, label, collection, "ok", attempt, timeout, stats["ttfb_seconds"], time.perf_counter() - request_start, len(query_result), stats["bytes"])
+            return query_result, stats, content_encoding
+        except Exception as e:
+            is_timeout = is_read_timeout(e)
+            record_query(site_url, label, collection, "timeout" if is_timeout else "error", attempt, timeout, 0.0, time.perf_counter() - request_start, 0, 0)
+            if is_timeout:
+                print(f"{datetime.now(timezone.utc)} The {label} query of {collection} timed out after {timeout:.0f} seconds and is not retried, the next run will wait up to {query_timeout(site_url, label, collection):.0f} seconds.")
+            if attempt == MAX_ATTEMPTS or not is_transient(e):
+                raise
+            delay = retry_delay(e, attempt)
+            print(f"{datetime.now(timezone.utc)} Attempt {attempt} of the {label} query of {collection} failed: {e}. Retrying in {delay:.0f} seconds.")
+            time.sleep(delay)
+
+## Assign units of work with their expected durations to a number of slots, longest first, each to the slot with the
+## least expected work so far (longest processing time first scheduling). Units with an unknown duration, given as
+## None, are assumed to be as long as the longest known one so that they also start early. Returns the units of each
+## slot in the order they are to be run, and the expected work of each slot.
+def lpt_schedule(units, num_slots):
+    known = [duration for unit, duration in units if duration is not None]
+    unknown_duration = max(known) if len(known) > 0 else 0.0
+    ordered = sorted(units, key=lambda unit: unit[1] if unit[1] is not None else unknown_duration, reverse=True)
+    slots = [[] for _ in range(num_slots)]
+    loads = [0.0] * num_slots
+    for unit, duration in ordered:
+        slot = loads.index(min(loads))
+        slots[slot].append(unit)
+        loads[slot] += duration if duration is not None else unknown_duration
+    return slots, loads
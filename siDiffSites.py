@@ -0,0 +1,254 @@
+from datetime import datetime, timezone
+from pathlib import Path
+from lazyImport import lazy_import, load_modules
+import threading
+import heapq
+import queue
+import csv
+import sys
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pd = lazy_import("pandas")
+requests = lazy_import("requests")
+
+## Set up variables
+CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
+TIME_STAMP = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+OUTPUT_DIRECTORY = f"siDiff-{TIME_STAMP}"
+OUTPUT_FILENAME_ROOT = f"siDiff-{TIME_STAMP}"
+
+## Each site streams its listing in batches of URIS_PER_BATCH uris through a queue holding at most QUEUE_BATCHES batches,
+## so memory use is bounded regardless of the size of the namespace.
+URIS_PER_BATCH = 10000
+QUEUE_BATCHES = 10
+QUEUE_TIMEOUT = 5
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {sys.argv[0]} [--sites site1,site2,...] [namespace1 namespace2 ...]")
+    print(f"       {sys.argv[0]} <-h || --help>")
+
+## Format a duration as HH:MM:SS
+def format_duration(duration):
+    total_seconds = int(duration.total_seconds())
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    seconds = total_seconds % 60
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+## Put an item on a site queue, giving up if the merge has been stopped.
+def put_item(uri_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            uri_queue.put(item, timeout=QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+## Stream the uri-sorted listing of a namespace from a site as a sync TAP query and put the uris on the queue in batches.
+## The end of the listing is signalled with None and an error with the exception raised.
+def stream_site_uris(site_name, site_url, namespace, uri_queue, stop_event):
+    site_url_sync = site_url + "/sync"
+    site_query = f"select uri from inventory.Artifact where uri like '{namespace}/%' order by uri"
+    data_list = {"LANG": "ADQL", "RESPONSEFORMAT": "CSV", "QUERY": site_query}
+
+    try:
+        # Make the POST request with a streaming response and a 2 hour timeout
+        with requests.post(site_url_sync, data=data_list, allow_redirects=True, cert=CERT_FILENAME, stream=True, timeout=7200) as response:
+            response.raise_for_status()
+            response.encoding = 'utf-8'
+            reader = csv.reader(response.iter_lines(decode_unicode=True))
+            next(reader, None)
+            batch = []
+            for row in reader:
+                if len(row) == 0:
+                    continue
+                batch.append(row[0])
+                if len(batch) == URIS_PER_BATCH:
+                    if not put_item(uri_queue, batch, stop_event):
+                        return
+                    batch = []
+            if len(batch) > 0:
+                put_item(uri_queue, batch, stop_event)
+    except Exception as e:
+        print(f"{datetime.now(timezone.utc)} Error querying site {site_name} for namespace {namespace}: {e}")
+        put_item(uri_queue, e, stop_event)
+        return
+
+    put_item(uri_queue, None, stop_event)
+
+## Yield the uris of a site from its queue, tagged with the index of the site. The listing must be sorted by uri
+## for the merge to be correct, so an unsorted listing is an error.
+def site_uris(site_name, site_index, uri_queue):
+    previous_uri = None
+    while True:
+        item = uri_queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        for uri in item:
+            if previous_uri is not None and uri <= previous_uri:
+                if uri == previous_uri:
+                    continue
+                raise ValueError(f"Listing from site {site_name} is not sorted by uri: {uri} follows {previous_uri}")
+            previous_uri = uri
+            yield uri, site_index
+
+## Download the listings of a namespace from all sites concurrently, merge them by uri and write one row for each site
+## missing each uri. Only one batch per site is held in the merge at any time.
+def diff_namespace(namespace, site_names, site_urls):
+    start_time = datetime.now(timezone.utc)
+    filename = f"{OUTPUT_FILENAME_ROOT}_{namespace}.tsv"
+    num_sites = len(site_names)
+    num_uris = 0
+    num_missing = [0] * num_sites
+    stop_event = threading.Event()
+
+    ## Start one download thread per site. The threads are the first to use requests, so it is loaded first on the
+    ## main thread, see lazyImport.
+    load_modules(requests)
+    uri_queues = []
+    threads = []
+    for site_name, site_url in zip(site_names, site_urls):
+        uri_queue = queue.Queue(maxsize=QUEUE_BATCHES)
+        thread = threading.Thread(target=stream_site_uris, args=(site_name, site_url, namespace, uri_queue, stop_event), daemon=True)
+        thread.start()
+        uri_queues.append(uri_queue)
+        threads.append(thread)
+
+    print(f"Comparing namespace {namespace} across sites {' '.join(site_names)} and writing results to {filename}.")
+    try:
+        with open(filename, 'w') as f:
+            f.write(f"Result for namespace {namespace}\n")
+            f.write(f"\n")
+            f.write(f"Start time UTC\t{start_time.strftime('%Y-%m-%dT%H:%M:%S')}\n")
+            f.write(f"Sites compared\t{' '.join(site_names)}\n")
+            f.write(f"\n")
+            f.write(f"category\tnamespace\tsite\turi\n")
+
+            ## Merge the sorted listings and collect the sites holding each uri.
+            merged_uris = heapq.merge(*[site_uris(site_names[index], index, uri_queues[index]) for index in range(num_sites)])
+            current_uri = None
+            present = [False] * num_sites
+            for uri, site_index in merged_uris:
+                if uri != current_uri:
+                    if current_uri is not None:
+                        num_uris += 1
+                        for index in range(num_sites):
+                            if not present[index]:
+                                num_missing[index] += 1
+                                f.write(f"MISSING\t{namespace}\t{site_names[index]}\t{current_uri}\n")
+                    current_uri = uri
+                    present = [False] * num_sites
+                present[site_index] = True
+            if current_uri is not None:
+                num_uris += 1
+                for index in range(num_sites):
+                    if not present[index]:
+                        num_missing[index] += 1
+                        f.write(f"MISSING\t{namespace}\t{site_names[index]}\t{current_uri}\n")
+
+            ## Finally, write the summary message
+            end_time = datetime.now(timezone.utc)
+            missing_header = "\t".join([f"Missing at {site_name}" for site_name in site_names])
+            missing_values = "\t".join([str(count) for count in num_missing])
+            message = f"Category\tNamespace\tStart time UTC\tDistinct URIs\t{missing_header}\tDuration\tEnd time UTC"
+            f.write(f"\n{message}\n")
+            message = f"SUMMARY\t{namespace}\t{start_time.strftime('%Y-%m-%dT%H:%M:%S')}\t{num_uris}\t{missing_values}\t{format_duration(end_time - start_time)}\t{end_time.strftime('%Y-%m-%dT%H:%M:%S')}\n"
+            f.write(f"{message}\n")
+            f.flush()
+            print(message)
+    except Exception as e:
+        print(f"Error comparing namespace {namespace}: {e}")
+        stop_event.set()
+        return False
+
+    for thread in threads:
+        thread.join()
+    return True
+
+## Main function to execute the script.
+## It initializes the data structures by reading from the pre-generated namespaces and sites files.
+## It then loops through the list of namespaces and lists the uris missing at each site.
+## If the script is given one or more arguments, these are the namespaces to be compared.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
+
+if __name__ == "__main__":
+
+    ## Check if the certificate file exists.
+    if not os.path.exists(CERT_FILENAME):
+        print(f"Certificate file {CERT_FILENAME} does not exist. Please check the path.")
+        exit(1)
+
+    ## Determine where the siMonitoring directory is located and change to that directory.
+    if os.path.isdir("/Users/gaudet_1/work/siMonitoring"):
+        os.chdir("/Users/gaudet_1/work/siMonitoring")
+    elif os.path.isdir("/arc/projects/CADC/siMonitoring"):
+        os.chdir("/arc/projects/CADC/siMonitoring")
+    else:
+        print("Unable to determine the location of the siMonitoring directory.")
+        exit(1)
+
+    ## Check the first argument to determine if help is requested.
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+
+    ## Read static configuration files for namespaces and sites.
+    namespace_filename = "config/siNamespaces.csv"
+    sites_filename = "config/siSites.csv"
+    try:
+        namespaces = pd.read_csv(namespace_filename)
+        sites = pd.read_csv(sites_filename)
+    except FileNotFoundError as e:
+        print(f"Error reading configuration files: {e}")
+        exit(1)
+
+    ## Check for a list of sites to compare, otherwise compare all sites.
+    arguments = sys.argv[1:]
+    if len(arguments) >= 2 and arguments[0] == '--sites':
+        sites_to_compare = arguments[1].split(',')
+        arguments = arguments[2:]
+        for site_name in sites_to_compare:
+            if site_name not in sites['site_name'].values:
+                print(f"Site {site_name} not found in configuration file.")
+                exit(1)
+        sites = sites[sites['site_name'].isin(sites_to_compare)]
+    if len(sites) < 2:
+        print("At least two sites are required for a comparison.")
+        exit(1)
+
+    ## Create the list of namespaces to compare, either from the list provided on the command line or from the configuration file.
+    if len(arguments) == 0:
+        namespaces_to_compare = namespaces['namespace'].tolist()
+    else:
+        namespaces_to_compare = arguments
+        for namespace in namespaces_to_compare:
+            if namespaces[namespaces['namespace'] == namespace].empty:
+                print(f"Namespace {namespace} not found in configuration file.")
+                exit(1)
+    print(f"Comparing namespace(s): {namespaces_to_compare}")
+
+    ## Creat a subdirectory for the output files if it does not exist.
+    try:
+        if not os.path.exists(OUTPUT_DIRECTORY):
+            os.makedirs(OUTPUT_DIRECTORY)
+        os.chdir(OUTPUT_DIRECTORY)
+    except Exception as e:
+        print(f"Error creating output directory {OUTPUT_DIRECTORY}: {e}")
+        exit(1)
+
+    ## Now compare the namespaces one at a time, downloading from all sites concurrently.
+    error = False
+    for namespace in namespaces_to_compare:
+        if not diff_namespace(namespace, sites['site_name'].tolist(), sites['url'].tolist()):
+            error = True
+
+    if error:
+        print("One or more namespaces could not be compared.")
+        exit(1)
+    print("All namespaces have been compared.")
+    exit(0)
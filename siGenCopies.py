@@ -1,23 +1,56 @@
-from astroquery.cadc import Cadc
 from datetime import datetime, timezone
 from pathlib import Path
+from lazyImport import lazy_import
 import multiprocessing  
-import pandas as pd
+import auditTrace
+import queue
 import sys
 import os
 
+## Heavy packages are loaded on first use, see lazyImport.
+pd = lazy_import("pandas")
+
 ## Set up variables
 CERT_FILENAME = f"{Path.home()}/.ssl/cadcproxy.pem"
 TIME_STAMP = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
 OUTPUT_DIRECTORY = f"siCopies-{TIME_STAMP}"
 OUTPUT_FILENAME_ROOT = f"siCopies-{TIME_STAMP}"
 
-def query_site(namespace, namespace_filename_root, namespace_datestamp, site):
+## Expression giving the namespace prefix of an artifact uri, i.e. everything before the first '/', or the whole uri
+## when it has no '/' so that the length of the substring is never negative.
+NAMESPACE_PREFIX = "case when position('/' in uri) > 0 then substring(uri from 1 for position('/' in uri) - 1) else uri end"
+
+## Each site is queried in its own process, which sends the spans it records back to the trace of the run through a queue.
+TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
+
+## Add the spans sent by the site processes to the trace of the run. The processes have been joined, so the queue only holds complete lists.
+def collect_spans(trace_queue):
+    while not trace_queue.empty():
+        TRACE.extend(trace_queue.get())
+
+## Wait for the site processes to complete, adding the spans they send to the trace of the run while waiting, as a
+## process that has put its spans on the queue cannot exit until they have been read.
+def join_processes(processes, trace_queue, description):
+    for p in processes:
+        try:
+            while p.is_alive():
+                try:
+                    TRACE.extend(trace_queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            p.join()
+        except Exception as e:
+            print(f"Error joining process {p}{description}: {e}")
+            continue
+    collect_spans(trace_queue)
+
+def query_site(namespace, namespace_filename_root, namespace_datestamp, site, trace_queue):
 
     site_name = site['site_name']
     site_url = site['url']
 
     ## Create a Cadc service object for the given site.
+    from astroquery.cadc import Cadc
     try:
         site_service = Cadc(url=site_url)
         site_service.login(certificate_file=CERT_FILENAME)
@@ -29,19 +62,21 @@ def query_site(namespace, namespace_filename_root, namespace_datestamp, site):
     site_filename = f"{namespace_filename_root}_{site_name}.csv"
     print(f"Querying site {site_name} for namespace {namespace}")
 
+    trace = auditTrace.Trace(OUTPUT_FILENAME_ROOT)
     try:
-        start = datetime.now(timezone.utc)
-        job = site_service.create_async(site_query)
-        print(f"Job ID link: {site_url}/async/{job.job_id}")
-        job.run().wait()
-        job.raise_if_error()
-        query_results = job.fetch_result().to_table().to_pandas()
-        end = datetime.now(timezone.utc)
-        duration = (end - start).total_seconds()
+        with trace.span("site_query", site=site_name, namespace=namespace) as query_span:
+            job = site_service.create_async(site_query)
+            print(f"Job ID link: {site_url}/async/{job.job_id}")
+            job.run().wait()
+            job.raise_if_error()
+            query_results = job.fetch_result().to_table().to_pandas()
+            query_span.count(num_rows=len(query_results))
+        duration = query_span.duration.total_seconds()
         query_results[f'{site_name}_duration'] = duration
         print(f"Query completed for {site_name} in {duration:.2f} seconds.")        
     except Exception as e:
         print(f"Error querying {site_name}: {e}")
+    trace_queue.put(trace.spans)
 
     try:
         query_results.to_csv(site_filename, index=False)
@@ -51,7 +86,7 @@ def query_site(namespace, namespace_filename_root, namespace_datestamp, site):
 
 
 ## For a given namespace, query all sites in parallel and wait for them to complete.
-def query_namespace(namespace):
+def query_namespace(namespace, trace_queue):
     namespace_filename_root = f"{OUTPUT_FILENAME_ROOT}_{namespace}"
     namespace_datestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
     processes = []
@@ -59,7 +94,7 @@ def query_namespace(namespace):
     ## Loop though the sites dataframe, format the query for the given namespce.
     for index, site in sites.iterrows():       
         try:
-            p = multiprocessing.Process(target=query_site, args=(namespace, namespace_filename_root, namespace_datestamp, site))
+            p = multiprocessing.Process(target=query_site, args=(namespace, namespace_filename_root, namespace_datestamp, site, trace_queue))
             p.start()
             processes.append(p)
         except Exception as e:
@@ -71,20 +106,144 @@ def query_namespace(namespace):
         return
 
     ## Join all processes to ensure they complete before moving on.
-    for p in processes:
+    join_processes(processes, trace_queue, f" for namespace {namespace}")
+
+    print(f"All queries for namespace {namespace} completed.")
+
+
+## Run a query on a site as an async job and return its results as a pandas DataFrame.
+def run_site_query(site_service, site_url, site_query):
+    job = site_service.create_async(site_query)
+    print(f"Job ID link: {site_url}/async/{job.job_id}")
+    job.run().wait()
+    job.raise_if_error()
+    return job.fetch_result().to_table().to_pandas()
+
+## Write the count, duration and total bytes of a namespace at a site to the per-namespace file read by siMergeCopies.
+def write_namespace_results(filename_root, namespace, datestamp, site_name, count, duration, total_bytes):
+    namespace_results = pd.DataFrame({
+        'datestamp': [datestamp],
+        'namespace': [namespace],
+        f'{site_name}_count': [count],
+        f'{site_name}_duration': [duration],
+        f'{site_name}_bytes': [0 if pd.isna(total_bytes) else int(total_bytes)]
+    })
+    site_filename = f"{filename_root}_{namespace}_{site_name}.csv"
+    try:
+        ## A namespace containing a '/' puts its file in a subdirectory.
+        if os.path.dirname(site_filename) != "":
+            os.makedirs(os.path.dirname(site_filename), exist_ok=True)
+        namespace_results.to_csv(site_filename, index=False)
+    except Exception as e:
+        print(f"Error writing to {site_filename}: {e}")
+
+
+## Query a site once for all the given namespaces, grouping the artifacts by namespace prefix, and fan the
+## counts and total bytes out into the same per-namespace files written by query_site. A namespace containing a '/'
+## can never be the namespace prefix of a uri, so these namespaces are queried one at a time with a uri like constraint.
+## The filename root is given by the parent, as a process started with spawn computes its own TIME_STAMP.
+def query_site_grouped(namespaces_to_query, filename_root, datestamp, site, constrained, trace_queue):
+
+    site_name = site['site_name']
+    site_url = site['url']
+    grouped_namespaces = [namespace for namespace in namespaces_to_query if '/' not in namespace]
+    nested_namespaces = [namespace for namespace in namespaces_to_query if '/' in namespace]
+
+    ## Create a Cadc service object for the given site.
+    from astroquery.cadc import Cadc
+    try:
+        site_service = Cadc(url=site_url)
+        site_service.login(certificate_file=CERT_FILENAME)
+    except Exception as e:
+        print(f"Error creating service for site {site_name} at {site_url}: {e}")
+        exit(1)
+
+    trace = auditTrace.Trace(filename_root)
+
+    if len(grouped_namespaces) > 0:
+        ## Only constrain the uri when a subset of namespaces was requested, otherwise a single scan of the table is cheaper.
+        site_query = f"""select {NAMESPACE_PREFIX} as namespace, count(*) as {site_name}_count, sum(contentLength) as {site_name}_bytes
+            from inventory.Artifact"""
+        if constrained:
+            uri_constraints = " or ".join([f"uri like '{namespace}/%'" for namespace in grouped_namespaces])
+            site_query += f"""
+            where {uri_constraints}"""
+        site_query += f"""
+            group by {NAMESPACE_PREFIX}"""
+        print(f"Querying site {site_name} for {len(grouped_namespaces)} namespaces")
+
         try:
-            p.join()
+            with trace.span("site_query", site=site_name, namespaces=len(grouped_namespaces)) as query_span:
+                query_results = run_site_query(site_service, site_url, site_query)
+                query_span.count(num_rows=len(query_results))
+            duration = query_span.duration.total_seconds()
+            print(f"Query completed for {site_name} in {duration:.2f} seconds.")
         except Exception as e:
-            print(f"Error joining process {p} for namespace {namespace}: {e}")
+            print(f"Error querying {site_name}: {e}")
+            query_results = None
+
+        ## Fan the grouped results out into one row per namespace. Namespaces without artifacts at this site have a count of 0.
+        if query_results is not None:
+            write_span = trace.span("write", site=site_name).start()
+            query_results = query_results.set_index('namespace')
+            for namespace in grouped_namespaces:
+                if namespace in query_results.index:
+                    count = query_results.loc[namespace, f"{site_name}_count"]
+                    total_bytes = query_results.loc[namespace, f"{site_name}_bytes"]
+                else:
+                    count = 0
+                    total_bytes = 0
+                write_namespace_results(filename_root, namespace, datestamp, site_name, count, duration, total_bytes)
+            write_span.stop()
+
+    ## Query the namespaces containing a '/' one at a time, as in the per-namespace mode.
+    for namespace in nested_namespaces:
+        site_query = f"select count(*) as {site_name}_count, sum(contentLength) as {site_name}_bytes from inventory.Artifact where uri like '{namespace}/%'"
+        print(f"Querying site {site_name} for namespace {namespace}")
+        try:
+            with trace.span("site_query", site=site_name, namespace=namespace) as query_span:
+                query_results = run_site_query(site_service, site_url, site_query)
+                query_span.count(num_rows=len(query_results))
+            duration = query_span.duration.total_seconds()
+            print(f"Query completed for {site_name} and namespace {namespace} in {duration:.2f} seconds.")
+        except Exception as e:
+            print(f"Error querying {site_name} for namespace {namespace}: {e}")
             continue
+        write_namespace_results(filename_root, namespace, datestamp, site_name, query_results[f"{site_name}_count"].iloc[0], duration, query_results[f"{site_name}_bytes"].iloc[0])
+    trace_queue.put(trace.spans)
 
-    print(f"All queries for namespace {namespace} completed.")
+    print(f"Results for {len(namespaces_to_query)} namespaces written for site {site_name}")
+
+
+## Query all sites in parallel with one grouped query per site and wait for them to complete.
+def query_sites_grouped(namespaces_to_query, constrained, trace_queue):
+    datestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+    processes = []
+
+    for index, site in sites.iterrows():
+        try:
+            p = multiprocessing.Process(target=query_site_grouped, args=(namespaces_to_query, OUTPUT_FILENAME_ROOT, datestamp, site, constrained, trace_queue))
+            p.start()
+            processes.append(p)
+        except Exception as e:
+            print(f"Error starting process for site {site['site_name']}: {e}")
+            continue
+
+    if len(processes) == 0:
+        print(f"No processes to join.")
+        return
+
+    ## Join all processes to ensure they complete before moving on.
+    join_processes(processes, trace_queue, "")
+
+    print(f"All grouped queries completed.")
 
 
 ## Main function to execute the script.
 ## It initializes the data structures by reading from pre-generated namespaces and sites files
 ## It then loops through the list of namespaces and processes them.
 ## If the script is give one or more arguments, these are the namespaces to be queried.
+## If the first argument is --grouped, each site is queried once for all namespaces rather than once per namespace.
 ## The script will exit with a status code of 0 if successful, or 255 if an error occurs.
 
 if __name__ == "__main__":
@@ -104,10 +263,17 @@ if __name__ == "__main__":
         exit(1)
 
     ## Check the first argument to determine if help is requested.
-    if len(sys.argv) == 1 and sys.argv[0] in ['--help', '-h']:
-        print(f"Usage: {sys.argv[0]} [namespace1 namespace2 ...]")
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
+        print(f"Usage: {sys.argv[0]} [--grouped] [namespace1 namespace2 ...]")
         print(f"       {sys.argv[0]} <-h || --help>")
         exit(0)
+
+    ## Check the first argument to determine if a single grouped query per site is requested.
+    arguments = sys.argv[1:]
+    grouped = False
+    if len(arguments) > 0 and arguments[0] == '--grouped':
+        grouped = True
+        arguments = arguments[1:]
    
     ## Read static configuration files for namespaces and sites.
     namespace_filename = "config/siNamespaces.csv"
@@ -120,13 +286,13 @@ if __name__ == "__main__":
         exit(1)
 
 
-    if len(sys.argv) == 1:
+    if len(arguments) == 0:
         ## If the script is given no arguments, it will query for all namespaces in the configuration file.
         namespaces_to_query = namespaces['namespace'].tolist()
         print(f"Querying all namespaces: {namespaces_to_query}")
     else:   
         ## If the script is given one or more arguments, these are the namespaces to be queried.
-        namespaces_to_query = sys.argv[2:]
+        namespaces_to_query = arguments
         error = False
         for namespace in namespaces_to_query:
             row_data = namespaces[namespaces['namespace'] == namespace]
@@ -147,9 +313,19 @@ if __name__ == "__main__":
         print(f"Error creating output directory {OUTPUT_DIRECTORY}: {e}")
         exit(1)
     
-    ## Now query the namespaces.
-    for namespace in namespaces_to_query:
-        print(f"Querying namespace: {namespace}")
-        query_namespace(namespace) 
+    ## Now query the namespaces, either with one grouped query per site or one query per namespace per site.
+    TRACE = auditTrace.Trace(OUTPUT_FILENAME_ROOT, grouped=grouped, sites=len(sites))
+    trace_queue = multiprocessing.Queue()
+    if grouped:
+        with TRACE.span("grouped", namespaces=len(namespaces_to_query)):
+            query_sites_grouped(namespaces_to_query, len(arguments) > 0, trace_queue)
+    else:
+        for namespace in namespaces_to_query:
+            print(f"Querying namespace: {namespace}")
+            with TRACE.span("namespace", namespace=namespace):
+                query_namespace(namespace, trace_queue) 
+
+    ## Write the trace of the run next to the per-site files.
+    TRACE.write(OUTPUT_FILENAME_ROOT)
     
     print("All namespaces have been queried.")
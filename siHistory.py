@@ -0,0 +1,168 @@
+from datetime import datetime, timezone
+from lazyImport import lazy_import
+import sys
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+HISTORY_DIRECTORY = "history/siCopies"
+INDEX_FILENAME = f"{HISTORY_DIRECTORY}/runs.csv"
+RUN_PREFIX = "siCopies-"
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {sys.argv[0]} runs")
+    print(f"       {sys.argv[0]} trend <namespace> [site1 site2 ...]")
+    print(f"       {sys.argv[0]} delta <run1> <run2> [namespace1 namespace2 ...]")
+    print(f"       {sys.argv[0]} <-h || -help> for help")
+
+## The schema of the index, built when it is needed so that polars is not loaded on import.
+def index_schema():
+    return {"run": pl.String, "run_time": pl.String, "date": pl.String, "path": pl.String, "num_namespaces": pl.Int64}
+
+## Determine the time of a run from its directory name, e.g. siCopies-2025-06-12T16-15-16.
+def run_time_from_name(run):
+    try:
+        return datetime.strptime(run.removeprefix(RUN_PREFIX), "%Y-%m-%dT%H-%M-%S").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return datetime.now(timezone.utc)
+
+## Read the index of runs in the history store, one row per run with the path of its Parquet file.
+def read_index():
+    if not os.path.exists(INDEX_FILENAME):
+        return pl.DataFrame(schema=index_schema())
+    return pl.read_csv(INDEX_FILENAME, schema=index_schema())
+
+## Append the merged namespace x site matrix of one siCopies run to the history store. The matrix is stored in long
+## format (one row per namespace and site), sorted by namespace, in a Parquet file partitioned by the date of the run.
+## Appending the same run again replaces its file and index entry.
+def append_run(merged_df, run, site_names):
+    run_time = run_time_from_name(run)
+    date = run_time.strftime("%Y-%m-%d")
+    partition_directory = f"{HISTORY_DIRECTORY}/date={date}"
+    path = f"{partition_directory}/{run}.parquet"
+
+    site_frames = []
+    for site in site_names:
+        if f"{site}_count" not in merged_df.columns:
+            continue
+        bytes_column = pl.col(f"{site}_bytes") if f"{site}_bytes" in merged_df.columns else pl.lit(None)
+        site_frames.append(merged_df.select(
+            pl.lit(run).alias("run"),
+            pl.lit(run_time.strftime("%Y-%m-%dT%H:%M:%S")).alias("run_time"),
+            pl.col("namespace"),
+            pl.lit(site).alias("site"),
+            pl.col(f"{site}_count").cast(pl.Int64).alias("count"),
+            pl.col(f"{site}_duration").cast(pl.Int64).alias("duration"),
+            bytes_column.cast(pl.Int64).alias("bytes")
+        ))
+    run_df = pl.concat(site_frames).sort(["namespace", "site"])
+
+    os.makedirs(partition_directory, exist_ok=True)
+    run_df.write_parquet(path)
+
+    index_df = read_index().filter(pl.col("run") != run)
+    index_df = pl.concat([index_df, pl.DataFrame({
+        "run": [run], "run_time": [run_time.strftime("%Y-%m-%dT%H:%M:%S")], "date": [date], "path": [path], "num_namespaces": [len(merged_df)]
+    }, schema=index_schema())]).sort("run_time")
+    index_df.write_csv(INDEX_FILENAME)
+
+    print(f"Appended {len(run_df)} rows for run {run} to {path}.")
+    return
+
+## Add the replication lag of each site, i.e. how many artifacts it is behind the site with the most artifacts for
+## the same namespace in the same run.
+def with_lag(history_df):
+    return history_df.with_columns(
+        (pl.col("count").max().over(["run", "namespace"]) - pl.col("count")).alias("lag")
+    )
+
+## Read the rows of the given runs, using the index to open only their Parquet files.
+def read_runs(runs):
+    index_df = read_index().filter(pl.col("run").is_in(runs))
+    for run in runs:
+        if run not in index_df["run"].to_list():
+            print(f"Run {run} not found in {INDEX_FILENAME}.")
+            exit(1)
+    return pl.scan_parquet(index_df["path"].to_list())
+
+## List the runs in the history store.
+def list_runs():
+    index_df = read_index()
+    print(index_df.select(["run", "run_time", "num_namespaces"]))
+    return index_df
+
+## Return the count and lag of each site for one namespace across all runs, oldest first, with the change in count
+## since the previous run.
+def trend(namespace, sites):
+    index_df = read_index()
+    if index_df.is_empty():
+        print(f"No runs found in {INDEX_FILENAME}.")
+        exit(1)
+
+    history_df = pl.scan_parquet(index_df["path"].to_list()).filter(pl.col("namespace") == namespace).collect()
+    history_df = with_lag(history_df)
+    if len(sites) > 0:
+        history_df = history_df.filter(pl.col("site").is_in(sites))
+    history_df = history_df.sort(["site", "run_time"]).with_columns(
+        pl.col("count").diff().over("site").alias("count_change")
+    ).select(["run_time", "site", "count", "count_change", "lag", "duration"]).sort(["run_time", "site"])
+    return history_df
+
+## Return the count and lag of each namespace and site in two runs along with their differences.
+def delta(run1, run2, namespaces):
+    history_df = read_runs([run1, run2])
+    if len(namespaces) > 0:
+        history_df = history_df.filter(pl.col("namespace").is_in(namespaces))
+    history_df = with_lag(history_df.collect())
+
+    run1_df = history_df.filter(pl.col("run") == run1).select(["namespace", "site", "count", "lag"])
+    run2_df = history_df.filter(pl.col("run") == run2).select(["namespace", "site", "count", "lag"])
+    delta_df = run1_df.join(run2_df, on=["namespace", "site"], how="full", coalesce=True, suffix="_2").rename(
+        {"count": "count_1", "lag": "lag_1"}
+    ).with_columns(
+        (pl.col("count_2") - pl.col("count_1")).alias("count_change"),
+        (pl.col("lag_2") - pl.col("lag_1")).alias("lag_change")
+    ).sort(["namespace", "site"])
+    return delta_df
+
+## Main function to execute the script.
+## It queries the history store of merged siCopies runs that siMergeCopies appends to.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
+
+if __name__ == "__main__":
+
+    ## Determine where the siMonitoring directory is located and change to that directory.
+    if os.path.isdir("/Users/gaudet_1/work/siMonitoring"):
+        os.chdir("/Users/gaudet_1/work/siMonitoring")
+    elif os.path.isdir("/arc/projects/CADC/siMonitoring"):
+        os.chdir("/arc/projects/CADC/siMonitoring")
+    else:
+        print("Unable to determine the location of the siMonitoring directory.")
+        exit(1)
+
+    if len(sys.argv) < 2:
+        print_usage()
+        exit(1)
+
+    if sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+
+    pl.Config.set_tbl_rows(-1)
+    command = sys.argv[1]
+    if command == "runs":
+        list_runs()
+    elif command == "trend" and len(sys.argv) >= 3:
+        result_df = trend(sys.argv[2], sys.argv[3:])
+        print(result_df)
+    elif command == "delta" and len(sys.argv) >= 4:
+        result_df = delta(sys.argv[2], sys.argv[3], sys.argv[4:])
+        print(result_df)
+    else:
+        print_usage()
+        exit(1)
+
+    exit(0)
@@ -1,17 +1,50 @@
 from datetime import datetime, timezone
 from pathlib import Path
-import pandas as pd
+from lazyImport import lazy_import
+import siHistory
 import sys
 import os
 
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
 ## Usage message for the script.
 def print_usage():
     print(f"Usage: {sys.argv[0]} <directory_name> e.g. siCopies-2025-06-12T16-15-16")
     print(f"       {sys.argv[0]} <-h || -help> for help")
 
+## Read all the per-namespace files for one site in a single scan and return one row per namespace with
+## the datestamp and the site columns. Files that do not exist are skipped as their namespace was not queried or failed.
+def read_site_files(directory_name, namespaces, site):
+    filenames = []
+    for namespace in namespaces:
+        filename = f"{directory_name}_{namespace}_{site}.csv"
+        if os.path.exists(filename):
+            filenames.append(filename)
+        else:
+            print(f"File {filename} does not exist, skipping.")
+
+    if len(filenames) == 0:
+        return None, 0
+
+    site_df = pl.scan_csv(filenames, schema_overrides={'datestamp': pl.String, 'namespace': pl.String}).collect()
+
+    ## Keep the datestamp, count and duration columns, along with the total bytes if the files were produced in grouped mode.
+    site_columns = [f"{site}_count", f"{site}_duration"]
+    if f"{site}_bytes" in site_df.columns:
+        site_columns.append(f"{site}_bytes")
+    site_df = site_df.select(
+        pl.col('namespace'),
+        pl.col('datestamp').alias(f"{site}_datestamp"),
+        *[pl.col(column) for column in site_columns]
+    ).unique(subset=['namespace'], keep='first')
+
+    return site_df, len(filenames)
+
 ## Main function to execute the script.
 ## It initializes the data structures for pre-generated namespaces and sites.
-## It then loops through the list of namespaces and and merges the values to a single file.
+## It then reads the per-namespace files of each site and merges the values to a single CSV and Parquet file.
+## The merged values are also appended to the siCopies history store (see siHistory.py).
 ## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
 
 if __name__ == "__main__":
@@ -39,13 +72,14 @@ if __name__ == "__main__":
     namespace_filename = "config/siNamespaces.csv"
     sites_filename = "config/siSites.csv"
     try:
-        namespaces = pd.read_csv(namespace_filename)
-        sites = pd.read_csv(sites_filename)
+        namespaces = pl.read_csv(namespace_filename)
+        sites = pl.read_csv(sites_filename)
     except FileNotFoundError as e:
         print(f"Error reading configuration files: {e}")
         exit(1)
 
     ## Change to the output directory provided as an argument.
+    monitoring_directory = os.getcwd()
     directory_name = sys.argv[1]
     if os.path.isdir(directory_name):
         os.chdir(directory_name)
@@ -53,39 +87,52 @@ if __name__ == "__main__":
         print(f"Unable to change to directory {directory_name}")
         exit(1)
 
-   ## Create the output file for the merged results.
+    ## Read the per-namespace files of each site in one pass and join them into the namespace x site matrix,
+    ## keeping the namespaces in the order of the configuration file.
+    read_start = datetime.now(timezone.utc)
+    merged_df = namespaces.select(pl.col('namespace').cast(pl.String)).unique(subset=['namespace'], keep='first', maintain_order=True)
+    datestamp_columns = []
+    site_columns = []
+    num_files = 0
+    for site in sites['site_name']:
+        site_df, num_site_files = read_site_files(directory_name, merged_df['namespace'].to_list(), site)
+        if site_df is None:
+            site_df = pl.DataFrame(schema={'namespace': pl.String, f"{site}_datestamp": pl.String, f"{site}_count": pl.Int64, f"{site}_duration": pl.Float64})
+        merged_df = merged_df.join(site_df, on='namespace', how='left', maintain_order='left')
+        datestamp_columns.append(f"{site}_datestamp")
+        site_columns.extend([column for column in site_df.columns if column not in ['namespace', f"{site}_datestamp"]])
+        num_files += num_site_files
+    read_duration = datetime.now(timezone.utc) - read_start
+    print(f"Read {num_files} files for {len(sites)} sites in {read_duration.total_seconds():.2f} seconds.")
+
+    ## The datestamp of a namespace is the one from the first site with results, and durations are reported in whole seconds.
+    pivot_start = datetime.now(timezone.utc)
+    merged_df = merged_df.with_columns(
+        pl.coalesce(datestamp_columns).alias('datestamp'),
+        *[pl.col(column).round(0).cast(pl.Int64) for column in site_columns if column.endswith('_duration')]
+    ).select(['datestamp', 'namespace'] + site_columns)
+    pivot_duration = datetime.now(timezone.utc) - pivot_start
+    print(f"Merged {len(merged_df)} namespaces in {pivot_duration.total_seconds():.2f} seconds.")
+
+    ## Write the merged results as CSV and Parquet.
+    write_start = datetime.now(timezone.utc)
     output_filename = f"{directory_name}_merged.csv"
+    parquet_filename = f"{directory_name}_merged.parquet"
+    try:
+        merged_df.write_csv(output_filename)
+        merged_df.write_parquet(parquet_filename)
+    except Exception as e:
+        print(f"Error creating output files {output_filename} and {parquet_filename}: {e}")
+        exit(1)
+    write_duration = datetime.now(timezone.utc) - write_start
+    print(f"Wrote {output_filename} and {parquet_filename} in {write_duration.total_seconds():.2f} seconds.")
+
+    ## Append the merged results to the history store in the siMonitoring directory.
+    os.chdir(monitoring_directory)
     try:
-        with open(output_filename, 'w') as f:
-
-            ## Loop through the sites to create csv header.
-            f.write(f"datestamp,namespace")
-            for site in sites['site_name']:
-                f.write(f",{site}_count,{site}_duration")
-            f.write("\n")
-
-            ## Loop through the namespaces and sites to extract values and write to merged file.
-            for namespace in namespaces['namespace']:
-                print(f"Merging namespace: {namespace}")
-                f.write(f"{namespace}")
-                first_site = True
-                for site in sites['site_name']:
-                    filename = f"{directory_name}_{namespace}_{site}.csv"
-                    if os.path.exists(filename):
-                        df = pd.read_csv(filename)
-                        if first_site:
-                            datestamp = df['datestamp'].iloc[0] if 'datestamp' in df.columns else ''
-                            f.write(f",{datestamp}")
-                            first_site = False
-                        count = df[f"{site}_count"].iloc[0] if f"{site}_count" in df.columns else ''
-                        duration = df[f"{site}_duration"].iloc[0] if f"{site}_duration" in df.columns else ''
-                        f.write(f",{count},{duration:.0f}")
-                    else:
-                        f.write(",,")
-                        print(f"File {filename} does not exist, skipping.")
-                f.write("\n")
+        siHistory.append_run(merged_df, os.path.basename(directory_name.rstrip('/')), sites['site_name'].to_list())
     except Exception as e:
-        print(f"Error creating output file {output_filename}: {e}")
+        print(f"Error appending {directory_name} to the history store: {e}")
         exit(1)
 
     print("Script completed successfully.")
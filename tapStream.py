@@ -0,0 +1,134 @@
+# This module reads the CSV output of a sync TAP query into a polars DataFrame while it is still downloading.
+# pl.read_csv buffers the whole response before it starts parsing, so a long download is followed by a long parse.
+# read_csv_pipelined instead cuts the stream into batches at row boundaries and parses each batch on a worker
+# thread while the next one downloads, so the total time approaches the larger of the download and the parse.
+# The queries ask for a compressed response and decode_stream makes the response stream decompress it.
+
+from urllib3.util.request import ACCEPT_ENCODING
+from lazyImport import lazy_import
+import threading
+import tempfile
+import queue
+import time
+import io
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+READ_SIZE = 1024 * 1024
+BATCH_BYTES = 16 * 1024 * 1024
+QUEUE_BATCHES = 4
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+
+## Headers for the sync TAP queries, accepting every content encoding urllib3 can decode: gzip and deflate, and
+## also br and zstd when the brotli and zstandard packages are installed.
+REQUEST_HEADERS = {"Accept-Encoding": ACCEPT_ENCODING}
+
+## Make the raw stream of a streamed response decompress its content as it is read, which reading response.raw
+## directly does not do by default, and return it with the content encoding of the response.
+def decode_stream(response):
+    response.raw.decode_content = True
+    return response.raw, response.headers.get("Content-Encoding", "identity")
+
+## Return the position just after the last complete row in the data, or 0 if there is none. The data starts at a
+## row boundary, so a newline ends a row only if the number of quotes before it is even, which keeps quoted values
+## containing newlines in one batch.
+def last_row_end(data):
+    position = data.rfind(b"\n")
+    while position >= 0 and data.count(b'"', 0, position) % 2 != 0:
+        position = data.rfind(b"\n", 0, position)
+    return position + 1
+
+## Parse the batches put on the queue until None is received. The first batch is parsed with the usual schema
+## inference of pl.read_csv and its schema is used for the following batches, so the result has the same types as
+## reading the whole response at once. A batch that does not match the schema stops the parse and the error is kept.
+## The time spent parsing each batch is appended to parse_times.
+def parse_batches(header, batch_queue, frames, errors, schema_overrides, parse_times):
+    schema = None
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            return
+        if len(errors) > 0:
+            continue
+        parse_start = time.perf_counter()
+        try:
+            if schema is None:
+                frame = pl.read_csv(io.BytesIO(header + batch), schema_overrides=schema_overrides)
+                schema = frame.schema
+            else:
+                frame = pl.read_csv(io.BytesIO(header + batch), schema=schema)
+            frames.append(frame)
+        except Exception as e:
+            errors.append(e)
+        parse_times.append(time.perf_counter() - parse_start)
+
+## Read the CSV stream of a TAP query into a DataFrame, parsing batches of about batch_bytes on a worker thread while
+## the stream downloads. The stream is also spooled to a temporary file, and if a batch cannot be parsed with the
+## schema of the first batch the spooled response is parsed in one go as pl.read_csv would have. As the parse
+## overlaps the download, the time from the last byte to the end of the parse is not the parse time, so the time
+## spent parsing, summed over the batches, is set as parse_seconds in timings when a dictionary is given.
+def read_csv_pipelined(stream, schema_overrides=None, batch_bytes=BATCH_BYTES, timings=None):
+    batch_queue = queue.Queue(maxsize=QUEUE_BATCHES)
+    frames = []
+    errors = []
+    parse_times = []
+    header = None
+    pending = bytearray()
+    num_batches = 0
+    worker = None
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        try:
+            while True:
+                chunk = stream.read(READ_SIZE)
+                spool.write(chunk)
+                if len(errors) == 0:
+                    pending += chunk
+
+                ## The first line is the header, which is added to every batch. Start the worker once it is complete.
+                if header is None:
+                    end = pending.find(b"\n")
+                    if end < 0:
+                        if chunk:
+                            continue
+                        break
+                    header = bytes(pending[:end + 1])
+                    del pending[:end + 1]
+                    worker = threading.Thread(target=parse_batches, args=(header, batch_queue, frames, errors, schema_overrides, parse_times), daemon=True)
+                    worker.start()
+
+                ## At the end of the stream the remaining rows form the last batch. A response with no rows still
+                ## needs one batch to give a DataFrame with the columns of the header.
+                if not chunk:
+                    if len(errors) == 0 and (len(pending) > 0 or num_batches == 0):
+                        batch_queue.put(bytes(pending))
+                    break
+
+                if len(pending) >= batch_bytes and len(errors) == 0:
+                    end = last_row_end(pending)
+                    if end > 0:
+                        batch_queue.put(bytes(pending[:end]))
+                        del pending[:end]
+                        num_batches += 1
+        finally:
+            if worker is not None:
+                batch_queue.put(None)
+                worker.join()
+
+        ## Without a complete header or if a batch could not be parsed, parse the spooled response in one go.
+        if header is None or len(errors) > 0:
+            if len(errors) > 0:
+                print(f"Pipelined parse failed ({str(errors[0]).splitlines()[0]}), parsing the whole response.")
+            spool.seek(0)
+            parse_start = time.perf_counter()
+            query_result = pl.read_csv(spool, schema_overrides=schema_overrides)
+            parse_times.append(time.perf_counter() - parse_start)
+            if timings is not None:
+                timings["parse_seconds"] = sum(parse_times)
+            return query_result
+
+    if timings is not None:
+        timings["parse_seconds"] = sum(parse_times)
+    return pl.concat(frames, how="vertical", rechunk=True)
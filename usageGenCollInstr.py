@@ -1,10 +1,34 @@
 # This script is used to generate CSV files containing the percentage of null values
 # for each collection/instrument combination in the caom2.Observation and caom2.Plane tables.
 
-from astroquery.cadc import Cadc
+from concurrent.futures import ThreadPoolExecutor
+from lazyImport import lazy_import, load_modules
 import argparse
 import os.path
-import pandas as pd
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+## Set up variables
+STORE_LEVEL = "collInstr"
+PENDING_FILENAME = "config/collInstrPending_usageGenCollInstr.csv"
+
+## The sampling mode only counts the observations whose obsID starts with sample_digits f hex digits, i.e. a
+## deterministic sample of one in 16**sample_digits observations, and writes estimates with 95% Wilson confidence
+## intervals to SAMPLED_DIRECTORY instead of the exact counts. The sample is a range of the primary key, so the
+## database reads it from the obsID index instead of scanning every observation. The top of the obsID range is
+## sampled as the obsIDs converted from the older 64 bit identifiers all start with zero hex digits. The range does
+## not sample every collection/instrument the same way: those with few instances, or whose obsIDs are mostly such
+## legacy identifiers, have fewer sampled rows than expected. Their collections are counted exactly instead, with a
+## second query restricted to them, and the method of each row of the output is given in its method column.
+SAMPLE_PREDICATE = "caom2.Observation.obsID >= '{lower_bound}'"
+SAMPLED_DIRECTORY = "collInstrByField_sampled"
+SAMPLE_BATCH_SIZE = 50
+SAMPLE_MIN_ROWS = 30
+SAMPLE_MAX_DEFICIT_SIGMAS = 3
+CONFIDENCE_Z = 1.96
 
 ## Execute a query against the CAOM2 database and save the results to a CSV file.
 ## This function takes a SQL query, a field name, and a filename as arguments.
@@ -20,55 +44,277 @@ def execute_query(query, field, filename):
     results.to_csv(filename, index=True)
 
 ## Calculate the percentage of null values for each collection/instrument
-## combination in the results DataFrame.
+## combination in the results DataFrame. The number of instances is looked up
+## with a join on collection, instrument_name against the totals indexed by the same key.
+## The results are returned so that they can also be written to the usageStore.
 
 def calculate_percentages(filename, array_coll_instr):
     cp_results = pd.read_csv(filename)
 
     if len(cp_results) > 0:
-        cp_results['num_instances'] = cp_results.apply(lambda row: find_num_instances(row['collection'], row['instrument_name'], array_coll_instr), axis=1)
-        cp_results['percentage_null'] = cp_results.apply(lambda row: row['num_null'] * 100 / row['num_instances'], axis=1)
+        totals = array_coll_instr.drop_duplicates(subset=['collection', 'instrument_name'], keep='first').set_index(['collection', 'instrument_name'])['num_instances']
+        cp_results = cp_results.join(totals, on=['collection', 'instrument_name'])
+        cp_results['percentage_null'] = cp_results['num_null'] * 100 / cp_results['num_instances']
         cp_results['num_instances'] = cp_results['num_instances'].round(2)
         cp_results['percentage_null'] = cp_results['percentage_null'].round(2)
 
         cp_results.to_csv(filename, index=False)
 
+    return cp_results
 
-## Find the number of instances for a given collection and instrument name
-## in the array_coll_instr DataFrame.
-## This function is used to calculate the percentage of null values.
+## Read the collection/instruments that usagePrep found new, changed or removed since the last successful run
+## of this script.
 
-def find_num_instances(collection, instrument_name, array_coll_instr):
-    row = array_coll_instr[(array_coll_instr['collection'] == collection) & (array_coll_instr['instrument_name'] == instrument_name)]
-    return row['num_instances'].values[0]
+def read_pending_changes():
+    if not os.path.isfile(PENDING_FILENAME):
+        return pd.DataFrame(columns=['collection', 'instrument_name', 'status', 'detected'])
+    return pd.read_csv(PENDING_FILENAME, dtype=str)
+
+## Return the collections with a pending change.
+
+def read_changed_collections(pending):
+    return sorted(pending['collection'].unique().tolist())
+
+## Remove the changes read at the start of a successful run from the pending list, keeping the changes that
+## usagePrep added since.
+
+def consume_pending_changes(pending):
+    if len(pending) == 0 or not os.path.isfile(PENDING_FILENAME):
+        return
+    current = read_pending_changes()
+    consumed = current.merge(pending, how='left', indicator=True)['_merge'] == 'both'
+    remaining = current[~consumed.values]
+    remaining.to_csv(f"{PENDING_FILENAME}.tmp", index=False)
+    os.replace(f"{PENDING_FILENAME}.tmp", PENDING_FILENAME)
+    print(f"Removed {consumed.sum()} changes from {PENDING_FILENAME}, {len(remaining)} still pending")
+
+## Build the constraint restricting a query to the given collections, or no constraint for a full run.
+
+def collection_constraint(changed_collections):
+    if changed_collections is None:
+        return ""
+    collections = ", ".join(["'" + collection.replace("'", "''") + "'" for collection in changed_collections])
+    return f" and collection in ({collections})"
+
+## Merge the results of an incremental query for the changed collections into the previous results of a field.
+## The rows of the changed collections are replaced and the file is rewritten in the same format as execute_query
+## writes it, so that calculate_percentages recomputes the percentages of all the rows.
+
+def merge_previous_results(filename, previous_results, changed_collections):
+    results = pd.read_csv(filename, dtype={'collection': str, 'instrument_name': str})
+    kept_results = previous_results[~previous_results['collection'].isin(changed_collections)]
+    merged_results = pd.concat([kept_results[['collection', 'instrument_name', 'num_null']], results[['collection', 'instrument_name', 'num_null']]], ignore_index=True)
+    merged_results = merged_results.sort_values(['collection', 'instrument_name'], kind='stable').reset_index(drop=True)
+    merged_results.to_csv(filename, index=True)
+
+## Read the previous results of a field for an incremental run. A field without previous results needs a full
+## query, in which case None is returned.
+
+def read_previous_results(filename, changed_collections):
+    if changed_collections is None or not os.path.isfile(filename):
+        return None
+    return pd.read_csv(filename, dtype={'collection': str, 'instrument_name': str})
 
 ## Process the observation field and calculate the percentage of null values
 ## for each collection/instrument combination.
 ## This function is used to generate the CSV file for each field.
 
-def process_observation_field(field, array_coll_instr_obs, num_coll_instr_obs, sum_instances_coll_instr_obs):
+def process_observation_field(field, array_coll_instr_obs, num_coll_instr_obs, sum_instances_coll_instr_obs, changed_collections=None):
     filename = f"collInstrByField/{field}.csv"
+    previous_results = read_previous_results(filename, changed_collections)
+    constraint = collection_constraint(None if previous_results is None else changed_collections)
     query = f"""select collection, instrument_name, count(*) as num_null
         from caom2.Observation
-        where instrument_name is not null and instrument_name != 'NULL' and {field} is null
+        where instrument_name is not null and instrument_name != 'NULL' and {field} is null{constraint}
         group by collection, instrument_name
         order by collection, instrument_name"""
     execute_query(query, field, filename)
-    calculate_percentages(filename, array_coll_instr_obs)
+    if previous_results is not None:
+        merge_previous_results(filename, previous_results, changed_collections)
+    usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_coll_instr_obs))
 
 ## Process the plane field and calculate the percentage of null values
 ## for each collection/instrument combination.
 ## This function is used to generate the CSV file for each field.
 
-def process_plane_field(field, array_coll_instr_planes, num_coll_instr_planes, sum_instances_coll_instr_planes):
+def process_plane_field(field, array_coll_instr_planes, num_coll_instr_planes, sum_instances_coll_instr_planes, changed_collections=None):
     filename = f"collInstrByField/{field}.csv"
+    previous_results = read_previous_results(filename, changed_collections)
+    constraint = collection_constraint(None if previous_results is None else changed_collections)
     query = f"""select collection, instrument_name, count(*) as num_null
         from caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID
-        where instrument_name is not null and instrument_name != 'NULL' and {field} is null
+        where instrument_name is not null and instrument_name != 'NULL' and {field} is null{constraint}
         group by collection, instrument_name
         order by collection, instrument_name"""
     execute_query(query,field, filename)
-    calculate_percentages(filename, array_coll_instr_planes)
+    if previous_results is not None:
+        merge_previous_results(filename, previous_results, changed_collections)
+    usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_coll_instr_planes))
+
+## Return the lowest obsID of the sample, the UUID starting with sample_digits f hex digits followed by zeros.
+
+def sample_lower_bound(sample_digits):
+    digits = ("f" * sample_digits).ljust(32, "0")
+    return f"{digits[0:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:32]}"
+
+## Build a query counting the null values of a batch of fields of the same table in a single scan,
+## with one num_null_<index> column per field, restricted to the changed collections for an incremental run.
+## With sample_digits, only the sampled observations are counted and their number is returned as num_sampled, which
+## count_rows also returns for an exact count.
+
+def batch_query(table, fields, changed_collections=None, sample_digits=0, count_rows=False):
+    null_counts = ",\n        ".join([f"sum(case when {field} is null then 1 else 0 end) as num_null_{index}" for index, field in enumerate(fields)])
+    sample_constraint = ""
+    if sample_digits > 0 or count_rows:
+        null_counts = "count(*) as num_sampled,\n        " + null_counts
+    if sample_digits > 0:
+        sample_constraint = " and " + SAMPLE_PREDICATE.format(lower_bound=sample_lower_bound(sample_digits))
+    if table == "caom2.Observation":
+        from_clause = "caom2.Observation"
+    else:
+        from_clause = "caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID"
+    query = f"""select collection, instrument_name,
+        {null_counts}
+        from {from_clause}
+        where instrument_name is not null and instrument_name != 'NULL'{collection_constraint(changed_collections)}{sample_constraint}
+        group by collection, instrument_name
+        order by collection, instrument_name"""
+    return query
+
+## Process a batch of fields with one query and split the results into the same per-field CSV files
+## as process_observation_field and process_plane_field. Each batch uses its own service so that
+## batches can run concurrently. For an incremental run, every field of the batch must have previous results.
+
+def process_field_batch(table, fields, array_coll_instr, changed_collections=None):
+    from astroquery.cadc import Cadc
+    batch_service = Cadc()
+    job = batch_service.create_async(batch_query(table, fields, changed_collections))
+    print(f"Job ID link for {len(fields)} {table} fields from {fields[0]}: https://ws.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/argus/async/{job.job_id}")
+    job.run().wait()
+    job.raise_if_error()
+    results = job.fetch_result().to_table().to_pandas()
+
+    for index, field in enumerate(fields):
+        num_null = results[f"num_null_{index}"].fillna(0).astype('int64')
+        field_results = results.loc[num_null > 0, ['collection', 'instrument_name']].reset_index(drop=True)
+        field_results['num_null'] = num_null[num_null > 0].values
+        filename = f"collInstrByField/{field}.csv"
+        previous_results = read_previous_results(filename, changed_collections)
+        field_results.to_csv(filename, index=True)
+        if previous_results is not None:
+            merge_previous_results(filename, previous_results, changed_collections)
+        usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_coll_instr))
+    print(f"Completed batch of {len(fields)} {table} fields from {fields[0]} to {fields[-1]}")
+
+## Estimate the percentage of null values of each collection/instrument from the sampled rows, with the 95% Wilson
+## score interval of the percentage. The estimated number of null values scales the sampled fraction to all instances.
+## For caom2.Plane fields all the planes of a sampled observation are counted, so the interval is approximate there.
+## The rows counted exactly have their exact percentage as both bounds, and the rows without any counted instance
+## have no estimate.
+
+def estimate_percentages(sampled_results):
+    estimates = sampled_results.copy()
+    num_sampled = estimates['num_sampled'].where(estimates['num_sampled'] > 0)
+    fraction = estimates['num_null'] / num_sampled
+    z2 = CONFIDENCE_Z * CONFIDENCE_Z
+    centre = (fraction + z2 / (2 * num_sampled)) / (1 + z2 / num_sampled)
+    half_width = CONFIDENCE_Z * np.sqrt(fraction * (1 - fraction) / num_sampled + z2 / (4 * num_sampled * num_sampled)) / (1 + z2 / num_sampled)
+    estimates['estimated_num_null'] = (fraction * estimates['num_instances']).round().astype('Int64')
+    estimates['percentage_null'] = (fraction * 100).round(2)
+    estimates['percentage_null_low'] = ((centre - half_width).clip(lower=0) * 100).round(2)
+    estimates['percentage_null_high'] = ((centre + half_width).clip(upper=1) * 100).round(2)
+    exact = estimates['method'] == 'exact'
+    estimates.loc[exact, 'percentage_null_low'] = estimates.loc[exact, 'percentage_null']
+    estimates.loc[exact, 'percentage_null_high'] = estimates.loc[exact, 'percentage_null']
+    return estimates
+
+## Return whether each collection/instrument has too few sampled rows for an estimate: fewer than SAMPLE_MIN_ROWS, or
+## SAMPLE_MAX_DEFICIT_SIGMAS standard deviations fewer than expected from its number of instances, as when most of
+## its obsIDs are outside the sampled range.
+
+def undersampled(results, sample_digits):
+    expected = results['num_instances'] / 16 ** sample_digits
+    return (results['num_sampled'] < SAMPLE_MIN_ROWS) | (results['num_sampled'] < expected - SAMPLE_MAX_DEFICIT_SIGMAS * np.sqrt(expected))
+
+## Run a batch query with its own service and return the results as a DataFrame.
+
+def run_batch_query(query, description):
+    from astroquery.cadc import Cadc
+    batch_service = Cadc()
+    job = batch_service.create_async(query)
+    print(f"Job ID link for {description}: https://ws.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/argus/async/{job.job_id}")
+    job.run().wait()
+    job.raise_if_error()
+    return job.fetch_result().to_table().to_pandas()
+
+## Process a batch of fields with one sampling query and write the estimates of each field to SAMPLED_DIRECTORY, with
+## one row for every collection/instrument of the totals. The collections with an undersampled collection/instrument
+## are counted exactly with a second query.
+
+def process_sampled_batch(table, fields, array_coll_instr, sample_digits):
+    keys = ['collection', 'instrument_name']
+    null_columns = [f"num_null_{index}" for index in range(len(fields))]
+    results = array_coll_instr.drop_duplicates(subset=keys, keep='first')[keys + ['num_instances']].reset_index(drop=True)
+
+    sampled = run_batch_query(batch_query(table, fields, sample_digits=sample_digits), f"{len(fields)} sampled {table} fields from {fields[0]}")
+    results = results.merge(sampled[keys + ['num_sampled'] + null_columns], on=keys, how='left')
+    results[['num_sampled'] + null_columns] = results[['num_sampled'] + null_columns].fillna(0).astype('int64')
+    results['method'] = 'sampled'
+
+    exact_collections = sorted(results.loc[undersampled(results, sample_digits), 'collection'].unique().tolist())
+    if len(exact_collections) > 0:
+        print(f"Counting {len(exact_collections)} collections with undersampled {table} collection/instruments exactly")
+        exact = run_batch_query(batch_query(table, fields, exact_collections, count_rows=True), f"{len(fields)} exact {table} fields of {len(exact_collections)} collections from {fields[0]}")
+        exact = results.loc[results['collection'].isin(exact_collections), keys + ['num_instances']].merge(
+            exact[keys + ['num_sampled'] + null_columns], on=keys, how='left')
+        exact[['num_sampled'] + null_columns] = exact[['num_sampled'] + null_columns].fillna(0).astype('int64')
+        exact['method'] = 'exact'
+        results = pd.concat([results[~results['collection'].isin(exact_collections)], exact], ignore_index=True).sort_values(keys, kind='stable')
+
+    results.loc[results['num_sampled'] == 0, 'method'] = 'unsampled'
+    num_unsampled = (results['method'] == 'unsampled').sum()
+    if num_unsampled > 0:
+        print(f"No instance counted for {num_unsampled} {table} collection/instruments, which have no estimate")
+
+    for index, field in enumerate(fields):
+        sampled_results = results[keys + ['num_sampled', 'num_instances', 'method']].copy()
+        sampled_results['num_null'] = results[f"num_null_{index}"]
+        estimates = estimate_percentages(sampled_results)
+        estimates.to_csv(f"{SAMPLED_DIRECTORY}/{field}.csv", index=False, columns=[
+            'collection', 'instrument_name', 'method', 'num_sampled', 'num_null', 'num_instances', 'estimated_num_null',
+            'percentage_null', 'percentage_null_low', 'percentage_null_high'])
+    print(f"Completed sampled batch of {len(fields)} {table} fields from {fields[0]} to {fields[-1]}")
+
+## Process the fields in batches of batch_size fields of the same table, running up to jobs batches concurrently.
+## With sample_digits, the batches are sampled instead of counted exactly.
+
+def process_fields_batched(fields, batch_size, jobs, array_coll_instr_obs, array_coll_instr_planes, changed_collections=None, sample_digits=0):
+    batches = []
+    for table, array_coll_instr in [("caom2.Observation", array_coll_instr_obs), ("caom2.Plane", array_coll_instr_planes)]:
+        table_fields = [field for field in fields if field.startswith(f"{table}.")]
+        for start in range(0, len(table_fields), batch_size):
+            batches.append((table, table_fields[start:start + batch_size], array_coll_instr))
+
+    print(f"Processing {len(fields)} fields in {len(batches)} batches with up to {jobs} concurrent jobs")
+    error = False
+
+    ## The batches are the first to use polars, through usageStore, so the modules used by the batches are loaded
+    ## first on the main thread, see lazyImport.
+    load_modules(usageStore.pl, pd, np)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if sample_digits > 0:
+            futures = [executor.submit(process_sampled_batch, table, batch_fields, array_coll_instr, sample_digits) for table, batch_fields, array_coll_instr in batches]
+        else:
+            futures = [executor.submit(process_field_batch, table, batch_fields, array_coll_instr, changed_collections) for table, batch_fields, array_coll_instr in batches]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing batch: {e}")
+                error = True
+
+    if error:
+        exit(255)
 
 ## Main function to execute the script.
 ## It initializes the data structures for pre-generated collection/instrument
@@ -76,6 +322,10 @@ def process_plane_field(field, array_coll_instr_planes, num_coll_instr_planes, s
 ## It then loops through the list of fields and processes them.
 ## The script takes two command-line arguments: start field and end field.
 ## The script will process all fields between the start and end fields, inclusive.
+## With --batch-size, the null values of that many fields are counted by each query
+## and up to --jobs queries are run concurrently.
+## With --incremental, only the collections changed since the previous run of usagePrep are queried.
+## With --sample-digits, the null values are estimated from a deterministic sample of the observations.
 ## The script will exit with a status code of 0 if successful, or 255 if an error occurs.
 
 if __name__ == "__main__":
@@ -97,6 +347,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--start", default="caom2.Observation.accMetaChecksum", help="Start field")
     parser.add_argument("-e", "--end", default="caom2.Plane.time_sampleSize", help="End field")
+    parser.add_argument("-b", "--batch-size", type=int, default=0, help="Number of fields counted per query, 0 for one query per field")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of batch queries run concurrently")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip fields whose CSV file already exists")
+    parser.add_argument("--sample-digits", type=int, default=0, help=f"Estimate from the observations whose obsID starts with that many f hex digits, writing to {SAMPLED_DIRECTORY}")
+    parser.add_argument("--incremental", action="store_true", help=f"Only query the collections listed in {PENDING_FILENAME} by usagePrep and merge the results")
     args = parser.parse_args()
 
     start_field = args.start
@@ -128,8 +383,9 @@ if __name__ == "__main__":
     ## Now loop through the the list of field and process them.
 
     print(f"Execute from {start_field} to {end_field}")
-    service = Cadc()
 
+    output_directory = SAMPLED_DIRECTORY if args.sample_digits > 0 else "collInstrByField"
+    fields_to_process = []
     for index, row in field_names.iterrows():
         field = row['field_name']
 
@@ -137,15 +393,74 @@ if __name__ == "__main__":
             started = True
 
         if started:
-            if field.startswith("caom2.Observation."):
-                print(f"processObservationField {field}")
-                process_observation_field(field, array_coll_instr_obs, num_coll_instr_obs, sum_instances_coll_instr_obs)
-            elif field.startswith("caom2.Plane."):
-                print(f"processPlaneField {field}")
-                process_plane_field(field, array_coll_instr_planes, num_coll_instr_planes, sum_instances_coll_instr_planes)
-            else:
+            if not field.startswith("caom2.Observation.") and not field.startswith("caom2.Plane."):
                 print(f"Unknown field {field}")
                 exit(255)
+            if args.skip_existing and os.path.isfile(f"{output_directory}/{field}.csv"):
+                print(f"Skipping {field} as {output_directory}/{field}.csv exists")
+            else:
+                fields_to_process.append(field)
 
         if field == end_field:
-            exit(0)
+            break
+
+    ## The pending changes are only consumed by a run that processes all the fields.
+
+    pending = read_pending_changes()
+    all_fields = len(fields_to_process) == num_fields
+
+    ## With --sample-digits, estimate the null values of all the fields from the sample, in batches.
+
+    if args.sample_digits > 0:
+        if args.incremental:
+            print("The --incremental and --sample-digits options cannot be combined")
+            exit(255)
+        os.makedirs(SAMPLED_DIRECTORY, exist_ok=True)
+        print(f"Sampling one in {16 ** args.sample_digits} observations")
+        process_fields_batched(fields_to_process, args.batch_size if args.batch_size > 0 else SAMPLE_BATCH_SIZE, args.jobs, array_coll_instr_obs, array_coll_instr_planes, sample_digits=args.sample_digits)
+        exit(0)
+
+    ## With --incremental, the fields with previous results are only queried for the changed collections and the
+    ## results are merged into their CSV files. The fields without previous results still need a full query.
+
+    changed_collections = None
+    incremental_fields = []
+    if args.incremental:
+        changed_collections = read_changed_collections(pending)
+        print(f"Number of changed collections in {PENDING_FILENAME}: {len(changed_collections)}")
+        incremental_fields = [field for field in fields_to_process if os.path.isfile(f"collInstrByField/{field}.csv")]
+        if len(changed_collections) == 0:
+            print("No collections have changed, only the fields without previous results are processed")
+            fields_to_process = [field for field in fields_to_process if field not in incremental_fields]
+            incremental_fields = []
+
+    ## Either count the null values of many fields per query, running the batches concurrently,
+    ## or run one query per field.
+
+    if args.batch_size > 0:
+        full_fields = [field for field in fields_to_process if field not in incremental_fields]
+        if len(full_fields) > 0:
+            process_fields_batched(full_fields, args.batch_size, args.jobs, array_coll_instr_obs, array_coll_instr_planes)
+        if len(incremental_fields) > 0:
+            process_fields_batched(incremental_fields, args.batch_size, args.jobs, array_coll_instr_obs, array_coll_instr_planes, changed_collections)
+    else:
+        from astroquery.cadc import Cadc
+        service = Cadc()
+
+        for field in fields_to_process:
+            if field.startswith("caom2.Observation."):
+                print(f"processObservationField {field}")
+                process_observation_field(field, array_coll_instr_obs, num_coll_instr_obs, sum_instances_coll_instr_obs, changed_collections)
+            else:
+                print(f"processPlaneField {field}")
+                process_plane_field(field, array_coll_instr_planes, num_coll_instr_planes, sum_instances_coll_instr_planes, changed_collections)
+
+    ## Every field has been processed, either in full or for the changed collections, so the pending changes read
+    ## at the start of the run have been taken into account.
+
+    if all_fields:
+        consume_pending_changes(pending)
+    elif len(pending) > 0:
+        print(f"Not all the fields were processed, the changes in {PENDING_FILENAME} are kept for the next run")
+
+    exit(0)
@@ -1,10 +1,18 @@
 # This script is used to generate CSV files containing the percentage of null values
 # for each collection combination in the caom2.Observation and caom2.Plane tables.
 
-from astroquery.cadc import Cadc
+from concurrent.futures import ThreadPoolExecutor
+from lazyImport import lazy_import, load_modules
 import argparse
 import os.path
-import pandas as pd
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pd = lazy_import("pandas")
+
+## Set up variables
+STORE_LEVEL = "collection"
+PENDING_FILENAME = "config/collInstrPending_usageGenCollection.csv"
 
 ## Execute a query against the CAOM2 database and save the results to a CSV file.
 ## This function takes a SQL query, a field name, and a filename as arguments.
@@ -20,55 +28,181 @@ def execute_query(query, field, filename):
     results.to_csv(filename, index=True)
 
 ## Calculate the percentage of null values for each collection
-## combination in the results DataFrame.
+## combination in the results DataFrame. The number of instances is looked up
+## with a join on collection against the totals indexed by the same key.
+## The results are returned so that they can also be written to the usageStore.
 
 def calculate_percentages(filename, array_collection):
     cp_results = pd.read_csv(filename)
 
     if len(cp_results) > 0:
-        cp_results['num_instances'] = cp_results.apply(lambda row: find_num_instances(row['collection'], array_collection), axis=1)
-        cp_results['percentage_null'] = cp_results.apply(lambda row: row['num_null'] * 100 / row['num_instances'], axis=1)
+        totals = array_collection.drop_duplicates(subset=['collection'], keep='first').set_index(['collection'])['num_instances']
+        cp_results = cp_results.join(totals, on=['collection'])
+        cp_results['percentage_null'] = cp_results['num_null'] * 100 / cp_results['num_instances']
         cp_results['num_instances'] = cp_results['num_instances'].round(2)
         cp_results['percentage_null'] = cp_results['percentage_null'].round(2)
 
         cp_results.to_csv(filename, index=False)
 
+    return cp_results
+
+## Read the collection/instruments that usagePrep found new, changed or removed since the last successful run
+## of this script.
+
+def read_pending_changes():
+    if not os.path.isfile(PENDING_FILENAME):
+        return pd.DataFrame(columns=['collection', 'instrument_name', 'status', 'detected'])
+    return pd.read_csv(PENDING_FILENAME, dtype=str)
+
+## Return the collections with a pending change.
+
+def read_changed_collections(pending):
+    return sorted(pending['collection'].unique().tolist())
+
+## Remove the changes read at the start of a successful run from the pending list, keeping the changes that
+## usagePrep added since.
+
+def consume_pending_changes(pending):
+    if len(pending) == 0 or not os.path.isfile(PENDING_FILENAME):
+        return
+    current = read_pending_changes()
+    consumed = current.merge(pending, how='left', indicator=True)['_merge'] == 'both'
+    remaining = current[~consumed.values]
+    remaining.to_csv(f"{PENDING_FILENAME}.tmp", index=False)
+    os.replace(f"{PENDING_FILENAME}.tmp", PENDING_FILENAME)
+    print(f"Removed {consumed.sum()} changes from {PENDING_FILENAME}, {len(remaining)} still pending")
+
+## Build the constraint restricting a query to the given collections, or no constraint for a full run.
+
+def collection_constraint(changed_collections):
+    if changed_collections is None:
+        return ""
+    collections = ", ".join(["'" + collection.replace("'", "''") + "'" for collection in changed_collections])
+    return f" and collection in ({collections})"
 
-## Find the number of instances for a given collection
-## in the array_collection DataFrame.
-## This function is used to calculate the percentage of null values.
+## Merge the results of an incremental query for the changed collections into the previous results of a field.
+## The rows of the changed collections are replaced and the file is rewritten in the same format as execute_query
+## writes it, so that calculate_percentages recomputes the percentages of all the rows.
 
-def find_num_instances(collection, array_collection):
-    row = array_collection[(array_collection['collection'] == collection)]
-    return row['num_instances'].values[0]
+def merge_previous_results(filename, previous_results, changed_collections):
+    results = pd.read_csv(filename, dtype={'collection': str})
+    kept_results = previous_results[~previous_results['collection'].isin(changed_collections)]
+    merged_results = pd.concat([kept_results[['collection', 'num_null']], results[['collection', 'num_null']]], ignore_index=True)
+    merged_results = merged_results.sort_values(['collection'], kind='stable').reset_index(drop=True)
+    merged_results.to_csv(filename, index=True)
+
+## Read the previous results of a field for an incremental run. A field without previous results needs a full
+## query, in which case None is returned.
+
+def read_previous_results(filename, changed_collections):
+    if changed_collections is None or not os.path.isfile(filename):
+        return None
+    return pd.read_csv(filename, dtype={'collection': str})
 
 ## Process the observation field and calculate the percentage of null values
 ## for each collection combination.
 ## This function is used to generate the CSV file for each field.
 
-def process_observation_field(field, array_collection_obs, num_collection_obs, sum_instances_collection_obs):
+def process_observation_field(field, array_collection_obs, num_collection_obs, sum_instances_collection_obs, changed_collections=None):
     filename = f"collectionByField/{field}.csv"
+    previous_results = read_previous_results(filename, changed_collections)
+    constraint = collection_constraint(None if previous_results is None else changed_collections)
     query = f"""select collection, count(*) as num_null
         from caom2.Observation
-        where instrument_name is not null and instrument_name != 'NULL' and {field} is null
+        where instrument_name is not null and instrument_name != 'NULL' and {field} is null{constraint}
         group by collection
         order by collection"""
     execute_query(query, field, filename)
-    calculate_percentages(filename, array_collection_obs)
+    if previous_results is not None:
+        merge_previous_results(filename, previous_results, changed_collections)
+    usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_collection_obs))
 
 ## Process the plane field and calculate the percentage of null values
 ## for each collection combination.
 ## This function is used to generate the CSV file for each field.
 
-def process_plane_field(field, array_collection_planes, num_collection_planes, sum_instances_collection_planes):
+def process_plane_field(field, array_collection_planes, num_collection_planes, sum_instances_collection_planes, changed_collections=None):
     filename = f"collectionByField/{field}.csv"
+    previous_results = read_previous_results(filename, changed_collections)
+    constraint = collection_constraint(None if previous_results is None else changed_collections)
     query = f"""select collection, count(*) as num_null
         from caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID
-        where instrument_name is not null and instrument_name != 'NULL' and {field} is null
+        where instrument_name is not null and instrument_name != 'NULL' and {field} is null{constraint}
         group by collection
         order by collection"""
     execute_query(query,field, filename)
-    calculate_percentages(filename, array_collection_planes)
+    if previous_results is not None:
+        merge_previous_results(filename, previous_results, changed_collections)
+    usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_collection_planes))
+
+## Build a query counting the null values of a batch of fields of the same table in a single scan,
+## with one num_null_<index> column per field, restricted to the changed collections for an incremental run.
+
+def batch_query(table, fields, changed_collections=None):
+    null_counts = ",\n        ".join([f"sum(case when {field} is null then 1 else 0 end) as num_null_{index}" for index, field in enumerate(fields)])
+    if table == "caom2.Observation":
+        from_clause = "caom2.Observation"
+    else:
+        from_clause = "caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID"
+    query = f"""select collection,
+        {null_counts}
+        from {from_clause}
+        where instrument_name is not null and instrument_name != 'NULL'{collection_constraint(changed_collections)}
+        group by collection
+        order by collection"""
+    return query
+
+## Process a batch of fields with one query and split the results into the same per-field CSV files
+## as process_observation_field and process_plane_field. Each batch uses its own service so that
+## batches can run concurrently. For an incremental run, every field of the batch must have previous results.
+
+def process_field_batch(table, fields, array_collection, changed_collections=None):
+    from astroquery.cadc import Cadc
+    batch_service = Cadc()
+    job = batch_service.create_async(batch_query(table, fields, changed_collections))
+    print(f"Job ID link for {len(fields)} {table} fields from {fields[0]}: https://ws.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/argus/async/{job.job_id}")
+    job.run().wait()
+    job.raise_if_error()
+    results = job.fetch_result().to_table().to_pandas()
+
+    for index, field in enumerate(fields):
+        num_null = results[f"num_null_{index}"].fillna(0).astype('int64')
+        field_results = results.loc[num_null > 0, ['collection']].reset_index(drop=True)
+        field_results['num_null'] = num_null[num_null > 0].values
+        filename = f"collectionByField/{field}.csv"
+        previous_results = read_previous_results(filename, changed_collections)
+        field_results.to_csv(filename, index=True)
+        if previous_results is not None:
+            merge_previous_results(filename, previous_results, changed_collections)
+        usageStore.write_field(STORE_LEVEL, field, calculate_percentages(filename, array_collection))
+    print(f"Completed batch of {len(fields)} {table} fields from {fields[0]} to {fields[-1]}")
+
+## Process the fields in batches of batch_size fields of the same table, running up to jobs batches concurrently.
+
+def process_fields_batched(fields, batch_size, jobs, array_collection_obs, array_collection_planes, changed_collections=None):
+    batches = []
+    for table, array_collection in [("caom2.Observation", array_collection_obs), ("caom2.Plane", array_collection_planes)]:
+        table_fields = [field for field in fields if field.startswith(f"{table}.")]
+        for start in range(0, len(table_fields), batch_size):
+            batches.append((table, table_fields[start:start + batch_size], array_collection))
+
+    print(f"Processing {len(fields)} fields in {len(batches)} batches with up to {jobs} concurrent jobs")
+    error = False
+
+    ## The batches are the first to use polars, through usageStore, so the modules used by the batches are loaded
+    ## first on the main thread, see lazyImport.
+    load_modules(usageStore.pl, pd)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(process_field_batch, table, batch_fields, array_collection, changed_collections) for table, batch_fields, array_collection in batches]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error processing batch: {e}")
+                error = True
+
+    if error:
+        exit(255)
 
 ## Main function to execute the script.
 ## It initializes the data structures for pre-generated collection
@@ -76,6 +210,9 @@ def process_plane_field(field, array_collection_planes, num_collection_planes, s
 ## It then loops through the list of fields and processes them.
 ## The script takes two command-line arguments: start field and end field.
 ## The script will process all fields between the start and end fields, inclusive.
+## With --batch-size, the null values of that many fields are counted by each query
+## and up to --jobs queries are run concurrently.
+## With --incremental, only the collections changed since the previous run of usagePrep are queried.
 ## The script will exit with a status code of 0 if successful, or 255 if an error occurs.
 
 if __name__ == "__main__":
@@ -97,6 +234,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--start", default="caom2.Observation.accMetaChecksum", help="Start field")
     parser.add_argument("-e", "--end", default="caom2.Plane.time_sampleSize", help="End field")
+    parser.add_argument("-b", "--batch-size", type=int, default=0, help="Number of fields counted per query, 0 for one query per field")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of batch queries run concurrently")
+    parser.add_argument("--skip-existing", action="store_true", help="Skip fields whose CSV file already exists")
+    parser.add_argument("--incremental", action="store_true", help=f"Only query the collections listed in {PENDING_FILENAME} by usagePrep and merge the results")
     args = parser.parse_args()
 
     start_field = args.start
@@ -128,8 +269,8 @@ if __name__ == "__main__":
 ## Now loop through the the list of field and process them.
 
     print(f"Execute from {start_field} to {end_field}")
-    service = Cadc()
 
+    fields_to_process = []
     for index, row in field_names.iterrows():
         field = row['field_name']
 
@@ -137,15 +278,63 @@ if __name__ == "__main__":
             started = True
 
         if started:
-            if field.startswith("caom2.Observation."):
-                print(f"processObservationField {field}")
-                process_observation_field(field, array_collection_obs, num_collection_obs, sum_instances_collection_obs)
-            elif field.startswith("caom2.Plane."):
-                print(f"processPlaneField {field}")
-                process_plane_field(field, array_collection_planes, num_collection_planes, sum_instances_collection_planes)
-            else:
+            if not field.startswith("caom2.Observation.") and not field.startswith("caom2.Plane."):
                 print(f"Unknown field {field}")
                 exit(255)
+            if args.skip_existing and os.path.isfile(f"collectionByField/{field}.csv"):
+                print(f"Skipping {field} as collectionByField/{field}.csv exists")
+            else:
+                fields_to_process.append(field)
 
         if field == end_field:
-            exit(0)
+            break
+
+    ## The pending changes are only consumed by a run that processes all the fields.
+
+    pending = read_pending_changes()
+    all_fields = len(fields_to_process) == num_fields
+
+    ## With --incremental, the fields with previous results are only queried for the changed collections and the
+    ## results are merged into their CSV files. The fields without previous results still need a full query.
+
+    changed_collections = None
+    incremental_fields = []
+    if args.incremental:
+        changed_collections = read_changed_collections(pending)
+        print(f"Number of changed collections in {PENDING_FILENAME}: {len(changed_collections)}")
+        incremental_fields = [field for field in fields_to_process if os.path.isfile(f"collectionByField/{field}.csv")]
+        if len(changed_collections) == 0:
+            print("No collections have changed, only the fields without previous results are processed")
+            fields_to_process = [field for field in fields_to_process if field not in incremental_fields]
+            incremental_fields = []
+
+    ## Either count the null values of many fields per query, running the batches concurrently,
+    ## or run one query per field.
+
+    if args.batch_size > 0:
+        full_fields = [field for field in fields_to_process if field not in incremental_fields]
+        if len(full_fields) > 0:
+            process_fields_batched(full_fields, args.batch_size, args.jobs, array_collection_obs, array_collection_planes)
+        if len(incremental_fields) > 0:
+            process_fields_batched(incremental_fields, args.batch_size, args.jobs, array_collection_obs, array_collection_planes, changed_collections)
+    else:
+        from astroquery.cadc import Cadc
+        service = Cadc()
+
+        for field in fields_to_process:
+            if field.startswith("caom2.Observation."):
+                print(f"processObservationField {field}")
+                process_observation_field(field, array_collection_obs, num_collection_obs, sum_instances_collection_obs, changed_collections)
+            else:
+                print(f"processPlaneField {field}")
+                process_plane_field(field, array_collection_planes, num_collection_planes, sum_instances_collection_planes, changed_collections)
+
+    ## Every field has been processed, either in full or for the changed collections, so the pending changes read
+    ## at the start of the run have been taken into account.
+
+    if all_fields:
+        consume_pending_changes(pending)
+    elif len(pending) > 0:
+        print(f"Not all the fields were processed, the changes in {PENDING_FILENAME} are kept for the next run")
+
+    exit(0)
@@ -1,8 +1,44 @@
+from lazyImport import lazy_import
 # This script is used to generate CSV files per collection containing the fields and counts of null values for all
 # fields in caom2.Observation and caom2.Plane tables.
 
-import pandas as pd
+import argparse
 import os.path
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pd = lazy_import("pandas")
+pl = lazy_import("polars")
+
+## Set up variables
+STORE_LEVEL = "collInstr"
+
+## Load every field CSV file once into one long table with a Field column, keeping the order of the
+## fields. Fields without any null values have no rows and are skipped.
+
+def load_field_results(field_names):
+    field_results = []
+    for index, row in field_names.iterrows():
+        field = row['field_name']
+        field_filename = f"collInstrByField/{field}.csv"
+        if os.path.isfile(field_filename):
+            results = pd.read_csv(field_filename, dtype={'collection': str, 'instrument_name': str})
+            if len(results) > 0:
+                results.insert(0, 'Field', field)
+                field_results.append(results[['Field', 'collection', 'instrument_name', 'num_null', 'num_instances', 'percentage_null']])
+
+    if len(field_results) == 0:
+        return pd.DataFrame(columns=['Field', 'collection', 'instrument_name', 'num_null', 'num_instances', 'percentage_null'])
+    return pd.concat(field_results, ignore_index=True).drop_duplicates(subset=['Field', 'collection', 'instrument_name'], keep='first')
+
+## Load the field results from the usageStore instead, in the same order and with the same columns
+## as load_field_results.
+
+def load_store_results(field_names):
+    field_order = pl.DataFrame({'field': field_names['field_name'].tolist()}, schema={'field': pl.String}).with_row_index('order').unique(subset=['field'], keep='first')
+    store_results = usageStore.load(STORE_LEVEL).join(field_order, on='field', how='inner').sort('order', maintain_order=True)
+    store_results = store_results.select(pl.col('field').alias('Field'), 'collection', 'instrument_name', 'num_null', 'num_instances', 'percentage_null')
+    return pd.DataFrame(store_results.to_dict(as_series=False), columns=store_results.columns).drop_duplicates(subset=['Field', 'collection', 'instrument_name'], keep='first')
 
 if __name__ == "__main__":
 
@@ -16,17 +52,29 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-store", action="store_true", help="Read the field results from the usageStore instead of the per-field CSV files")
+    args = parser.parse_args()
+
 ## Initialize the data structure for pre-generated collection counts for observations.
 
     obs_filename = "config/collInstrTotalObs.csv"
-    array_collection_obs = pd.read_csv(obs_filename)
+    array_collection_obs = pd.read_csv(obs_filename, dtype={'collection': str, 'instrument_name': str})
 
 ## Initialize lists of fields to be checked for null values.
 
     fields_filename = "config/fieldNames.csv"
     field_names = pd.read_csv(fields_filename)
 
-## Now loop through the the list of collections and process them
+## Load all the field results once, then split them by collection/instrument and write each file in one pass.
+
+    if args.from_store:
+        field_results = load_store_results(field_names)
+        print(f"Loaded {len(field_results)} field results from the usageStore")
+    else:
+        field_results = load_field_results(field_names)
+        print(f"Loaded {len(field_results)} field results from collInstrByField")
+    collInstr_results = {key: group for key, group in field_results.groupby(['collection', 'instrument_name'], sort=False)}
 
     for index, row in array_collection_obs.iterrows():
         collection = row['collection']
@@ -37,20 +85,7 @@ if __name__ == "__main__":
         collInstr_filename = f"fieldByCollInstr/{collection}.{instrument_for_filename}.csv"
 
         with open(collInstr_filename, 'w') as f:
-           f.write("Field,num_null,num_instances,percentage_null\n")
-
-        ## loop through all the fields
-
-        for index, row in field_names.iterrows():
-            field = row['field_name']
-            field_filename = f"collInstrByField/{field}.csv"
-            if os.path.isfile(field_filename):
-                results = pd.read_csv(field_filename)
-                row = results[(results['collection'] == collection) & (results['instrument_name'] == instrument_name)]
-                if len(row) >  0:
-                    num_null = row['num_null'].values[0]
-                    num_instances = row['num_instances'].values[0]
-                    percentage_null = row['percentage_null'].values[0]
-
-                    with open(collInstr_filename, 'a') as f:
-                        f.write(f"{field},{num_null},{num_instances},{percentage_null}\n")
\ No newline at end of file
+            f.write("Field,num_null,num_instances,percentage_null\n")
+            results = collInstr_results.get((collection, instrument_name))
+            if results is not None:
+                results[['Field', 'num_null', 'num_instances', 'percentage_null']].to_csv(f, header=False, index=False)
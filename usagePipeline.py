@@ -0,0 +1,234 @@
+# This script runs the caom2usage workflow, usagePrep -> usageGen* -> usageGenFieldBy* -> usageSum*, as a graph of
+# tasks with input and output files. Independent tasks run in parallel, tasks whose outputs are newer than their inputs
+# are skipped, and a failed task only stops the tasks that depend on it, so re-running the pipeline after a failure
+# resumes where it stopped. The output of each task is written to a log file and the timings are reported per stage.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+import subprocess
+import argparse
+import shlex
+import glob
+import time
+import sys
+import os
+
+## Set up variables
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TIME_STAMP = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+LOG_DIRECTORY = f"logs/usagePipeline-{TIME_STAMP}"
+
+## The tasks of the pipeline. The inputs and outputs are glob patterns relative to the caom2usage directory, and
+## a task is up to date when every output pattern matches a file and its oldest output is newer than its newest input.
+## A task without inputs, i.e. usagePrep which queries the archive, is only re-run when it is forced.
+TASKS = [
+    {"name": "usagePrep", "stage": "prep", "script": "usagePrep.py", "depends": [],
+     "inputs": [],
+     "outputs": ["config/fieldNames.csv", "config/collInstrTotalObs.csv", "config/collInstrTotalPlanes.csv",
+                 "config/collectionTotalObs.csv", "config/collectionTotalPlanes.csv", "config/collInstrChanged.csv"]},
+    {"name": "usageGenCollInstr", "stage": "gen", "script": "usageGenCollInstr.py", "depends": ["usagePrep"],
+     "inputs": ["config/fieldNames.csv", "config/collInstrTotalObs.csv", "config/collInstrTotalPlanes.csv"],
+     "outputs": ["collInstrByField/caom2.*.csv"]},
+    {"name": "usageGenCollection", "stage": "gen", "script": "usageGenCollection.py", "depends": ["usagePrep"],
+     "inputs": ["config/fieldNames.csv", "config/collectionTotalObs.csv", "config/collectionTotalPlanes.csv"],
+     "outputs": ["collectionByField/caom2.*.csv"]},
+    {"name": "usageGenFieldByCollInstr", "stage": "genFieldBy", "script": "usageGenFieldByCollInstr.py", "depends": ["usageGenCollInstr"],
+     "inputs": ["config/fieldNames.csv", "config/collInstrTotalObs.csv", "collInstrByField/caom2.*.csv"],
+     "outputs": ["fieldByCollInstr/*.*.csv"]},
+    {"name": "usageGenFieldByCollection", "stage": "genFieldBy", "script": "usageGenFieldByCollection.py", "depends": ["usageGenCollection"],
+     "inputs": ["config/fieldNames.csv", "config/collectionTotalObs.csv", "collectionByField/caom2.*.csv"],
+     "outputs": ["fieldByCollection/*.csv"], "exclude": ["fieldByCollection/sumFieldByCollection.csv"]},
+    {"name": "usageSumCollInstr", "stage": "sum", "script": "usageSumCollInstr.py", "depends": ["usageGenCollInstr"],
+     "inputs": ["config/fieldNames.csv", "config/collInstrTotalObs.csv", "config/collInstrTotalPlanes.csv", "collInstrByField/caom2.*.csv"],
+     "outputs": ["collInstrByField/sumCollInstrByField.csv"]},
+    {"name": "usageSumCollection", "stage": "sum", "script": "usageSumCollection.py", "depends": ["usageGenCollection"],
+     "inputs": ["config/fieldNames.csv", "config/collectionTotalObs.csv", "config/collectionTotalPlanes.csv", "collectionByField/caom2.*.csv"],
+     "outputs": ["collectionByField/sumCollectionByField.csv"]},
+    {"name": "usageSumFieldByCollInstr", "stage": "sum", "script": "usageSumFieldByCollInstr.py", "depends": ["usageGenFieldByCollInstr"],
+     "inputs": ["config/fieldNames.csv", "config/collInstrTotalObs.csv", "config/collInstrTotalPlanes.csv", "fieldByCollInstr/*.*.csv"],
+     "outputs": ["fieldByCollInstr/sumFieldByCollInstr.csv"]},
+    {"name": "usageSumFieldByCollection", "stage": "sum", "script": "usageSumFieldByCollection.py", "depends": ["usageGenFieldByCollection"],
+     "inputs": ["config/fieldNames.csv", "config/collectionTotalObs.csv", "config/collectionTotalPlanes.csv", "fieldByCollection/*.csv"],
+     "outputs": ["fieldByCollection/sumFieldByCollection.csv"]},
+]
+STAGES = ["prep", "gen", "genFieldBy", "sum"]
+
+## Format a duration in seconds as HH:MM:SS
+def format_duration(seconds):
+    total_seconds = int(seconds)
+    hours = total_seconds // 3600
+    minutes = (total_seconds % 3600) // 60
+    seconds = total_seconds % 60
+    return f"{hours:02}:{minutes:02}:{seconds:02}"
+
+## Return the files matching the given patterns, less the excluded ones.
+def match_files(patterns, exclude):
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(pattern))
+    return files - set(exclude)
+
+## Determine whether a task is up to date, i.e. every output pattern matches a file and the oldest output
+## is at least as new as the newest input. Inputs that are also outputs of the task are ignored.
+def is_up_to_date(task):
+    exclude = task.get("exclude", [])
+    outputs = set()
+    for pattern in task["outputs"]:
+        matched = match_files([pattern], exclude)
+        if len(matched) == 0:
+            return False
+        outputs.update(matched)
+
+    inputs = match_files(task["inputs"], exclude) - outputs
+    if len(inputs) == 0:
+        return True
+    return min(os.path.getmtime(filename) for filename in outputs) >= max(os.path.getmtime(filename) for filename in inputs)
+
+## Return the names of the given tasks along with all the tasks they depend on.
+def with_dependencies(task_names, tasks_by_name):
+    selected = set()
+    pending = list(task_names)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(tasks_by_name[name]["depends"])
+    return selected
+
+## Run the script of a task as a subprocess, writing its output to the log file of the task.
+## Return the exit code along with the start and end times.
+def run_task(task, extra_arguments):
+    log_filename = f"{LOG_DIRECTORY}/{task['name']}.log"
+    command = [sys.executable, f"{SCRIPT_DIRECTORY}/{task['script']}"] + extra_arguments
+    start_time = time.time()
+    print(f"{datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')} Starting {task['name']}: {' '.join(command[1:])}, log in {log_filename}")
+    with open(log_filename, 'w') as log_file:
+        completed = subprocess.run(command, stdout=log_file, stderr=subprocess.STDOUT)
+    end_time = time.time()
+    print(f"{datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')} Finished {task['name']} with exit code {completed.returncode} in {format_duration(end_time - start_time)}")
+    return completed.returncode, start_time, end_time
+
+## Run the selected tasks, starting each one as soon as the tasks it depends on have completed, with up to jobs tasks
+## running at the same time. A task is skipped when it is up to date and not forced, and when a task it depends on failed.
+## Return the status and timings of each task.
+def run_pipeline(selected, forced, jobs, task_arguments, dry_run):
+    results = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            ## Start every task whose dependencies are resolved.
+            for task in TASKS:
+                name = task["name"]
+                if name not in selected or name in results or name in running.values():
+                    continue
+                dependencies = [dependency for dependency in task["depends"] if dependency in selected]
+                if any(dependency not in results for dependency in dependencies):
+                    continue
+                if any(results[dependency]["status"] in ["failed", "blocked"] for dependency in dependencies):
+                    results[name] = {"status": "blocked"}
+                    print(f"Not running {name} as a task it depends on failed")
+                elif name not in forced and not any(results[dependency]["status"] in ["done", "would run"] for dependency in dependencies) and is_up_to_date(task):
+                    results[name] = {"status": "up to date"}
+                    print(f"Skipping {name} as its outputs are up to date")
+                elif dry_run:
+                    results[name] = {"status": "would run"}
+                    print(f"Would run {name}")
+                else:
+                    running[executor.submit(run_task, task, task_arguments.get(name, []))] = name
+
+            if len(running) == 0:
+                break
+
+            ## Wait for at least one running task to complete.
+            done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    exit_code, start_time, end_time = future.result()
+                    status = "done" if exit_code == 0 else "failed"
+                    results[name] = {"status": status, "start": start_time, "end": end_time, "exit_code": exit_code}
+                except Exception as e:
+                    print(f"Error running {name}: {e}")
+                    results[name] = {"status": "failed"}
+
+    return results
+
+## Print the status and duration of each task and the elapsed time of each stage, from the start of its first task
+## to the end of its last task.
+def report(results, pipeline_start, pipeline_end):
+    print(f"\nTask\tStage\tStatus\tDuration")
+    for task in TASKS:
+        result = results.get(task["name"])
+        if result is None:
+            continue
+        duration = format_duration(result["end"] - result["start"]) if "start" in result else ""
+        print(f"{task['name']}\t{task['stage']}\t{result['status']}\t{duration}")
+
+    print(f"\nStage\tTasks run\tElapsed")
+    for stage in STAGES:
+        stage_results = [results[task["name"]] for task in TASKS if task["stage"] == stage and task["name"] in results and "start" in results[task["name"]]]
+        if len(stage_results) > 0:
+            elapsed = max(result["end"] for result in stage_results) - min(result["start"] for result in stage_results)
+            print(f"{stage}\t{len(stage_results)}\t{format_duration(elapsed)}")
+    print(f"\nPipeline elapsed time {format_duration(pipeline_end - pipeline_start)}")
+
+## Main function to execute the script.
+## It determines the tasks to run, i.e. the tasks given as arguments along with the tasks they depend on or all tasks,
+## then runs them in dependency order and reports the timings.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs or a task failed.
+
+if __name__ == "__main__":
+
+    ## Determine where the caom2usage directory is located and change to that directory.
+
+    if os.path.isdir("/Users/gaudet_1/work/caom2usage"):
+        os.chdir("/Users/gaudet_1/work/caom2usage")
+    elif os.path.isdir("/arc/projects/CADC/caom2usage"):
+        os.chdir("/arc/projects/CADC/caom2usage")
+    else:
+        print("Unable to determine the location of the caom2usage directory.")
+        exit(1)
+
+    task_names = [task["name"] for task in TASKS]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tasks", nargs="*", help=f"Tasks to run along with the tasks they depend on, all tasks by default: {', '.join(task_names)}")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="Number of tasks run concurrently")
+    parser.add_argument("-f", "--force", nargs="*", help="Run the given tasks, or all the tasks when none is given, even if they are up to date")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only show which tasks would run")
+    parser.add_argument("--gen-args", default="", help="Arguments passed to usageGenCollInstr and usageGenCollection, e.g. \"-b 50 --incremental\"")
+    parser.add_argument("--sum-args", default="", help="Arguments passed to the usageSum* scripts, e.g. \"--store\"")
+    args = parser.parse_args()
+
+    for name in args.tasks + (args.force or []):
+        if name not in task_names:
+            print(f"Unknown task {name}, the tasks are: {', '.join(task_names)}")
+            exit(1)
+
+    tasks_by_name = {task["name"]: task for task in TASKS}
+    selected = with_dependencies(args.tasks, tasks_by_name) if len(args.tasks) > 0 else set(task_names)
+    if args.force is None:
+        forced = set()
+    elif len(args.force) == 0:
+        forced = set(task_names)
+    else:
+        forced = set(args.force)
+
+    task_arguments = {}
+    for task in TASKS:
+        if task["stage"] == "gen":
+            task_arguments[task["name"]] = shlex.split(args.gen_args)
+        elif task["stage"] == "sum":
+            task_arguments[task["name"]] = shlex.split(args.sum_args)
+
+    if not args.dry_run:
+        os.makedirs(LOG_DIRECTORY, exist_ok=True)
+    pipeline_start = time.time()
+    results = run_pipeline(selected, forced, args.jobs, task_arguments, args.dry_run)
+    pipeline_end = time.time()
+    report(results, pipeline_start, pipeline_end)
+
+    if any(result["status"] in ["failed", "blocked"] for result in results.values()):
+        print("One or more tasks failed.")
+        exit(1)
+    exit(0)
@@ -1,65 +1,76 @@
-from astroquery.cadc import Cadc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from lazyImport import lazy_import, load_modules
 import os.path
-import pandas
 
-def execute_query(query, filename):
+## Heavy packages are loaded on first use, see lazyImport.
+pandas = lazy_import("pandas")
+
+## Set up variables
+STATE_FILENAME = "config/collInstrState.csv"
+CHANGED_FILENAME = "config/collInstrChanged.csv"
+STATE_COLUMNS = ['max_last_modified', 'num_observations', 'num_planes']
+TIME_STAMP = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+
+## The collection/instruments changed since the last successful run of each usageGen* script. Each run of usagePrep
+## adds its changes to every list, and a usageGen* script only removes the changes it has read once it has processed
+## all the fields, so a change is never lost when usagePrep runs twice or a usageGen* script fails or is not run.
+PENDING_FILENAMES = ["config/collInstrPending_usageGenCollInstr.csv", "config/collInstrPending_usageGenCollection.csv"]
+PENDING_COLUMNS = ['collection', 'instrument_name', 'status', 'detected']
+
+## Execute a query as an async TAP job and return the results as a DataFrame. Each call uses its own
+## service so that the queries can run concurrently.
+
+def execute_query(query, description):
+    from astroquery.cadc import Cadc
+    service = Cadc()
     job = service.create_async(query)
-    print(f"Job ID: {job.job_id}")
+    print(f"Job ID for {description}: {job.job_id}")
     job.run().wait()
     job.raise_if_error()
-    results = job.fetch_result().to_table().to_pandas()
-    num_collection_instrument = len(results)
-    print(f"Number of collection/instances: {num_collection_instrument}")
-    total_instances = results['num_instances'].sum()
-    print(f"Total instances: {total_instances}")
+    return job.fetch_result().to_table().to_pandas()
 
-    results.to_csv(filename, index=False)
+## Write the collection/instrument totals and the collection totals rolled up from them.
 
+def write_totals(results, coll_instr_filename, collection_filename):
+    results.to_csv(coll_instr_filename, index=False, columns=['collection', 'instrument_name', 'num_instances'])
+    print(f"Number of collection/instances in {coll_instr_filename}: {len(results)}")
+    print(f"Total instances in {coll_instr_filename}: {results['num_instances'].sum()}")
 
-def count_collInstrObservations():
-    filename = "config/collInstrTotalObs.csv"
-    print( f"Querying caom2.Observation and writing results to {filename}")
+    collection_totals = results.groupby('collection', sort=False, as_index=False)['num_instances'].sum()
+    collection_totals.to_csv(collection_filename, index=False)
+    print(f"Number of collections in {collection_filename}: {len(collection_totals)}")
 
-    query = f"""select collection, instrument_name, count(*) as num_instances
+## Count the observations of each collection/instrument along with their latest maxLastModified in one
+## grouped query, and write both the collection/instrument and the collection totals.
+
+def count_observations():
+    print( f"Querying caom2.Observation and writing results to config/collInstrTotalObs.csv and config/collectionTotalObs.csv")
+
+    query = f"""select collection, instrument_name, count(*) as num_instances, max(maxLastModified) as max_last_modified
         from caom2.Observation
         where instrument_name is not null and instrument_name != 'NULL'
         group by collection, instrument_name
         order by collection, instrument_name"""
-    execute_query(query, filename)
-    
-def count_collInstrPlanes():
-    filename = "config/collInstrTotalPlanes.csv"
-    print( f"Querying caom2.Plane and writing results to {filename}")
+    results = execute_query(query, "caom2.Observation counts")
+    write_totals(results, "config/collInstrTotalObs.csv", "config/collectionTotalObs.csv")
+    return results
+
+## Count the planes of each collection/instrument in one grouped query, and write both the
+## collection/instrument and the collection totals.
+
+def count_planes():
+    print( f"Querying caom2.Plane and writing results to config/collInstrTotalPlanes.csv and config/collectionTotalPlanes.csv")
 
     query = f"""select collection, instrument_name, count(*) as num_instances
         from caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID
         where instrument_name is not null and instrument_name != 'NULL'
         group by collection, instrument_name
         order by collection, instrument_name"""
-    execute_query(query, filename)
-
-def count_collectionObservations():
-    filename = "config/collectionTotalObs.csv"
-    print( f"Querying caom2.Observation and writing results to {filename}")
+    results = execute_query(query, "caom2.Plane counts")
+    write_totals(results, "config/collInstrTotalPlanes.csv", "config/collectionTotalPlanes.csv")
+    return results
 
-    query = f"""select collection, count(*) as num_instances
-        from caom2.Observation
-        where instrument_name is not null and instrument_name != 'NULL'
-        group by collection
-        order by collection"""
-    execute_query(query, filename)
-    
-def count_collectionPlanes():
-    filename = "config/collectionTotalPlanes.csv"
-    print( f"Querying caom2.Plane and writing results to {filename}")
-
-    query = f"""select collection, count(*) as num_instances
-        from caom2.Observation join caom2.Plane on caom2.Observation.obsID = caom2.Plane.obsID
-        where instrument_name is not null and instrument_name != 'NULL'
-        group by collection
-        order by collection"""
-    execute_query(query, filename)
-    
 def list_fields():
     filename = "config/fieldNames.csv"
     print( f"Querying caom2 fields and writing results to {filename}")
@@ -68,17 +79,64 @@ def list_fields():
         from tap_schema.columns
         where table_name in ('caom2.Observation','caom2.Plane')
         order by table_name, column_name"""
-    job = service.create_async(query)
-    print(f"Job ID: {job.job_id}")
-    job.run().wait()
-    job.raise_if_error()
-    results = job.fetch_result().to_table().to_pandas()
+    results = execute_query(query, "caom2 fields")
     num_fields = len(results)
     print(f"Number of fields: {num_fields}")
     results['field_name'] = results['table_name'] + "." + results['column_name']
 
     results.to_csv(filename, index=False, columns=['field_name'])
-    
+
+## Record the state of each collection/instrument, i.e. the latest maxLastModified of its observations along with
+## its observation and plane counts, and compare it with the state recorded by the previous run. The collection/instruments
+## that are new, have changed or have been removed are written to the changed file and added to the pending lists
+## used by the --incremental mode of the usageGen* scripts.
+
+def record_collInstrState(obs_results, plane_results):
+    print( f"Writing the state of the collection/instruments to {STATE_FILENAME}")
+
+    if os.path.isfile(STATE_FILENAME):
+        previous_state = pandas.read_csv(STATE_FILENAME, dtype=str)
+    else:
+        print(f"No previous state in {STATE_FILENAME}, all collection/instruments are new")
+        previous_state = pandas.DataFrame(columns=['collection', 'instrument_name'] + STATE_COLUMNS)
+
+    state = obs_results.rename(columns={'num_instances': 'num_observations'}).merge(
+        plane_results.rename(columns={'num_instances': 'num_planes'}), on=['collection', 'instrument_name'], how='left')
+    state['num_planes'] = state['num_planes'].fillna(0).astype('int64')
+    state.to_csv(STATE_FILENAME, index=False, columns=['collection', 'instrument_name'] + STATE_COLUMNS)
+
+    ## Read the state back as text so that both states are compared in the same representation.
+    state = pandas.read_csv(STATE_FILENAME, dtype=str)
+    compared = state.merge(previous_state, on=['collection', 'instrument_name'], how='outer', suffixes=('', '_previous'), indicator=True)
+    compared['status'] = 'unchanged'
+    compared.loc[compared['_merge'] == 'left_only', 'status'] = 'new'
+    compared.loc[compared['_merge'] == 'right_only', 'status'] = 'removed'
+    for column in STATE_COLUMNS:
+        differs = (compared['_merge'] == 'both') & (compared[column].fillna('') != compared[f"{column}_previous"].fillna(''))
+        compared.loc[differs, 'status'] = 'changed'
+
+    changed = compared[compared['status'] != 'unchanged'].sort_values(['collection', 'instrument_name'])
+    changed.to_csv(CHANGED_FILENAME, index=False, columns=['collection', 'instrument_name', 'status'])
+    print(f"Number of collection/instruments new, changed or removed since the previous run: {len(changed)} of {len(state)}")
+
+    add_pending_changes(changed.assign(detected=TIME_STAMP))
+
+## Add the changes of this run to the pending list of each usageGen* script. A collection/instrument that is already
+## pending keeps only its latest change. The list is written under a temporary name and renamed so that a usageGen*
+## script never reads a partial file.
+
+def add_pending_changes(changed):
+    for pending_filename in PENDING_FILENAMES:
+        if os.path.isfile(pending_filename):
+            pending = pandas.read_csv(pending_filename, dtype=str)
+        else:
+            pending = pandas.DataFrame(columns=PENDING_COLUMNS)
+        pending = pandas.concat([pending[PENDING_COLUMNS], changed[PENDING_COLUMNS]], ignore_index=True)
+        pending = pending.drop_duplicates(subset=['collection', 'instrument_name'], keep='last').sort_values(['collection', 'instrument_name'])
+        pending.to_csv(f"{pending_filename}.tmp", index=False)
+        os.replace(f"{pending_filename}.tmp", pending_filename)
+        print(f"Number of collection/instruments pending in {pending_filename}: {len(pending)}")
+
 
 if __name__ == "__main__":
 
@@ -92,10 +150,24 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
-    service = Cadc()
-    
-    list_fields()
-    count_collectionObservations()
-    count_collInstrObservations()
-    count_collectionPlanes()
-    count_collInstrPlanes()
+    ## The queries are independent, so run them concurrently. The threads convert their results with to_pandas,
+    ## so pandas is loaded first on the main thread, see lazyImport.
+
+    load_modules(pandas)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        fields_future = executor.submit(list_fields)
+        obs_future = executor.submit(count_observations)
+        planes_future = executor.submit(count_planes)
+
+        error = False
+        for future in [fields_future, obs_future, planes_future]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error executing query: {e}")
+                error = True
+
+    if error:
+        exit(1)
+
+    record_collInstrState(obs_future.result(), planes_future.result())
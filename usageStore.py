@@ -0,0 +1,136 @@
+from lazyImport import lazy_import
+# This module maintains the consolidated Parquet store of the caom2usage null counts, with one row per
+# field and collection/instrument (or collection) holding num_null, num_instances and percentage_null.
+# The usageGen* scripts write one Parquet file per field to the store as they process the fields, and the
+# per-field CSV files can be regenerated from the store on demand. Run as a script to import existing
+# per-field CSV files into the store or to export the store back to per-field CSV files.
+
+import sys
+import os
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
+
+## Set up variables
+STORE_DIRECTORY = "usageStore"
+LEVELS = {
+    "collInstr": {"keys": ["collection", "instrument_name"], "field_directory": "collInstrByField"},
+    "collection": {"keys": ["collection"], "field_directory": "collectionByField"},
+}
+
+## Return the schema of the store for the given level.
+def store_schema(level):
+    schema = {"field": pl.String}
+    for key in LEVELS[level]["keys"]:
+        schema[key] = pl.String
+    schema["num_null"] = pl.Int64
+    schema["num_instances"] = pl.Int64
+    schema["percentage_null"] = pl.Float64
+    return schema
+
+## Return the path of the Parquet file holding the results of a field.
+def field_path(level, field):
+    return f"{STORE_DIRECTORY}/{level}/{field}.parquet"
+
+## Write the results of a field, as returned by calculate_percentages, to the store. A field without
+## null values is stored as an empty file so that the store records that it has been processed.
+## The file is written under a temporary name and renamed so that concurrent readers never see a partial file.
+def write_field(level, field, results):
+    schema = store_schema(level)
+    if len(results) > 0 and "percentage_null" in results.columns:
+        columns = {"field": [field] * len(results)}
+        for column in list(schema.keys())[1:]:
+            columns[column] = list(results[column])
+        field_df = pl.DataFrame(columns, schema=schema, strict=False)
+    else:
+        field_df = pl.DataFrame(schema=schema)
+
+    os.makedirs(f"{STORE_DIRECTORY}/{level}", exist_ok=True)
+    path = field_path(level, field)
+    field_df.write_parquet(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+## Return the list of fields in the store, including the fields without null values.
+def list_fields(level):
+    directory = f"{STORE_DIRECTORY}/{level}"
+    if not os.path.isdir(directory):
+        return []
+    return [filename.removesuffix(".parquet") for filename in sorted(os.listdir(directory)) if filename.endswith(".parquet")]
+
+## Load the whole store for the given level as one long DataFrame.
+def load(level):
+    fields = list_fields(level)
+    if len(fields) == 0:
+        return pl.DataFrame(schema=store_schema(level))
+    return pl.scan_parquet([field_path(level, field) for field in fields], schema=store_schema(level)).collect()
+
+## Import the per-field CSV files written by the usageGen* scripts into the store.
+def import_field_csvs(level, field_names):
+    field_directory = LEVELS[level]["field_directory"]
+    num_fields = 0
+    for field in field_names:
+        filename = f"{field_directory}/{field}.csv"
+        if os.path.isfile(filename):
+            results = pl.read_csv(filename, schema_overrides={key: pl.String for key in LEVELS[level]["keys"]})
+            write_field(level, field, results)
+            num_fields += 1
+    print(f"Imported {num_fields} fields from {field_directory} into {STORE_DIRECTORY}/{level}")
+
+## Regenerate the per-field CSV files from the store, in the same format as the usageGen* scripts write them.
+def export_field_csvs(level):
+    keys = LEVELS[level]["keys"]
+    field_directory = LEVELS[level]["field_directory"]
+    os.makedirs(field_directory, exist_ok=True)
+    store_df = load(level)
+    fields = list_fields(level)
+    field_results = {key[0]: group for key, group in store_df.group_by("field", maintain_order=True)}
+
+    for field in fields:
+        filename = f"{field_directory}/{field}.csv"
+        results = field_results.get(field)
+        with open(filename, 'w') as f:
+            if results is None:
+                f.write(f",{','.join(keys)},num_null\n")
+            else:
+                results.select(
+                    pl.int_range(pl.len()).alias("Unnamed: 0"), *keys, "num_null", "num_instances", "percentage_null"
+                ).write_csv(f)
+    print(f"Exported {len(fields)} fields from {STORE_DIRECTORY}/{level} to {field_directory}")
+
+## Usage message for the script.
+def print_usage():
+    print(f"Usage: {sys.argv[0]} <import || export> <collInstr || collection>")
+    print(f"       {sys.argv[0]} <-h || --help>")
+
+## Main function to execute the script.
+## It imports the per-field CSV files into the store, or exports the store to per-field CSV files.
+## The script will exit with a status code of 0 if successful, or 1 if an error occurs.
+
+if __name__ == "__main__":
+
+    ## Determine where the caom2usage directory is located and change to that directory.
+
+    if os.path.isdir("/Users/gaudet_1/work/caom2usage"):
+        os.chdir("/Users/gaudet_1/work/caom2usage")
+    elif os.path.isdir("/arc/projects/CADC/caom2usage"):
+        os.chdir("/arc/projects/CADC/caom2usage")
+    else:
+        print("Unable to determine the location of the caom2usage directory.")
+        exit(1)
+
+    if len(sys.argv) == 2 and sys.argv[1] in ['--help', '-h']:
+        print_usage()
+        exit(0)
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ['import', 'export'] or sys.argv[2] not in LEVELS:
+        print_usage()
+        exit(1)
+
+    level = sys.argv[2]
+    if sys.argv[1] == 'import':
+        field_names = pl.read_csv("config/fieldNames.csv")['field_name'].to_list()
+        import_field_csvs(level, field_names)
+    else:
+        export_field_csvs(level)
+
+    exit(0)
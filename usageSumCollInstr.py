@@ -1,5 +1,10 @@
-import pandas as pd
+from lazyImport import lazy_import
+import argparse
 import os.path
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
 
 # This script generates a summary of the number of collection-instrument and field instances with null values.
 # It reads pre-generated CSV files containing collection-instrument counts for observations and planes,
@@ -7,6 +12,41 @@ import os.path
 # and field instances with null values, and writes the results to a summary CSV file.
 #
 
+## Set up variables
+STORE_LEVEL = "collInstr"
+
+## Load the null counts of the given fields from their CSV files into one long table with a field column.
+## Fields without null values have a CSV file with a header only and contribute no rows.
+
+def load_field_results(fields):
+    field_results = [
+        pl.read_csv(f"collInstrByField/{field}.csv", columns=['num_null'], schema_overrides={'num_null': pl.Int64}).select(pl.lit(field).alias('field'), 'num_null')
+        for field in fields
+    ]
+    if len(field_results) == 0:
+        return pl.DataFrame(schema={'field': pl.String, 'num_null': pl.Int64})
+    return pl.concat(field_results)
+
+## Summarise the null counts of the given fields from one long table of field results with a single group-by,
+## keeping the order of the fields, and return the summary lines.
+
+def summarise_fields(field_results, fields, num_coll_instr_obs, sum_instances_coll_instr_obs, num_coll_instr_planes, sum_instances_coll_instr_planes):
+    counts = field_results.group_by('field').agg(
+        pl.len().alias('field_coll_instr'),
+        pl.col('num_null').sum().alias('field_instances')
+    )
+    is_observation = pl.col('field').str.starts_with("caom2.Observation.")
+    summary = pl.DataFrame({'field': fields}, schema={'field': pl.String}).join(counts, on='field', how='left', maintain_order='left').with_columns(
+        pl.col('field_coll_instr').fill_null(0),
+        pl.col('field_instances').fill_null(0),
+        pl.when(is_observation).then(pl.lit(int(num_coll_instr_obs))).otherwise(pl.lit(int(num_coll_instr_planes))).alias('num_coll_instr'),
+        pl.when(is_observation).then(pl.lit(int(sum_instances_coll_instr_obs))).otherwise(pl.lit(int(sum_instances_coll_instr_planes))).alias('sum_instances_coll_instr')
+    ).with_columns(
+        (pl.col('field_coll_instr') * 100 / pl.col('num_coll_instr')).alias('percentage_null_coll_instr'),
+        (pl.col('field_instances') * 100 / pl.col('sum_instances_coll_instr')).alias('percentage_null_instances')
+    )
+    return [f"{row['field']},{row['num_coll_instr']},{row['field_coll_instr']},{row['percentage_null_coll_instr']:.2f},{row['sum_instances_coll_instr']},{row['field_instances']},{row['percentage_null_instances']:.2f}\n" for row in summary.iter_rows(named=True)]
+
 if __name__ == "__main__":
 
     ## Determine where the caom2usage directory is located and change to that directory.
@@ -19,6 +59,10 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", action="store_true", help="Summarise the usageStore instead of the per-field CSV files")
+    args = parser.parse_args()
+
     obs_filename = "config/collInstrTotalObs.csv"
     planes_filename = "config/collInstrTotalPlanes.csv"
     fields_filename = "config/fieldNames.csv"
@@ -27,7 +71,7 @@ if __name__ == "__main__":
 #
 # Initialize the data structures for pre-generated collection-instrument counts for observations.
 #
-    array_coll_instr_obs = pd.read_csv(obs_filename)
+    array_coll_instr_obs = pl.read_csv(obs_filename)
     num_coll_instr_obs = len(array_coll_instr_obs)
     print(f"Number of collection-instrument in {obs_filename}: {num_coll_instr_obs}")
     sum_instances_coll_instr_obs = array_coll_instr_obs['num_instances'].sum()
@@ -36,50 +80,42 @@ if __name__ == "__main__":
 #
 # Initialize the data structures for pre-generated collection-instrument counts for planes.
 #
-    array_coll_instr_planes = pd.read_csv(planes_filename)
+    array_coll_instr_planes = pl.read_csv(planes_filename)
     num_coll_instr_planes = len(array_coll_instr_planes)
     print(f"Number of collection-instrument in {planes_filename}: {num_coll_instr_planes}")
     sum_instances_coll_instr_planes = array_coll_instr_planes['num_instances'].sum()
     print(f"Sum of instances of collection-instrument in {planes_filename}: {sum_instances_coll_instr_planes}")
-#
-# Initialize the summary output file with the CSV header.
-#
-    with open(summary_filename, 'w') as f:
-        f.write("Field name,number of collection-instrument,collection-instrument with null values,percentage of collection-instrument with null values,number of field instances,field instances with null values,percentage of field instances with null values\n")
 
 #
 # Initialize lists of fields to be checked for output.
 #
-    field_names = pd.read_csv(fields_filename)
+    field_names = pl.read_csv(fields_filename)
     num_fields = len(field_names)
     print(f"Number of fields in {fields_filename}: {num_fields}")
+
 #
-# Now loop through the the list of field and process the corresponding output files.
+# Load the results of all the fields that have been processed into one long table, either from the
+# usageStore with --store or from the per-field CSV files.
 #
-    for index, row in field_names.iterrows():
-        field = row['field_name']
-        field_filename = f"collInstrByField/{field}.csv"
-
-        if os.path.isfile(field_filename):
-#            print(f"Processing field {field} from {field_filename}")
-            results = pd.read_csv(field_filename)
-            field_coll_instr = len(results)
-#            print(f"Number of collection-instrument for {field}: {field_coll_instr}")
-            field_instances = results['num_null'].sum()
-#            print(f"Total instances for {field}: {field_instances}")
-
-            if field.startswith("caom2.Observation."):
-                num_coll_instr = num_coll_instr_obs
-                sum_instances_coll_instr = sum_instances_coll_instr_obs
-            elif field.startswith("caom2.Plane."):
-                num_coll_instr = num_coll_instr_planes
-                sum_instances_coll_instr = sum_instances_coll_instr_planes
-            else:
-                print(f"Unknown field {field}")
-                exit(255)
-
-            percentage_null_coll_instr = field_coll_instr * 100 / num_coll_instr
-            percentage_null_instances = field_instances * 100 / sum_instances_coll_instr
-#            print(f"{field},{num_coll_instr},{field_coll_instr},{percentage_null_coll_instr:.2f},{sum_instances_coll_instr},{field_instances},{percentage_null_instances:.2f}")
-            with open(summary_filename, 'a') as f:
-                f.write(f"{field},{num_coll_instr},{field_coll_instr},{percentage_null_coll_instr:.2f},{sum_instances_coll_instr},{field_instances},{percentage_null_instances:.2f}\n")    
+    if args.store:
+        stored_fields = set(usageStore.list_fields(STORE_LEVEL))
+        fields = [field for field in field_names['field_name'] if field in stored_fields]
+        field_results = usageStore.load(STORE_LEVEL)
+        source = "the usageStore"
+    else:
+        fields = [field for field in field_names['field_name'] if os.path.isfile(f"collInstrByField/{field}.csv")]
+        field_results = load_field_results(fields)
+        source = "collInstrByField"
+
+    for field in fields:
+        if not field.startswith("caom2.Observation.") and not field.startswith("caom2.Plane."):
+            print(f"Unknown field {field}")
+            exit(255)
+    print(f"Loaded {len(field_results)} field results for {len(fields)} fields from {source}")
+
+#
+# Summarise all the fields at once and write the summary file with its CSV header.
+#
+    with open(summary_filename, 'w') as f:
+        f.write("Field name,number of collection-instrument,collection-instrument with null values,percentage of collection-instrument with null values,number of field instances,field instances with null values,percentage of field instances with null values\n")
+        f.writelines(summarise_fields(field_results, fields, num_coll_instr_obs, sum_instances_coll_instr_obs, num_coll_instr_planes, sum_instances_coll_instr_planes))
@@ -1,5 +1,10 @@
-import pandas as pd
+from lazyImport import lazy_import
+import argparse
 import os.path
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
 
 # This script generates a summary of the number of collection and field instances with null values.
 # It reads pre-generated CSV files containing collection counts for observations and planes,
@@ -7,6 +12,41 @@ import os.path
 # and field instances with null values, and writes the results to a summary CSV file.
 #
 
+## Set up variables
+STORE_LEVEL = "collection"
+
+## Load the null counts of the given fields from their CSV files into one long table with a field column.
+## Fields without null values have a CSV file with a header only and contribute no rows.
+
+def load_field_results(fields):
+    field_results = [
+        pl.read_csv(f"collectionByField/{field}.csv", columns=['num_null'], schema_overrides={'num_null': pl.Int64}).select(pl.lit(field).alias('field'), 'num_null')
+        for field in fields
+    ]
+    if len(field_results) == 0:
+        return pl.DataFrame(schema={'field': pl.String, 'num_null': pl.Int64})
+    return pl.concat(field_results)
+
+## Summarise the null counts of the given fields from one long table of field results with a single group-by,
+## keeping the order of the fields, and return the summary lines.
+
+def summarise_fields(field_results, fields, num_collection_obs, sum_instances_collection_obs, num_collection_planes, sum_instances_collection_planes):
+    counts = field_results.group_by('field').agg(
+        pl.len().alias('field_collection'),
+        pl.col('num_null').sum().alias('field_instances')
+    )
+    is_observation = pl.col('field').str.starts_with("caom2.Observation.")
+    summary = pl.DataFrame({'field': fields}, schema={'field': pl.String}).join(counts, on='field', how='left', maintain_order='left').with_columns(
+        pl.col('field_collection').fill_null(0),
+        pl.col('field_instances').fill_null(0),
+        pl.when(is_observation).then(pl.lit(int(num_collection_obs))).otherwise(pl.lit(int(num_collection_planes))).alias('num_collection'),
+        pl.when(is_observation).then(pl.lit(int(sum_instances_collection_obs))).otherwise(pl.lit(int(sum_instances_collection_planes))).alias('sum_instances_collection')
+    ).with_columns(
+        (pl.col('field_collection') * 100 / pl.col('num_collection')).alias('percentage_null_collection'),
+        (pl.col('field_instances') * 100 / pl.col('sum_instances_collection')).alias('percentage_null_instances')
+    )
+    return [f"{row['field']},{row['num_collection']},{row['field_collection']},{row['percentage_null_collection']:.2f},{row['sum_instances_collection']},{row['field_instances']},{row['percentage_null_instances']:.2f}\n" for row in summary.iter_rows(named=True)]
+
 if __name__ == "__main__":
 
     ## Determine where the caom2usage directory is located and change to that directory.
@@ -19,6 +59,10 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", action="store_true", help="Summarise the usageStore instead of the per-field CSV files")
+    args = parser.parse_args()
+
     obs_filename = "config/collectionTotalObs.csv"
     planes_filename = "config/collectionTotalPlanes.csv"
     fields_filename = "config/fieldNames.csv"
@@ -27,7 +71,7 @@ if __name__ == "__main__":
 #
 # Initialize the data structures for pre-generated collection counts for observations.
 #
-    array_collection_obs = pd.read_csv(obs_filename)
+    array_collection_obs = pl.read_csv(obs_filename)
     num_collection_obs = len(array_collection_obs)
     print(f"Number of collection in {obs_filename}: {num_collection_obs}")
     sum_instances_collection_obs = array_collection_obs['num_instances'].sum()
@@ -36,53 +80,42 @@ if __name__ == "__main__":
 #
 # Initialize the data structures for pre-generated collection counts for planes.
 #
-    array_collection_planes = pd.read_csv(planes_filename)
+    array_collection_planes = pl.read_csv(planes_filename)
     num_collection_planes = len(array_collection_planes)
     print(f"Number of collection in {planes_filename}: {num_collection_planes}")
     sum_instances_collection_planes = array_collection_planes['num_instances'].sum()
     print(f"Sum of instances of collection in {planes_filename}: {sum_instances_collection_planes}")
-#
-# Initialize the summary output file with the CSV header.
-#
-    with open(summary_filename, 'w') as f:
-        f.write("Field name,number of collections,collections with null values,percentage of collections with null values,number of field instances,field instances with null values,percentage of field instances with null values\n")
 
 #
 # Initialize lists of fields to be checked for output.
 #
-    field_names = pd.read_csv(fields_filename)
+    field_names = pl.read_csv(fields_filename)
     num_fields = len(field_names)
     print(f"Number of fields in {fields_filename}: {num_fields}")
+
 #
-# Now loop through the the list of field and process the corresponding output files.
+# Load the results of all the fields that have been processed into one long table, either from the
+# usageStore with --store or from the per-field CSV files.
 #
-    for index, row in field_names.iterrows():
-        field = row['field_name']
-        field_filename = f"collectionByField/{field}.csv"
-
-        if os.path.isfile(field_filename):
-#            print(f"Processing field {field} from {field_filename}")
-            results = pd.read_csv(field_filename)
-            field_collection = len(results)
-#            print(f"Number of collections for {field}: {field_collection}")
-            field_instances = results['num_null'].sum()
-#            print(f"Total instances for {field}: {field_instances}")
-
-            if field.startswith("caom2.Observation."):
-                num_collection = num_collection_obs
-                sum_instances_collection = sum_instances_collection_obs
-            elif field.startswith("caom2.Plane."):
-                num_collection = num_collection_planes
-                sum_instances_collection = sum_instances_collection_planes
-            else:
-                print(f"Unknown field {field}")
-                exit(255)
-
-            percentage_null_collection = field_collection * 100 / num_collection
-            percentage_null_instances = field_instances * 100 / sum_instances_collection
-#            print(f"{field},{num_collection},{field_collection},{percentage_null_collection:.2f},{sum_instances_collection},{field_instances},{percentage_null_instances:.2f}")
-            with open(summary_filename, 'a') as f:
-                f.write(f"{field},{num_collection},{field_collection},{percentage_null_collection:.2f},{sum_instances_collection},{field_instances},{percentage_null_instances:.2f}\n")    
-
+    if args.store:
+        stored_fields = set(usageStore.list_fields(STORE_LEVEL))
+        fields = [field for field in field_names['field_name'] if field in stored_fields]
+        field_results = usageStore.load(STORE_LEVEL)
+        source = "the usageStore"
+    else:
+        fields = [field for field in field_names['field_name'] if os.path.isfile(f"collectionByField/{field}.csv")]
+        field_results = load_field_results(fields)
+        source = "collectionByField"
 
+    for field in fields:
+        if not field.startswith("caom2.Observation.") and not field.startswith("caom2.Plane."):
+            print(f"Unknown field {field}")
+            exit(255)
+    print(f"Loaded {len(field_results)} field results for {len(fields)} fields from {source}")
 
+#
+# Summarise all the fields at once and write the summary file with its CSV header.
+#
+    with open(summary_filename, 'w') as f:
+        f.write("Field name,number of collections,collections with null values,percentage of collections with null values,number of field instances,field instances with null values,percentage of field instances with null values\n")
+        f.writelines(summarise_fields(field_results, fields, num_collection_obs, sum_instances_collection_obs, num_collection_planes, sum_instances_collection_planes))
@@ -1,5 +1,10 @@
-import pandas as pd
+from lazyImport import lazy_import
+import argparse
 import os.path
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
 
 # This script generates a summary of the number of collection/instrument and field instances with null values.
 # It reads pre-generated CSV files containing collection/instrument counts for observations and planes,
@@ -7,6 +12,66 @@ import os.path
 # and field instances with null values, and writes the results to a summary CSV file.
 #
 
+## Set up variables
+STORE_LEVEL = "collInstr"
+KEYS = ['collection', 'instrument_name']
+
+## Return the name of the fieldByCollInstr file of a collection/instrument.
+
+def collInstr_filename(collection, instrument_name):
+    instrument_for_filename = instrument_name.replace(" ", "_")
+    instrument_for_filename = instrument_for_filename.replace("/", "_")
+    return f"fieldByCollInstr/{collection}.{instrument_for_filename}.csv"
+
+## Load the fieldByCollInstr files of the given collection/instruments into one long table of field results,
+## with the collection/instrument of each file added as columns.
+
+def load_collInstr_results(array_collInstr):
+    collInstr_results = [
+        pl.read_csv(collInstr_filename(collection, instrument_name), columns=['Field', 'num_null'], schema_overrides={'Field': pl.String, 'num_null': pl.Int64}).select(
+            pl.col('Field').alias('field'), pl.lit(collection).alias('collection'), pl.lit(instrument_name).alias('instrument_name'), 'num_null'
+        )
+        for collection, instrument_name in array_collInstr.select(KEYS).unique(keep='first', maintain_order=True).iter_rows()
+    ]
+    if len(collInstr_results) == 0:
+        return pl.DataFrame(schema={'field': pl.String, 'collection': pl.String, 'instrument_name': pl.String, 'num_null': pl.Int64})
+    return pl.concat(collInstr_results)
+
+## Summarise the null counts of each collection/instrument from one long table of field results with a single group-by,
+## in the order of the collection/instrument totals for observations, and return the summary lines. A caom2.Plane line
+## follows the caom2.Observation line of each collection/instrument that also has a total for planes.
+
+def summarise_collInstr(field_results, array_collInstr_obs, array_collInstr_planes, num_obs_fields, num_plane_fields):
+    counts = field_results.with_columns(
+        pl.when(pl.col('field').str.contains("caom2.Observation", literal=True)).then(pl.lit("caom2.Observation"))
+        .when(pl.col('field').str.contains("caom2.Plane", literal=True)).then(pl.lit("caom2.Plane"))
+        .alias('table')
+    ).group_by(KEYS + ['table']).agg(
+        pl.len().alias('fields_with_null'),
+        pl.col('num_null').sum().alias('instances_with_null')
+    )
+
+    totals_obs = array_collInstr_obs.select(KEYS + ['num_instances']).with_row_index('order')
+    totals_planes = array_collInstr_planes.select(KEYS + ['num_instances']).unique(subset=KEYS, keep='first', maintain_order=True)
+    table_summaries = []
+    for table_order, (table, totals, num_fields) in enumerate([
+            ("caom2.Observation", totals_obs, num_obs_fields),
+            ("caom2.Plane", totals_obs.select(['order'] + KEYS).join(totals_planes, on=KEYS, how='inner'), num_plane_fields)]):
+        table_summaries.append(totals.join(counts.filter(pl.col('table') == table), on=KEYS, how='left').with_columns(
+            pl.lit(table).alias('table'),
+            pl.lit(table_order).alias('table_order'),
+            pl.lit(int(num_fields)).alias('num_fields'),
+            (pl.col('num_instances') * int(num_fields)).alias('num_instances'),
+            pl.col('fields_with_null').fill_null(0),
+            pl.col('instances_with_null').fill_null(0)
+        ).select(['order', 'table_order', 'table'] + KEYS + ['num_fields', 'fields_with_null', 'num_instances', 'instances_with_null']))
+
+    summary = pl.concat(table_summaries).sort(['order', 'table_order']).with_columns(
+        (pl.col('fields_with_null') * 100 / pl.col('num_fields')).alias('percentage_fields_with_null'),
+        (pl.col('instances_with_null') * 100 / pl.col('num_instances')).alias('percentage_instances_with_null')
+    )
+    return [f"{row['table']},{row['collection']},{row['instrument_name']},{row['num_fields']},{row['fields_with_null']},{row['percentage_fields_with_null']:.2f},{row['num_instances']},{row['instances_with_null']},{row['percentage_instances_with_null']:.2f}\n" for row in summary.iter_rows(named=True)]
+
 if __name__ == "__main__":
 
     ## Determine where the caom2usage directory is located and change to that directory.
@@ -19,85 +84,44 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", action="store_true", help="Summarise the usageStore instead of the per-collection/instrument CSV files")
+    args = parser.parse_args()
+
     obs_filename = "config/collInstrTotalObs.csv"
     planes_filename = "config/collInstrTotalPlanes.csv"
     fields_filename = "config/fieldNames.csv"
     summary_filename = "fieldByCollInstr/sumFieldByCollInstr.csv"
 
     #
-    # Initialize the data structures for pre-generated collection/instrument counts for observations.
+    # Initialize the data structures for pre-generated collection/instrument counts for observations and planes.
     #
-    array_collInstr_obs = pd.read_csv(obs_filename)
-    num_collInstr_obs = len(array_collInstr_obs)
-    #print(f"Number of collection/instrument in {obs_filename}: {num_collInstr_obs}")
-    sum_instances_collInstr_obs = array_collInstr_obs['num_instances'].sum()
-    #print(f"Sum of instances of collection/instrument in {obs_filename}: {sum_instances_collInstr_obs}")
+    array_collInstr_obs = pl.read_csv(obs_filename, schema_overrides={key: pl.String for key in KEYS})
+    array_collInstr_planes = pl.read_csv(planes_filename, schema_overrides={key: pl.String for key in KEYS})
 
     #
-    # Initialize the data structures for pre-generated collection/instrument counts for planes.
-    #
-    array_collInstr_planes = pd.read_csv(planes_filename)
-    num_collInstr_planes = len(array_collInstr_planes)
-    #print(f"Number of collection/instrument in {planes_filename}: {num_collInstr_planes}")
-    sum_instances_collInstr_planes = array_collInstr_planes['num_instances'].sum()
-    #print(f"Sum of instances of collection/instrument in {planes_filename}: {sum_instances_collInstr_planes}")
-
-    #
-    # Initialize the summary output filew with the CSV header.
+    # Initialize lists of fields to be checked for output.
     #
-    with open(summary_filename, 'w') as f:
-        f.write("Table,Collection,Instrument,number of fields,fields with null values,percentage of fields with null values,number of instances,instances with null values,percentage of instances with null values\n")
+    field_names = pl.read_csv(fields_filename)
+    num_obs_fields = field_names['field_name'].str.starts_with("caom2.Observation").sum()
+    num_plane_fields = field_names['field_name'].str.starts_with("caom2.Plane").sum()
 
     #
-    # Initialize lists of fields to be checked for output.
+    # Load the field results of all the collection/instruments into one long table, either from the usageStore with --store
+    # or from the fieldByCollInstr files, in which case only the collection/instruments with a file are summarised.
     #
-    field_names = pd.read_csv(fields_filename)
-    num_obs_fields = field_names['field_name'].str.startswith("caom2.Observation").sum()
-    num_plane_fields = field_names['field_name'].str.startswith("caom2.Plane").sum()
+    if args.store:
+        field_results = usageStore.load(STORE_LEVEL)
+        source = "the usageStore"
+    else:
+        array_collInstr_obs = array_collInstr_obs.filter(pl.Series([os.path.isfile(collInstr_filename(collection, instrument_name)) for collection, instrument_name in array_collInstr_obs.select(KEYS).iter_rows()], dtype=pl.Boolean))
+        field_results = load_collInstr_results(array_collInstr_obs)
+        source = "fieldByCollInstr"
+    print(f"Loaded {len(field_results)} field results for {len(array_collInstr_obs)} collection/instruments from {source}")
 
     #
-    # Now loop through the collection/instrument and summarize the corresponding output file.
+    # Summarise all the collection/instruments at once and write the summary file with its CSV header.
     #
-    for index, row_obs in array_collInstr_obs.iterrows():
-        collection = row_obs['collection']
-        instrument_name = row_obs['instrument_name']
-        num_collInstr_observations = row_obs['num_instances']
-        num_collInstr_obs_instances = num_collInstr_observations * num_obs_fields
-    
-        instrument_for_filename = instrument_name.replace(" ", "_")
-        instrument_for_filename = instrument_for_filename.replace("/", "_")
-        collInstr_filename = f"fieldByCollInstr/{collection}.{instrument_for_filename}.csv"
-
-        if os.path.isfile(collInstr_filename):
-            print(f"Processing collection/instrument {collection} {instrument_name} from {collInstr_filename}")
-            results = pd.read_csv(collInstr_filename)
-
-            ## Process Observation fields
-
-            obs_results= results[results['Field'].str.contains("caom2.Observation")]
-            num_collInstr_obs_fields_with_null = len(obs_results)
-            percentage_obs_fields_with_null = num_collInstr_obs_fields_with_null * 100 / num_obs_fields
-            #print(f"Number of obs fields with null for {collection}/{instrument_name}: {num_collInstr_obs_fields_with_null}")
-            num_collInstr_obs_instances_with_null = obs_results['num_null'].sum()
-            #print(f"Number of obs instances with null for {collection}/{instrument_name}: {num_collInstr_obs_instances_with_null}")
-            percentage_obs_instances_with_null = num_collInstr_obs_instances_with_null * 100 / num_collInstr_obs_instances
-            with open(summary_filename, 'a') as f:
-                f.write(f"caom2.Observation,{collection},{instrument_name},{num_obs_fields},{num_collInstr_obs_fields_with_null},{percentage_obs_fields_with_null:.2f},{num_collInstr_obs_instances},{num_collInstr_obs_instances_with_null},{percentage_obs_instances_with_null:.2f}\n")    
-
-            ## Process Plane fields
-
-            row_planes = array_collInstr_planes[(array_collInstr_planes['collection'] == collection) & (array_collInstr_planes['instrument_name'] == instrument_name)]
-            if len(row_planes) > 0:
-                num_collInstr_planes = row_planes['num_instances'].values[0]
-                num_collInstr_plane_instances = num_collInstr_planes * num_plane_fields
-
-                plane_results = results[results['Field'].str.contains("caom2.Plane")]
-                num_collInstr_plane_fields_with_null = len(plane_results)
-                percentage_plane_fields_with_null = num_collInstr_plane_fields_with_null * 100 / num_plane_fields
-                #print(f"Number of plane fields with null for {collection}/{instrument_name}: {num_collInstr_plane_fields_with_null}")
-                num_collInstr_plane_instances_with_null = plane_results['num_null'].sum()
-                #print(f"Number of plane instances with null for {collection}/{instrument_name}: {num_collInstr_plane_instances_with_null}")
-                percentage_plane_instances_with_null = num_collInstr_plane_instances_with_null * 100 / num_collInstr_plane_instances
-                with open(summary_filename, 'a') as f:
-                    f.write(f"caom2.Plane,{collection},{instrument_name},{num_plane_fields},{num_collInstr_plane_fields_with_null},{percentage_plane_fields_with_null:.2f},{num_collInstr_plane_instances},{num_collInstr_plane_instances_with_null},{percentage_plane_instances_with_null:.2f}\n")    
-
+    with open(summary_filename, 'w') as f:
+        f.write("Table,Collection,Instrument,number of fields,fields with null values,percentage of fields with null values,number of instances,instances with null values,percentage of instances with null values\n")
+        f.writelines(summarise_collInstr(field_results, array_collInstr_obs, array_collInstr_planes, num_obs_fields, num_plane_fields))
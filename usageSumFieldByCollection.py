@@ -1,5 +1,10 @@
-import pandas as pd
+from lazyImport import lazy_import
+import argparse
 import os.path
+import usageStore
+
+## Heavy packages are loaded on first use, see lazyImport.
+pl = lazy_import("polars")
 
 # This script generates a summary of the number of collection and field instances with null values.
 # It reads pre-generated CSV files containing collection counts for observations and planes,
@@ -7,6 +12,64 @@ import os.path
 # and field instances with null values, and writes the results to a summary CSV file.
 #
 
+## Set up variables
+STORE_LEVEL = "collection"
+KEYS = ['collection']
+
+## Return the name of the fieldByCollection file of a collection.
+
+def collection_filename(collection):
+    return f"fieldByCollection/{collection}.csv"
+
+## Load the fieldByCollection files of the given collections into one long table of field results,
+## with the collection of each file added as a column.
+
+def load_collection_results(array_collection):
+    collection_results = [
+        pl.read_csv(collection_filename(collection), columns=['Field', 'num_null'], schema_overrides={'Field': pl.String, 'num_null': pl.Int64}).select(
+            pl.col('Field').alias('field'), pl.lit(collection).alias('collection'), 'num_null'
+        )
+        for (collection,) in array_collection.select(KEYS).unique(keep='first', maintain_order=True).iter_rows()
+    ]
+    if len(collection_results) == 0:
+        return pl.DataFrame(schema={'field': pl.String, 'collection': pl.String, 'num_null': pl.Int64})
+    return pl.concat(collection_results)
+
+## Summarise the null counts of each collection from one long table of field results with a single group-by,
+## in the order of the collection totals for observations, and return the summary lines. A caom2.Plane line
+## follows the caom2.Observation line of each collection that also has a total for planes.
+
+def summarise_collection(field_results, array_collection_obs, array_collection_planes, num_obs_fields, num_plane_fields):
+    counts = field_results.with_columns(
+        pl.when(pl.col('field').str.contains("caom2.Observation", literal=True)).then(pl.lit("caom2.Observation"))
+        .when(pl.col('field').str.contains("caom2.Plane", literal=True)).then(pl.lit("caom2.Plane"))
+        .alias('table')
+    ).group_by(KEYS + ['table']).agg(
+        pl.len().alias('fields_with_null'),
+        pl.col('num_null').sum().alias('instances_with_null')
+    )
+
+    totals_obs = array_collection_obs.select(KEYS + ['num_instances']).with_row_index('order')
+    totals_planes = array_collection_planes.select(KEYS + ['num_instances']).unique(subset=KEYS, keep='first', maintain_order=True)
+    table_summaries = []
+    for table_order, (table, totals, num_fields) in enumerate([
+            ("caom2.Observation", totals_obs, num_obs_fields),
+            ("caom2.Plane", totals_obs.select(['order'] + KEYS).join(totals_planes, on=KEYS, how='inner'), num_plane_fields)]):
+        table_summaries.append(totals.join(counts.filter(pl.col('table') == table), on=KEYS, how='left').with_columns(
+            pl.lit(table).alias('table'),
+            pl.lit(table_order).alias('table_order'),
+            pl.lit(int(num_fields)).alias('num_fields'),
+            (pl.col('num_instances') * int(num_fields)).alias('num_instances'),
+            pl.col('fields_with_null').fill_null(0),
+            pl.col('instances_with_null').fill_null(0)
+        ).select(['order', 'table_order', 'table'] + KEYS + ['num_fields', 'fields_with_null', 'num_instances', 'instances_with_null']))
+
+    summary = pl.concat(table_summaries).sort(['order', 'table_order']).with_columns(
+        (pl.col('fields_with_null') * 100 / pl.col('num_fields')).alias('percentage_fields_with_null'),
+        (pl.col('instances_with_null') * 100 / pl.col('num_instances')).alias('percentage_instances_with_null')
+    )
+    return [f"{row['table']},{row['collection']},{row['num_fields']},{row['fields_with_null']},{row['percentage_fields_with_null']:.2f},{row['num_instances']},{row['instances_with_null']},{row['percentage_instances_with_null']:.2f}\n" for row in summary.iter_rows(named=True)]
+
 if __name__ == "__main__":
 
     ## Determine where the caom2usage directory is located and change to that directory.
@@ -19,84 +82,44 @@ if __name__ == "__main__":
         print("Unable to determine the location of the caom2usage directory.")
         exit(1)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", action="store_true", help="Summarise the usageStore instead of the per-collection CSV files")
+    args = parser.parse_args()
+
     obs_filename = "config/collectionTotalObs.csv"
     planes_filename = "config/collectionTotalPlanes.csv"
     fields_filename = "config/fieldNames.csv"
     summary_filename = "fieldByCollection/sumFieldByCollection.csv"
 
     #
-    # Initialize the data structures for pre-generated collection counts for observations.
+    # Initialize the data structures for pre-generated collection counts for observations and planes.
     #
-    array_collection_obs = pd.read_csv(obs_filename)
-    num_collection_obs = len(array_collection_obs)
-    #print(f"Number of collection in {obs_filename}: {num_collection_obs}")
-    sum_instances_collection_obs = array_collection_obs['num_instances'].sum()
-    #print(f"Sum of instances of collection in {obs_filename}: {sum_instances_collection_obs}")
+    array_collection_obs = pl.read_csv(obs_filename, schema_overrides={key: pl.String for key in KEYS})
+    array_collection_planes = pl.read_csv(planes_filename, schema_overrides={key: pl.String for key in KEYS})
 
     #
-    # Initialize the data structures for pre-generated collection counts for planes.
+    # Initialize lists of fields to be checked for output.
     #
-    array_collection_planes = pd.read_csv(planes_filename)
-    num_collection_planes = len(array_collection_planes)
-    #print(f"Number of collection in {planes_filename}: {num_collection_planes}")
-    sum_instances_collection_planes = array_collection_planes['num_instances'].sum()
-    #print(f"Sum of instances of collection in {planes_filename}: {sum_instances_collection_planes}")
+    field_names = pl.read_csv(fields_filename)
+    num_obs_fields = field_names['field_name'].str.starts_with("caom2.Observation").sum()
+    num_plane_fields = field_names['field_name'].str.starts_with("caom2.Plane").sum()
 
     #
-    # Initialize the summary output filew with the CSV header.
+    # Load the field results of all the collections into one long table, either from the usageStore with --store
+    # or from the fieldByCollection files, in which case only the collections with a file are summarised.
     #
-    with open(summary_filename, 'w') as f:
-        f.write("Table,Collection,number of fields,fields with null values,percentage of fields with null values,number of instances,instances with null values,percentage of instances with null values\n")
-
-    #
-    # Initialize lists of fields to be checked for output.
-    #
-    field_names = pd.read_csv(fields_filename)
-    num_obs_fields = field_names['field_name'].str.startswith("caom2.Observation").sum()
-    num_plane_fields = field_names['field_name'].str.startswith("caom2.Plane").sum()
+    if args.store:
+        field_results = usageStore.load(STORE_LEVEL)
+        source = "the usageStore"
+    else:
+        array_collection_obs = array_collection_obs.filter(pl.Series([os.path.isfile(collection_filename(collection)) for (collection,) in array_collection_obs.select(KEYS).iter_rows()], dtype=pl.Boolean))
+        field_results = load_collection_results(array_collection_obs)
+        source = "fieldByCollection"
+    print(f"Loaded {len(field_results)} field results for {len(array_collection_obs)} collections from {source}")
 
     #
-    # Now loop through the collections and summarize the corresponding output file.
+    # Summarise all the collections at once and write the summary file with its CSV header.
     #
-    for index, row_obs in array_collection_obs.iterrows():
-        collection = row_obs['collection']
-        num_collection_observations = row_obs['num_instances']
-        num_collection_obs_instances = num_collection_observations * num_obs_fields
-        collection_filename = f"fieldByCollection/{collection}.csv"
-
-        if os.path.isfile(collection_filename):
-            print(f"Processing collection {collection} from {collection_filename}")
-            results = pd.read_csv(collection_filename)
-
-            ## Process Observation fields
-
-            obs_results = results[results['Field'].str.contains("caom2.Observation")]
-            #print(obs_results)
-
-            num_collection_obs_fields_with_null = len(obs_results)
-            #print(f"Number of obs fields with null for {collection}: {num_collection_obs_fields_with_null}")
-            percentage_obs_fields_with_null = num_collection_obs_fields_with_null * 100 / num_obs_fields
-
-            num_collection_obs_instances_with_null = obs_results['num_null'].sum()
-            #print(f"Number of obs instances with null for {collection}: {num_collection_obs_instances_with_null}")
-            percentage_obs_instances_with_null = num_collection_obs_instances_with_null * 100 / num_collection_obs_instances
-            with open(summary_filename, 'a') as f:
-                f.write(f"caom2.Observation,{collection},{num_obs_fields},{num_collection_obs_fields_with_null},{percentage_obs_fields_with_null:.2f},{num_collection_obs_instances},{num_collection_obs_instances_with_null},{percentage_obs_instances_with_null:.2f}\n")    
-
-            ## Process Plane fields
-
-            row_planes = array_collection_planes[array_collection_planes['collection'] == collection]
-            if len(row_planes) > 0:
-                num_collection_planes = row_planes['num_instances'].values[0]
-                num_collection_plane_instances = num_collection_planes * num_plane_fields
-
-                plane_results = results[results['Field'].str.contains("caom2.Plane")]
-                #print(plane_results)
-                num_collection_plane_fields_with_null = len(plane_results)
-                percentage_plane_fields_with_null = num_collection_plane_fields_with_null * 100 / num_plane_fields
-                #print(f"Number of plane fields with null for {collection}: {num_collection_plane_fields_with_null}")
-                num_collection_plane_instances_with_null = plane_results['num_null'].sum()
-                #print(f"Number of plane instances with null for {collection}: {num_collection_plane_instances_with_null}")
-                percentage_plane_instances_with_null = num_collection_plane_instances_with_null * 100 / num_collection_plane_instances
-                with open(summary_filename, 'a') as f:
-                    f.write(f"caom2.Plane,{collection},{num_plane_fields},{num_collection_plane_fields_with_null},{percentage_plane_fields_with_null:.2f},{num_collection_plane_instances},{num_collection_plane_instances_with_null},{percentage_plane_instances_with_null:.2f}\n")    
+    with open(summary_filename, 'w') as f:
+        f.write("Table,Collection,number of fields,fields with null values,percentage of fields with null values,number of instances,instances with null values,percentage of instances with null values\n")
+        f.writelines(summarise_collection(field_results, array_collection_obs, array_collection_planes, num_obs_fields, num_plane_fields))